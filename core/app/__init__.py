@@ -13,11 +13,14 @@ from pathlib import Path
 
 from .config import get_config
 
+# Per client address; app.asgi enforces it on the streams it serves itself
+DEFAULT_RATE_LIMIT = "1000 per minute"
+
 # Extensions
 db = SQLAlchemy()
 limiter = Limiter(
     key_func=get_remote_address,
-    default_limits=["1000 per minute"]
+    default_limits=[DEFAULT_RATE_LIMIT]
 )
 
 # API with Swagger documentation
@@ -0,0 +1,113 @@
+"""
+ASGI entry point: async audio streaming mounted next to the Flask app.
+
+/api/v1/tracks/stream/<video_id> is served by AsyncStreamer on the event
+loop; every other path, and ?download=1 requests (which fetch segments on
+their own thread pool), is passed to the Flask app through WsgiToAsgi.
+Streams served here never reach Flask-Limiter, so the handler applies the
+same default limit to them, counted per client address in the limiter's
+storage.
+
+Run with: uvicorn --factory app.asgi:create_asgi_app --workers 4
+"""
+import asyncio
+import json
+import re
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+from limits import parse_many
+
+from . import create_app, limiter, DEFAULT_RATE_LIMIT
+from .middleware.error_handler import generate_request_id
+from .services.async_stream import AsyncStreamer
+from .services.bandwidth import bandwidth
+
+STREAM_PATH_RE = re.compile(r'^/api/v1/tracks/stream/([^/]+)$')
+
+
+def create_asgi_app(flask_app=None):
+    """Create the ASGI application wrapping a Flask app."""
+    flask_app = flask_app or create_app()
+    wsgi = WsgiToAsgi(flask_app)
+    streamer = AsyncStreamer(flask_app)
+    stream_limits = parse_many(DEFAULT_RATE_LIMIT)
+    
+    def within_rate_limit(client: str) -> bool:
+        # Every limit is hit, like Flask-Limiter does, so each window counts the request
+        return all([limiter.limiter.hit(limit, 'asgi-stream', client) for limit in stream_limits])
+    
+    async def application(scope, receive, send):
+        match = STREAM_PATH_RE.match(scope.get('path', '')) if scope['type'] == 'http' else None
+        if match is None or scope['method'] != 'GET' or _needs_wsgi(scope):
+            return await wsgi(scope, receive, send)
+        
+        headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope['headers']}
+        if not flask_app.config.get('ALLOW_ANONYMOUS_ACCESS', False) and not headers.get('x-api-key'):
+            return await _send_error(send, 'API_KEY_REQUIRED', 'API key required', 401)
+        
+        if limiter.enabled:
+            client = (scope.get('client') or ('127.0.0.1',))[0]
+            # Shared storage (e.g. Redis) is network I/O
+            if not await asyncio.get_running_loop().run_in_executor(None, within_rate_limit, client):
+                return await _send_error(send, 'RATE_LIMIT_EXCEEDED', 'Too many requests, please slow down', 429)
+        
+        body, response_headers, status = await streamer.stream(match.group(1), headers.get('range'))
+        if body is None:
+            return await _send_error(send, 'STREAM_ERROR', 'Could not start stream', status)
+        
+        with flask_app.app_context():
+            shaper = bandwidth.open(headers.get('x-api-key'))
+        
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(k.lower().encode('latin-1'), str(v).encode('latin-1'))
+                        for k, v in response_headers.items() if v is not None],
+        })
+        # Servers keep accepting sends after a disconnect, so watch for it explicitly
+        disconnected = asyncio.Event()
+        
+        async def watch_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            disconnected.set()
+        
+        watcher = asyncio.ensure_future(watch_disconnect())
+        try:
+            async for chunk in body:
+                if disconnected.is_set():
+                    break
+                if shaper:
+                    await shaper.apace(len(chunk))
+                # Awaiting send applies the server's flow control to upstream reads
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            if not disconnected.is_set():
+                await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            watcher.cancel()
+            await body.aclose()
+            if shaper:
+                shaper.close()
+    
+    return application
+
+
+def _needs_wsgi(scope) -> bool:
+    """Downloads, quality/codec variants and seeks are only implemented by the WSGI stream path."""
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    return query.get('download', [''])[-1].lower() in ('1', 'true') \
+        or any(query.get(name) for name in ('quality', 'codec', 'kbps', 't'))
+
+
+async def _send_error(send, code: str, message: str, status: int):
+    """Send an error body in the same shape as middleware.error_response."""
+    payload = json.dumps({
+        'error': {'code': code, 'message': message, 'request_id': generate_request_id()}
+    }).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(payload)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': payload})
@@ -24,6 +24,11 @@ class Config:
     
     # Redis (optional)
     REDIS_URL = os.getenv('REDIS_URL', None)
+    REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', 50))
+    REDIS_SOCKET_TIMEOUT = float(os.getenv('REDIS_SOCKET_TIMEOUT', 1.0))
+    REDIS_CONNECT_TIMEOUT = float(os.getenv('REDIS_CONNECT_TIMEOUT', 1.0))
+    REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv('REDIS_HEALTH_CHECK_INTERVAL', 30))
+    REDIS_RETRY_MAX_BACKOFF = int(os.getenv('REDIS_RETRY_MAX_BACKOFF', 30))  # seconds
     
     # Rate Limiting
     RATE_LIMIT_DEFAULT = os.getenv('RATE_LIMIT_DEFAULT', '100/minute')
@@ -31,11 +36,116 @@ class Config:
     
     # Cache TTL (seconds)
     CACHE_TTL_SEARCH = 300  # 5 minutes
+    SEARCH_MIN_FETCH_LIMIT = int(os.getenv('SEARCH_MIN_FETCH_LIMIT', 20))  # Smaller searches are served from this
     CACHE_TTL_TRACK = 3600  # 1 hour
     CACHE_TTL_RECOMMENDATIONS = 1800  # 30 minutes
     CACHE_TTL_ARTIST = 3600  # 1 hour
     CACHE_TTL_ALBUM = 3600  # 1 hour
     
+    # Redis value encoding: json|msgpack, compression none|zlib|zstd|lz4 above the threshold (bytes)
+    CACHE_SERIALIZER = os.getenv('CACHE_SERIALIZER', 'json')
+    CACHE_COMPRESSION = os.getenv('CACHE_COMPRESSION', 'zlib')
+    CACHE_COMPRESSION_THRESHOLD = int(os.getenv('CACHE_COMPRESSION_THRESHOLD', 1024))
+    
+    # Stale-while-revalidate: serve expired entries CACHE_STALE_RATIO times their
+    # fresh TTL longer while refreshing, but never more than CACHE_STALE_TTL seconds
+    CACHE_STALE_RATIO = float(os.getenv('CACHE_STALE_RATIO', 1.0))
+    CACHE_STALE_TTL = int(os.getenv('CACHE_STALE_TTL', 3600))
+    CACHE_REFRESH_RETRY = int(os.getenv('CACHE_REFRESH_RETRY', 30))
+    CACHE_REFRESH_WORKERS = int(os.getenv('CACHE_REFRESH_WORKERS', 4))
+    
+    # Negative cache for IDs upstream reports as missing, and for transient upstream errors
+    NEGATIVE_CACHE_TTL = int(os.getenv('NEGATIVE_CACHE_TTL', 600))
+    NEGATIVE_CACHE_ERROR_TTL = int(os.getenv('NEGATIVE_CACHE_ERROR_TTL', 30))
+    
+    # Max seconds a request waits on an identical in-flight upstream call
+    CACHE_SINGLEFLIGHT_TIMEOUT = int(os.getenv('CACHE_SINGLEFLIGHT_TIMEOUT', 30))
+    # Redis lease lifetime for cross-node work; a crashed owner blocks others at most this long
+    CACHE_LEASE_TTL = int(os.getenv('CACHE_LEASE_TTL', 30))
+    # After the lease owner's load fails, other nodes get its outcome this long instead of retrying
+    CACHE_LEASE_FAILURE_TTL = int(os.getenv('CACHE_LEASE_FAILURE_TTL', 10))
+    
+    # In-memory cache budget (used when Redis is unavailable)
+    CACHE_MEMORY_MAX_ENTRIES = int(os.getenv('CACHE_MEMORY_MAX_ENTRIES', 10000))
+    CACHE_MEMORY_MAX_BYTES = int(os.getenv('CACHE_MEMORY_MAX_BYTES', 64 * 1024 * 1024))  # 64 MB
+    
+    # Per-process L1 cache in front of Redis
+    CACHE_L1_ENABLED = os.getenv('CACHE_L1_ENABLED', 'true').lower() == 'true'
+    CACHE_L1_TTL = int(os.getenv('CACHE_L1_TTL', 5))
+    CACHE_L1_MAX_ENTRIES = int(os.getenv('CACHE_L1_MAX_ENTRIES', 2000))
+    CACHE_L1_MAX_BYTES = int(os.getenv('CACHE_L1_MAX_BYTES', 16 * 1024 * 1024))  # 16 MB
+    CACHE_L1_PUBSUB = os.getenv('CACHE_L1_PUBSUB', 'true').lower() == 'true'
+    CACHE_L1_CHANNEL = os.getenv('CACHE_L1_CHANNEL', 'cache:invalidate')
+    
+    # On-disk audio cache for /tracks/stream
+    AUDIO_CACHE_ENABLED = os.getenv('AUDIO_CACHE_ENABLED', 'true').lower() == 'true'
+    AUDIO_CACHE_MAX_BYTES = int(os.getenv('AUDIO_CACHE_MAX_BYTES', 2 * 1024 ** 3))  # 2 GB
+    AUDIO_CACHE_MAX_FILE_BYTES = int(os.getenv('AUDIO_CACHE_MAX_FILE_BYTES', 50 * 1024 ** 2))  # 50 MB
+    AUDIO_CACHE_META_FLUSH_BYTES = int(os.getenv('AUDIO_CACHE_META_FLUSH_BYTES', 1024 ** 2))  # Persist extent map every 1 MB
+    AUDIO_CACHE_MIN_CACHED_RUN = int(os.getenv('AUDIO_CACHE_MIN_CACHED_RUN', 64 * 1024))  # Smaller cached gaps are refetched
+    AUDIO_CACHE_SENDFILE_MODE = os.getenv('AUDIO_CACHE_SENDFILE_MODE', 'wsgi')  # wsgi, x-accel, x-sendfile or off
+    AUDIO_CACHE_ACCEL_PREFIX = os.getenv('AUDIO_CACHE_ACCEL_PREFIX', '/_audio_cache/')  # nginx internal location
+    
+    # In-memory heads of popular tracks so playback starts before upstream connects
+    STREAM_HEAD_ENABLED = os.getenv('STREAM_HEAD_ENABLED', 'true').lower() == 'true'
+    STREAM_HEAD_BYTES = int(os.getenv('STREAM_HEAD_BYTES', 192 * 1024))  # ~10 s at 160 kbps
+    STREAM_HEAD_MIN_PLAYS = int(os.getenv('STREAM_HEAD_MIN_PLAYS', 3))  # Plays within the window before caching a head
+    STREAM_HEAD_PLAY_WINDOW = int(os.getenv('STREAM_HEAD_PLAY_WINDOW', 86400))
+    STREAM_HEAD_PLAYS_MAX_ENTRIES = int(os.getenv('STREAM_HEAD_PLAYS_MAX_ENTRIES', 50000))  # Tracks whose plays are counted
+    STREAM_HEAD_TTL = int(os.getenv('STREAM_HEAD_TTL', 86400))
+    STREAM_HEAD_MAX_ENTRIES = int(os.getenv('STREAM_HEAD_MAX_ENTRIES', 1000))
+    STREAM_HEAD_CACHE_MAX_BYTES = int(os.getenv('STREAM_HEAD_CACHE_MAX_BYTES', 128 * 1024 * 1024))  # 128 MB
+    STREAM_HEAD_WORKERS = int(os.getenv('STREAM_HEAD_WORKERS', 16))  # Threads opening upstream tails
+    
+    # Download mode (?download=1): whole files over parallel upstream range requests
+    STREAM_DOWNLOAD_ENABLED = os.getenv('STREAM_DOWNLOAD_ENABLED', 'true').lower() == 'true'
+    STREAM_DOWNLOAD_SEGMENT_BYTES = int(os.getenv('STREAM_DOWNLOAD_SEGMENT_BYTES', 1024 * 1024))
+    STREAM_DOWNLOAD_PARALLELISM = int(os.getenv('STREAM_DOWNLOAD_PARALLELISM', 4))  # Connections per download
+    STREAM_DOWNLOAD_WORKERS = int(os.getenv('STREAM_DOWNLOAD_WORKERS', 32))  # Segment threads across downloads
+    STREAM_RESUME_RETRIES = int(os.getenv('STREAM_RESUME_RETRIES', 3))  # Upstream reconnects per response mid-stream
+    
+    # Bandwidth scheduling: token buckets per stream, per API key and for the whole process
+    BANDWIDTH_ENABLED = os.getenv('BANDWIDTH_ENABLED', 'false').lower() == 'true'
+    BANDWIDTH_PLAYBACK_KBPS = int(os.getenv('BANDWIDTH_PLAYBACK_KBPS', 160))  # Assumed audio bitrate of a playback stream
+    BANDWIDTH_PLAYBACK_HEADROOM = float(os.getenv('BANDWIDTH_PLAYBACK_HEADROOM', 1.5))  # Playback rate, times real time
+    BANDWIDTH_PLAYBACK_BURST_SECONDS = int(os.getenv('BANDWIDTH_PLAYBACK_BURST_SECONDS', 10))  # Audio sent unpaced first
+    BANDWIDTH_BULK_KBPS = int(os.getenv('BANDWIDTH_BULK_KBPS', 0))  # Per download, 0 = unlimited
+    BANDWIDTH_BULK_RESERVE = float(os.getenv('BANDWIDTH_BULK_RESERVE', 0.25))  # Global burst kept for playback only
+    BANDWIDTH_PER_KEY_KBPS = int(os.getenv('BANDWIDTH_PER_KEY_KBPS', 0))  # All streams of one API key, 0 = unlimited
+    BANDWIDTH_GLOBAL_KBPS = int(os.getenv('BANDWIDTH_GLOBAL_KBPS', 0))  # Process egress cap, 0 = unlimited
+    BANDWIDTH_BURST_SECONDS = float(os.getenv('BANDWIDTH_BURST_SECONDS', 1))  # Burst of the key and global buckets
+    
+    # Time seeks (?t=): sidx / Cues index read from the head of the file
+    SEEK_INDEX_PROBE_BYTES = int(os.getenv('SEEK_INDEX_PROBE_BYTES', 64 * 1024))  # Head bytes read to find the index
+    SEEK_INDEX_TTL = int(os.getenv('SEEK_INDEX_TTL', 86400))
+    SEEK_INDEX_MISS_TTL = int(os.getenv('SEEK_INDEX_MISS_TTL', 300))  # Files without a usable index
+    
+    # Bitrate/codec variants (?quality= or ?codec=&kbps=): native formats, else ffmpeg
+    TRANSCODE_ENABLED = os.getenv('TRANSCODE_ENABLED', 'true').lower() == 'true'
+    TRANSCODE_FFMPEG = os.getenv('TRANSCODE_FFMPEG', 'ffmpeg')
+    TRANSCODE_MAX_PROCESSES = int(os.getenv('TRANSCODE_MAX_PROCESSES', 0))  # Concurrent ffmpeg runs, 0 = half the CPUs
+    TRANSCODE_QUEUE_TIMEOUT = float(os.getenv('TRANSCODE_QUEUE_TIMEOUT', 2))  # Wait for a slot before using a native format
+    TRANSCODE_NATIVE_TOLERANCE = float(os.getenv('TRANSCODE_NATIVE_TOLERANCE', 0.35))  # Native bitrate distance accepted, of target
+    
+    # ASGI streaming proxy (app.asgi)
+    ASYNC_STREAM_WORKERS = int(os.getenv('ASYNC_STREAM_WORKERS', 32))  # Threads for URL resolution and cache I/O
+    ASYNC_STREAM_MAX_UPSTREAM = int(os.getenv('ASYNC_STREAM_MAX_UPSTREAM', 10000))  # Concurrent upstream connections
+    
+    # Stream URL resolver (yt-dlp worker pool)
+    RESOLVER_WORKERS = int(os.getenv('RESOLVER_WORKERS', 8))
+    RESOLVER_BACKEND = os.getenv('RESOLVER_BACKEND', 'thread')  # thread or process (yt-dlp in worker processes)
+    RESOLVER_PROCESSES = int(os.getenv('RESOLVER_PROCESSES', 0))  # Process backend pool size, 0 = CPU count
+    RESOLVER_PLAYER_CLIENTS = os.getenv('RESOLVER_PLAYER_CLIENTS', 'android,ios')  # yt-dlp player clients
+    RESOLVER_RACE_CLIENTS = os.getenv('RESOLVER_RACE_CLIENTS', 'false').lower() == 'true'  # Ask all clients at once
+    RESOLVER_RACE_HEDGE_MS = int(os.getenv('RESOLVER_RACE_HEDGE_MS', 0))  # Stagger racing clients, 0 = all at once
+    RESOLVER_FAST_PATH = os.getenv('RESOLVER_FAST_PATH', 'true').lower() == 'true'  # Player endpoint before yt-dlp
+    RESOLVER_FAST_PATH_TIMEOUT = int(os.getenv('RESOLVER_FAST_PATH_TIMEOUT', 5))
+    RESOLVER_QUEUE_SIZE = int(os.getenv('RESOLVER_QUEUE_SIZE', 64))  # Pending extractions before rejecting
+    RESOLVER_TIMEOUT = int(os.getenv('RESOLVER_TIMEOUT', 30))
+    RESOLVER_TTL = int(os.getenv('RESOLVER_TTL', 3600))  # Only for URLs without an expire= parameter
+    RESOLVER_EXPIRY_SAFETY = int(os.getenv('RESOLVER_EXPIRY_SAFETY', 60))  # Drop cached URLs this long before expire=
+    RESOLVER_REFRESH_MARGIN = int(os.getenv('RESOLVER_REFRESH_MARGIN', 300))  # Re-resolve this long before expiry
+    
     # Service URLs (for cross-linking in Docker/Production)
     API_URL = os.getenv('API_URL', 'http://localhost:5001')
     DASHBOARD_URL = os.getenv('DASHBOARD_URL', 'http://localhost:5002')
@@ -45,9 +155,12 @@ class Config:
     WHISPER_MODEL = os.getenv('WHISPER_MODEL', 'base')
     WHISPER_DEVICE = os.getenv('WHISPER_DEVICE', 'cpu')
     WHISPER_COMPUTE_TYPE = os.getenv('WHISPER_COMPUTE_TYPE', 'int8')
+    TRANSCRIBE_WAIT_TIMEOUT = int(os.getenv('TRANSCRIBE_WAIT_TIMEOUT', 300))
+    TRANSCRIBE_LEASE_TTL = int(os.getenv('TRANSCRIBE_LEASE_TTL', 600))
     
     # Directories
     LYRICS_CACHE_DIR = BASE_DIR / 'cache' / 'lyrics'
+    AUDIO_CACHE_DIR = Path(os.getenv('AUDIO_CACHE_DIR', BASE_DIR / 'cache' / 'audio'))
     DOWNLOADS_DIR = BASE_DIR / 'downloads'
 
 
@@ -76,6 +189,9 @@ class TestingConfig(Config):
     # No rate limiting in tests
     RATE_LIMIT_DEFAULT = '1000/minute'
     RATE_LIMIT_SEARCH = '1000/minute'
+    
+    # Tests never call the player endpoint unless they mock it
+    RESOLVER_FAST_PATH = False
 
 
 config = {
@@ -13,10 +13,11 @@ browse_ns = Namespace('browse', description='Trending, genres, recommendations')
 lyrics_ns = Namespace('lyrics', description='Lyrics & transcription')
 playlists_ns = Namespace('playlists', description='Playlist management')
 health_ns = Namespace('health', description='Health checks')
+metrics_ns = Namespace('metrics', description='Cache and service metrics')
 
 def register_namespaces(api: Api):
     """Register all namespaces with the API."""
-    from . import search, tracks, artists, albums, browse, lyrics, playlists, health, player
+    from . import search, tracks, artists, albums, browse, lyrics, playlists, health, metrics, player
     
     api.add_namespace(search_ns, path='/search')
     api.add_namespace(tracks_ns, path='/tracks')
@@ -26,11 +27,12 @@ def register_namespaces(api: Api):
     api.add_namespace(lyrics_ns, path='/lyrics')
     api.add_namespace(playlists_ns, path='/playlists')
     api.add_namespace(health_ns, path='/health')
+    api.add_namespace(metrics_ns, path='/metrics')
     api.add_namespace(player.player_ns, path='/player-docs')
 
 def register_blueprints(app):
     """Register all blueprints with the Flask app."""
-    from . import search, tracks, artists, albums, browse, lyrics, playlists, health, player, compat
+    from . import search, tracks, artists, albums, browse, lyrics, playlists, health, metrics, player, compat
     prefix = '/api/v1'
     
     app.register_blueprint(search.bp, url_prefix=prefix)
@@ -41,6 +43,7 @@ def register_blueprints(app):
     app.register_blueprint(lyrics.bp, url_prefix=prefix)
     app.register_blueprint(playlists.bp, url_prefix=prefix)
     app.register_blueprint(health.bp, url_prefix=prefix)
+    app.register_blueprint(metrics.bp, url_prefix=prefix)
     app.register_blueprint(player.bp, url_prefix='/player')
     app.register_blueprint(compat.bp)
 
@@ -39,6 +39,7 @@ class Lyrics(Resource):
 class Transcribe(Resource):
     @ns.doc('transcribe_lyrics', security='apikey')
     @ns.response(200, 'Transcribed lyrics with timestamps')
+    @ns.response(400, 'Invalid video ID')
     @ns.response(503, 'Transcription service unavailable')
     @require_api_key
     def post(self, video_id):
@@ -46,6 +47,8 @@ class Transcribe(Resource):
         try:
             result = transcription.transcribe(video_id)
             return success_response(result)
+        except ValueError as e:
+            return error_response('INVALID_VIDEO_ID', str(e), 400)
         except RuntimeError as e:
             return error_response('TRANSCRIPTION_UNAVAILABLE', str(e), 503)
         except Exception as e:
@@ -75,6 +78,8 @@ def transcribe_lyrics(video_id):
     try:
         result = transcription.transcribe(video_id)
         return success_response(result)
+    except ValueError as e:
+        return error_response('INVALID_VIDEO_ID', str(e), 400)
     except RuntimeError as e:
         return error_response('TRANSCRIPTION_UNAVAILABLE', str(e), 503)
     except Exception as e:
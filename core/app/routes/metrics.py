@@ -0,0 +1,66 @@
+"""
+Metrics routes with Swagger documentation - cache and service counters.
+"""
+from flask import Blueprint
+from flask_restx import Resource
+
+from app.routes import metrics_ns as ns
+from app.services import cache, metrics, resolver, require_master_key
+from app.services.audio_cache import audio_cache
+from app.services.bandwidth import bandwidth
+from app.services.head_cache import head_cache
+from app.services.transcoder import transcoder
+from app.middleware import success_response
+
+bp = Blueprint('metrics', __name__)
+
+
+def _snapshot():
+    return {
+        'cache': cache.stats(),
+        'audio_cache': audio_cache.stats(),
+        'head_cache': head_cache.stats(),
+        'resolver': resolver.stats(),
+        'transcoder': transcoder.stats(),
+        'bandwidth': bandwidth.stats(),
+        **metrics.snapshot()
+    }
+
+
+def _reset():
+    cache.reset_stats()
+    metrics.reset()
+    return {'status': 'reset'}
+
+
+@ns.route('')
+class Metrics(Resource):
+    @ns.doc('get_metrics', security='masterkey')
+    @ns.response(200, 'Cache statistics per tier and key prefix, plus service counters')
+    @require_master_key
+    def get(self):
+        """Get cache hit ratios, latencies and service counters"""
+        return success_response(_snapshot())
+
+
+@ns.route('/reset')
+class MetricsReset(Resource):
+    @ns.doc('reset_metrics', security='masterkey')
+    @ns.response(200, 'Counters reset')
+    @require_master_key
+    def post(self):
+        """Reset all cache and service counters"""
+        return success_response(_reset())
+
+
+# Keep Flask blueprint routes
+@bp.route('/metrics', methods=['GET'])
+@require_master_key
+def get_metrics():
+    return success_response(_snapshot())
+
+
+@bp.route('/metrics/reset', methods=['POST'])
+@require_master_key
+def reset_metrics():
+    return success_response(_reset())
@@ -1,8 +1,9 @@
 """
 Track routes with Swagger documentation.
 """
-from flask import Blueprint, request, Response, g
+from flask import Blueprint, request, Response, g, current_app
 from flask_restx import Resource, fields
+from werkzeug.wsgi import wrap_file
 import yt_dlp
 import requests as http_requests
 
@@ -13,6 +14,9 @@ from app.middleware import success_response, error_response
 bp = Blueprint('tracks', __name__)
 
 from app.services.youtube_music import ytmusic
+from app.services.audio_cache import CachedFile
+from app.services.bandwidth import bandwidth
+from app.services.transcoder import parse_target
 
 @ns.route('/<video_id>')
 class Track(Resource):
@@ -35,19 +39,70 @@ def stream_track(video_id):
     """Stream audio directly."""
 
     range_header = request.headers.get('Range')
-    generate, headers, status = ytmusic.stream_track(video_id, range_header)
+    download = request.args.get('download', '').lower() in ('1', 'true')
+    try:
+        variant = parse_target(request.args.get('quality'), request.args.get('codec'), request.args.get('kbps'))
+    except ValueError as e:
+        return error_response('INVALID_QUALITY', str(e), 400)
+    try:
+        seek = float(request.args['t']) if request.args.get('t') else None
+        if seek is not None and not 0 <= seek < 86400:
+            raise ValueError
+    except ValueError:
+        return error_response('INVALID_SEEK', 't must be a time in seconds', 400)
+    generate, headers, status = ytmusic.stream_track(video_id, range_header, download, variant, seek)
     
     if not generate:
         return error_response('STREAM_ERROR', 'Could not start stream', status)
-        
-    # Wrap generator for kill-switch
-    from flask import current_app
-    flask_app = current_app._get_current_object()
-    def wrapped_generate():
-        for chunk in generate():
-            yield chunk
     
-    return Response(wrapped_generate(), status=status, headers=headers)
+    # Paced by the bandwidth scheduler; released when the response is closed
+    shaper = bandwidth.open(request.headers.get('X-API-Key'), bulk=download and not range_header,
+                            kbps=variant[1] if variant else None)
+    
+    if isinstance(generate, CachedFile):
+        response = _send_cached_file(generate, headers, status, shaper)
+    else:
+        response = Response(_paced(generate(), shaper), status=status, headers=headers)
+    if shaper:
+        response.call_on_close(shaper.close)
+    if getattr(generate, 'close', None):
+        # Bodies holding resources (an upstream response, an ffmpeg slot) free them even if never iterated
+        response.call_on_close(generate.close)
+    return response
+
+
+def _paced(chunks, shaper):
+    """Yield a body no faster than the bandwidth scheduler allows."""
+    for chunk in chunks:
+        if shaper:
+            shaper.pace(len(chunk))
+        yield chunk
+
+
+def _send_cached_file(cached, headers, status, shaper=None):
+    """Let the server send a locally cached file instead of copying it through Python."""
+    mode = current_app.config.get('AUDIO_CACHE_SENDFILE_MODE', 'wsgi')
+    
+    if mode in ('x-accel', 'x-sendfile') and cached.complete:
+        # The front-end server reads the file and applies Range itself
+        headers = {k: v for k, v in headers.items() if k not in ('Content-Length', 'Content-Range')}
+        if mode == 'x-accel':
+            prefix = current_app.config.get('AUDIO_CACHE_ACCEL_PREFIX', '/_audio_cache/')
+            headers['X-Accel-Redirect'] = f"{prefix.rstrip('/')}/{cached.path.name}"
+            if shaper and shaper.rate:
+                # nginx paces the connection itself; key and global limits don't reach it
+                headers['X-Accel-Limit-Rate'] = str(int(shaper.rate))
+        else:
+            headers['X-Sendfile'] = str(cached.path.resolve())
+        return Response(status=200, headers=headers)
+    
+    if mode == 'off' or cached.end != cached.size - 1 or (shaper and shaper.limited):
+        # wsgi.file_wrapper may send to EOF, and can't be paced, so these are read in Python
+        return Response(_paced(cached(), shaper), status=status, headers=headers)
+    
+    # Servers such as gunicorn turn wsgi.file_wrapper into os.sendfile from the current offset
+    body = wrap_file(request.environ, cached.open(), 256 * 1024)
+    return Response(body, status=status, headers=headers, direct_passthrough=True)
 
 
 @ns.route('/thumbnail/<video_id>')
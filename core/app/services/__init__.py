@@ -1,11 +1,15 @@
 """Services package."""
+from .metrics import metrics, MetricsRegistry
 from .cache import cache, CacheService
+from .resolver import resolver, StreamResolver
 from .youtube_music import ytmusic, YouTubeMusicService
 from .auth import require_api_key, require_master_key, optional_api_key
 from .transcription import transcription, TranscriptionService
 
 __all__ = [
+    'metrics', 'MetricsRegistry',
     'cache', 'CacheService',
+    'resolver', 'StreamResolver',
     'ytmusic', 'YouTubeMusicService',
     'require_api_key', 'require_master_key', 'optional_api_key',
     'transcription', 'TranscriptionService'
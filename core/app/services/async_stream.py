@@ -0,0 +1,355 @@
+"""
+Asyncio streaming proxy for /tracks/stream.
+
+Mirrors YouTubeMusicService.stream_track, but upstream bytes are read with
+httpx.AsyncClient so an active listener costs a coroutine instead of a
+worker thread. Blocking work (URL resolution, cache file I/O) runs in a
+small thread pool.
+"""
+import asyncio
+import time
+from contextlib import aclosing
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, Optional
+
+import httpx
+
+from .audio_cache import audio_cache, CachedFile, parse_range, parse_content_range
+from .head_cache import head_cache
+from .metrics import metrics
+from .resolver import resolver
+from .validation import is_valid_video_id
+from .youtube_music import ytmusic, UpstreamError, STALE_URL_STATUSES
+
+CHUNK_SIZE = 64 * 1024
+
+
+class AsyncStreamer:
+    """Serves audio from the disk and head caches, fetching the rest with httpx."""
+    
+    def __init__(self, app):
+        self.app = app
+        self._executor = ThreadPoolExecutor(
+            max_workers=app.config.get('ASYNC_STREAM_WORKERS', 32),
+            thread_name_prefix='async-stream',
+        )
+        self._client = None
+    
+    def _get_client(self) -> httpx.AsyncClient:
+        """Shared client, created on the serving event loop."""
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(30, read=60),
+                limits=httpx.Limits(
+                    max_connections=self.app.config.get('ASYNC_STREAM_MAX_UPSTREAM', 10000),
+                    max_keepalive_connections=200,
+                ),
+                follow_redirects=True,
+            )
+        return self._client
+    
+    async def _run(self, fn: Callable, *args) -> Any:
+        """Run blocking service code in the thread pool under an app context."""
+        def call():
+            with self.app.app_context():
+                return fn(*args)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+    
+    async def stream(self, video_id: str, range_header: Optional[str] = None):
+        """Async twin of stream_track: (async body iterator, headers, status)."""
+        if not is_valid_video_id(video_id):
+            return None, None, 400
+        
+        with self.app.app_context():
+            use_head_cache = head_cache.enabled()
+            from_start = not range_header or range_header.replace(' ', '').startswith('bytes=0-')
+            popular = use_head_cache and from_start and head_cache.record_play(video_id)
+            use_audio_cache = audio_cache.enabled()
+        
+        # Lookups stat and touch files on disk
+        entry = await self._run(audio_cache.lookup, video_id) if use_audio_cache else None
+        if entry:
+            try:
+                byte_range = parse_range(range_header, entry['size'])
+            except ValueError:
+                byte_range = (0, -1)  # Unsatisfiable; serve() answers 416
+            start, end = byte_range or (0, entry['size'] - 1)
+            if end < start or audio_cache.covers(entry, start, end):
+                cached, headers, status = audio_cache.serve(entry, range_header)
+                return cached and self._read_file(cached), headers, status
+        
+        with self.app.app_context():
+            head = head_cache.get(video_id) if use_head_cache else None
+        
+        if head:
+            streamed = self._stream_from_head(video_id, head, range_header, use_audio_cache)
+            if streamed:
+                return streamed
+        
+        try:
+            audio_url = await self._run(ytmusic._get_audio_url, video_id)
+            if not audio_url:
+                return None, None, 404
+            
+            if entry:
+                # Size is known: mix cached extents with upstream fetches for the holes
+                body, headers, status = self._stream_sparse(
+                    video_id, entry, audio_url, start, end, byte_range is not None
+                )
+                if popular and start == 0:
+                    body = self._capture_head(video_id, entry['content_type'], entry['size'], body)
+                return body, headers, status
+            
+            upstream_headers = {'Range': range_header} if range_header else {}
+            resp, audio_url = await self._fetch(video_id, audio_url, upstream_headers)
+            
+            content_type = resp.headers.get('Content-Type', 'audio/webm')
+            response_headers = {
+                'Content-Type': content_type,
+                'Accept-Ranges': 'bytes',
+            }
+            
+            status_code = resp.status_code
+            if range_header and status_code == 206:
+                response_headers['Content-Range'] = resp.headers.get('Content-Range')
+                response_headers['Content-Length'] = resp.headers.get('Content-Length')
+            else:
+                if 'Content-Length' in resp.headers:
+                    response_headers['Content-Length'] = resp.headers.get('Content-Length')
+                status_code = 200
+            
+            writer = None
+            offset, total = ytmusic._body_position(resp)
+            if use_audio_cache and total:
+                writer = await self._open_writer(video_id, content_type, total, offset)
+            
+            length = resp.headers.get('Content-Length')
+            last = offset + int(length) - 1 if length and length.isdigit() else None
+            body = self._relay(video_id, audio_url, resp, offset, last, writer, total)
+            if popular and offset == 0 and total:
+                body = self._capture_head(video_id, content_type, total, body)
+            return body, response_headers, status_code
+        
+        except Exception as e:
+            self.app.logger.error(f"Error streaming track {video_id}: {e}")
+            return None, None, 500
+    
+    async def _relay(self, video_id: str, audio_url: str, resp: httpx.Response, start: int,
+                     end: Optional[int], writer=None, size: Optional[int] = None) -> AsyncIterator[bytes]:
+        """
+        Yield an upstream body that starts at byte `start`, teeing it into the
+        disk cache off the event loop and resuming from the current position
+        if the connection drops, like YouTubeMusicService._relay.
+        """
+        retries = self.app.config.get('STREAM_RESUME_RETRIES', 3)
+        position = start
+        pending = bytearray()
+        try:
+            while True:
+                try:
+                    async for chunk in resp.aiter_bytes(CHUNK_SIZE):
+                        if writer:
+                            pending += chunk
+                            if len(pending) >= 256 * 1024:
+                                await self._write(writer, bytes(pending))
+                                pending.clear()
+                        position += len(chunk)
+                        yield chunk
+                    if end is None or position > end:
+                        return
+                    error = UpstreamError(f"Upstream closed at byte {position} of {end + 1}")
+                except httpx.TransportError as e:
+                    error = e
+                await resp.aclose()
+                
+                if retries <= 0:
+                    metrics.incr('stream.resume_failed')
+                    self.app.logger.error(f"Gave up resuming {video_id} at byte {position}: {error}")
+                    return
+                retries -= 1
+                metrics.incr('stream.resume')
+                started = time.perf_counter()
+                try:
+                    resp, audio_url = await self._open_range(video_id, audio_url, position, end, size)
+                except Exception as e:
+                    metrics.incr('stream.resume_failed')
+                    self.app.logger.error(f"Could not resume {video_id} at byte {position} after {error}: {e}")
+                    return
+                metrics.observe('stream.resume_ms', (time.perf_counter() - started) * 1000)
+        finally:
+            await resp.aclose()
+            if writer:
+                await self._write(writer, bytes(pending))
+                await asyncio.get_running_loop().run_in_executor(self._executor, writer.close)
+    
+    async def _open_writer(self, video_id: str, content_type: str, size: int, offset: int):
+        """Get or create the cache entry (sizing its file and writing its metadata) and a writer at `offset`."""
+        def open_writer():
+            entry = audio_cache.begin(video_id, content_type, size)
+            return audio_cache.writer(entry, offset) if entry else None
+        return await self._run(open_writer)
+    
+    async def _write(self, writer, data: bytes):
+        if data:
+            await asyncio.get_running_loop().run_in_executor(self._executor, writer.write, data)
+    
+    async def _read_file(self, cached: CachedFile) -> AsyncIterator[bytes]:
+        """Yield a cached byte range, reading the file in the thread pool."""
+        loop = asyncio.get_running_loop()
+        f = await loop.run_in_executor(self._executor, cached.open)
+        try:
+            remaining = cached.end - cached.start + 1
+            while remaining > 0:
+                chunk = await loop.run_in_executor(self._executor, f.read, min(CHUNK_SIZE * 4, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            f.close()
+    
+    async def _fetch(self, video_id: str, audio_url: str, headers: Dict[str, str]):
+        """GET an audio URL; if upstream rejects it as stale, re-resolve and retry once."""
+        client = self._get_client()
+        resp = await client.send(client.build_request('GET', audio_url, headers=headers), stream=True)
+        if resp.status_code not in STALE_URL_STATUSES:
+            return resp, audio_url
+        
+        await resp.aclose()
+        metrics.incr('stream.stale_url')
+        await self._run(resolver.invalidate, video_id)
+        audio_url = await self._run(ytmusic._get_audio_url, video_id)
+        if not audio_url:
+            raise UpstreamError(f"No audio URL for {video_id}")
+        resp = await client.send(client.build_request('GET', audio_url, headers=headers), stream=True)
+        return resp, audio_url
+    
+    async def _open_range(self, video_id: str, audio_url: str, start: int,
+                          end: Optional[int] = None, size: Optional[int] = None):
+        """Open an upstream 206 response starting exactly at `start`: (resp, url)."""
+        resp, audio_url = await self._fetch(
+            video_id, audio_url, {'Range': f"bytes={start}-{'' if end is None else end}"}
+        )
+        content_range = parse_content_range(resp.headers.get('Content-Range'))
+        if resp.status_code != 206 or not content_range or content_range[0] != start:
+            await resp.aclose()
+            raise UpstreamError(f"Upstream returned HTTP {resp.status_code} for range {start}-{end}")
+        if size is not None and content_range[2] != size:
+            await resp.aclose()
+            metrics.incr('stream.size_mismatch')
+            raise UpstreamError(f"Upstream size of {video_id} is {content_range[2]}, expected {size}")
+        return resp, audio_url
+    
+    def _stream_sparse(self, video_id: str, entry: Dict[str, Any], audio_url: str,
+                       start: int, end: int, ranged: bool):
+        """Serve [start, end] from cached extents, fetching only the holes upstream."""
+        size = entry['size']
+        response_headers = {
+            'Content-Type': entry['content_type'],
+            'Accept-Ranges': 'bytes',
+            'Content-Length': str(end - start + 1),
+            'X-Cache': 'PARTIAL',
+        }
+        if ranged:
+            response_headers['Content-Range'] = f"bytes {start}-{end}/{size}"
+        runs = audio_cache.plan(entry, start, end)
+        
+        async def body():
+            nonlocal audio_url
+            for run_start, run_end, cached in runs:
+                if cached:
+                    async for chunk in self._read_file(CachedFile(audio_cache, entry, run_start, run_end)):
+                        yield chunk
+                    continue
+                try:
+                    resp, audio_url = await self._open_range(video_id, audio_url, run_start, run_end, size)
+                except Exception as e:
+                    self.app.logger.error(f"Error fetching {run_start}-{run_end} of {entry['key']}: {e}")
+                    return
+                writer = await self._run(audio_cache.writer, entry, run_start)
+                relay = self._relay(video_id, audio_url, resp, run_start, run_end, writer, size)
+                async with aclosing(relay):
+                    async for chunk in relay:
+                        yield chunk
+        
+        return body(), response_headers, 206 if ranged else 200
+    
+    def _stream_from_head(self, video_id: str, head, range_header: Optional[str], use_audio_cache: bool):
+        """Play a cached head while the URL is resolved and the tail connection opens."""
+        content_type, size, data = head
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            return None
+        start, end = byte_range or (0, size - 1)
+        if start >= len(data):
+            return None
+        
+        response_headers = {
+            'Content-Type': content_type,
+            'Accept-Ranges': 'bytes',
+            'Content-Length': str(end - start + 1),
+            'X-Cache': 'HEAD',
+        }
+        if byte_range is not None:
+            response_headers['Content-Range'] = f"bytes {start}-{end}/{size}"
+        
+        async def open_tail():
+            audio_url = await self._run(ytmusic._get_audio_url, video_id)
+            if not audio_url:
+                raise UpstreamError(f"No audio URL for {video_id}")
+            return await self._open_range(video_id, audio_url, len(data), end, size)
+        
+        tail = asyncio.ensure_future(open_tail()) if end >= len(data) else None
+        
+        async def body():
+            relayed = False
+            try:
+                yield data[start:end + 1]
+                if tail is None:
+                    return
+                try:
+                    resp, audio_url = await tail
+                except Exception as e:
+                    self.app.logger.error(f"Error fetching the rest of {video_id} after its head: {e}")
+                    return
+                relayed = True
+                writer = None
+                if use_audio_cache:
+                    try:
+                        writer = await self._open_writer(video_id, content_type, size, len(data))
+                    except Exception:
+                        await resp.aclose()
+                        raise
+                async with aclosing(self._relay(video_id, audio_url, resp, len(data), end, writer, size)) as relay:
+                    async for chunk in relay:
+                        yield chunk
+            finally:
+                if tail is not None and not relayed:
+                    await self._drop_tail(tail)
+        
+        return body(), response_headers, 206 if byte_range is not None else 200
+    
+    @staticmethod
+    async def _drop_tail(tail: asyncio.Future):
+        """Client left during the head: stop the tail fetch, or close its response if it connected."""
+        if not tail.done():
+            tail.cancel()
+        elif not tail.cancelled() and tail.exception() is None:
+            resp, _ = tail.result()
+            await resp.aclose()
+    
+    @staticmethod
+    async def _capture_head(video_id: str, content_type: str, size: int, body: AsyncIterator[bytes]):
+        """Pass a body starting at offset 0 through, storing its first bytes in the head cache."""
+        head = bytearray()
+        async with aclosing(body):
+            async for chunk in body:
+                if head is not None:
+                    head += chunk
+                    if len(head) >= head_cache.head_size:
+                        head_cache.put(video_id, content_type, size, head)
+                        head = None
+                yield chunk
+        if head is not None and len(head) == size:
+            head_cache.put(video_id, content_type, size, head)
@@ -0,0 +1,566 @@
+"""
+On-disk audio cache for proxied streams.
+
+Files are filled sparsely: every byte range that passes through the proxy is
+written at its offset into `{key}.part` and recorded in an extent map kept in
+`{key}.json`. Once the extents cover the whole file it is promoted to
+`{key}.audio`.
+"""
+import bisect
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from flask import current_app
+
+from .metrics import metrics
+
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+_CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+
+
+def parse_range(range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    Resolve a single-range `Range` header against a file size.
+    
+    Returns an inclusive (start, end) tuple, None when the header is absent
+    or not a single byte range, or raises ValueError when unsatisfiable.
+    """
+    if not range_header:
+        return None
+    match = _RANGE_RE.match(range_header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the final N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError('Unsatisfiable range')
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError('Unsatisfiable range')
+    return start, end
+
+
+def parse_content_range(content_range: Optional[str]) -> Optional[Tuple[int, int, Optional[int]]]:
+    """Parse an upstream `Content-Range` header into (start, end, total)."""
+    if not content_range:
+        return None
+    match = _CONTENT_RANGE_RE.match(content_range.strip())
+    if not match:
+        return None
+    start, end, total = match.groups()
+    return int(start), int(end), None if total == '*' else int(total)
+
+
+class ExtentMap:
+    """Sorted, non-overlapping half-open [start, end) byte ranges."""
+    
+    def __init__(self, extents: Optional[List[List[int]]] = None):
+        self._starts = []
+        self._ends = []
+        for start, end in extents or []:
+            self.add(start, end)
+    
+    def add(self, start: int, end: int):
+        """Mark [start, end) as present, merging with overlapping or touching extents."""
+        if end <= start:
+            return
+        i = bisect.bisect_left(self._ends, start)
+        j = i
+        while j < len(self._starts) and self._starts[j] <= end:
+            start = min(start, self._starts[j])
+            end = max(end, self._ends[j])
+            j += 1
+        self._starts[i:j] = [start]
+        self._ends[i:j] = [end]
+    
+    def covers(self, start: int, end: int) -> bool:
+        """Whether [start, end) is entirely present."""
+        i = bisect.bisect_right(self._starts, start) - 1
+        return i >= 0 and self._ends[i] >= end
+    
+    def plan(self, start: int, end: int) -> List[Tuple[int, int, bool]]:
+        """Split [start, end) into consecutive (start, end, present) runs."""
+        runs = []
+        position = start
+        i = max(bisect.bisect_right(self._starts, start) - 1, 0)
+        while position < end:
+            while i < len(self._starts) and self._ends[i] <= position:
+                i += 1
+            if i < len(self._starts) and self._starts[i] <= position:
+                run_end = min(self._ends[i], end)
+                runs.append((position, run_end, True))
+            else:
+                run_end = min(self._starts[i], end) if i < len(self._starts) else end
+                runs.append((position, run_end, False))
+            position = run_end
+        return runs
+    
+    def total(self) -> int:
+        return sum(end - start for start, end in zip(self._starts, self._ends))
+    
+    def to_list(self) -> List[List[int]]:
+        return [[start, end] for start, end in zip(self._starts, self._ends)]
+
+
+class CachedFile:
+    """
+    Byte range [start, end] of a cached file, returned in place of a chunk generator.
+    
+    Calling it yields the bytes like any stream generator; routes can instead
+    open it and hand the file to the server for a zero-copy send.
+    """
+    
+    def __init__(self, store: 'AudioCache', entry: Dict[str, Any], start: int, end: int):
+        self._store = store
+        self.key = entry['key']
+        self.size = entry['size']
+        self.complete = entry['complete']
+        self.start = start
+        self.end = end
+        self.path = store._data_path(entry)
+    
+    def open(self):
+        """Open the file positioned at `start`."""
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            # Promoted from .part to .audio since the lookup
+            self.path = self._store.directory / f"{self.key}.audio"
+            f = open(self.path, 'rb')
+        f.seek(self.start)
+        return f
+    
+    def __call__(self) -> Iterator[bytes]:
+        with self.open() as f:
+            remaining = self.end - self.start + 1
+            while remaining > 0:
+                chunk = f.read(min(65536, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+
+class AudioCacheWriter:
+    """Writes one contiguous run of upstream bytes into a sparse cache file."""
+    
+    def __init__(self, store: 'AudioCache', entry: Dict[str, Any], offset: int,
+                 buffer_size: int = 256 * 1024):
+        self._store = store
+        self._entry = entry
+        self.offset = offset
+        self._buffer = bytearray()
+        self._buffer_size = buffer_size
+        self._fd = os.open(store.directory / f"{entry['key']}.part", os.O_WRONLY | os.O_CREAT, 0o644)
+    
+    def write(self, chunk: bytes):
+        self._buffer += chunk
+        if len(self._buffer) >= self._buffer_size:
+            self._flush()
+    
+    def close(self):
+        """Write out buffered bytes and persist the extent map."""
+        if self._fd is None:
+            return
+        try:
+            self._flush()
+        finally:
+            os.close(self._fd)
+            self._fd = None
+        self._store.flush(self._entry)
+    
+    def _flush(self):
+        if not self._buffer:
+            return
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        # Bytes must be on disk before their extent is recorded
+        os.pwrite(self._fd, data, self.offset)
+        self._store._record(self._entry, self.offset, len(data))
+        self.offset += len(data)
+
+
+class AudioCacheSpool:
+    """Collects a file of unknown length (e.g. a transcode) and adds it to the cache once whole."""
+    
+    def __init__(self, store: 'AudioCache', video_id: str, content_type: str, fmt: str):
+        self._store = store
+        self.video_id = video_id
+        self.content_type = content_type
+        self.fmt = fmt
+        self.size = 0
+        self.path = store.directory / f".{store.make_key(video_id, fmt)}.{uuid.uuid4().hex}.spool"
+        self._file = open(self.path, 'wb')
+    
+    def write(self, chunk: bytes):
+        if self._file is None:
+            return
+        self.size += len(chunk)
+        if self.size > self._store.max_file_bytes:
+            self.abort()
+            return
+        self._file.write(chunk)
+    
+    def commit(self):
+        """Add the collected file to the cache as a complete entry."""
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        self._store._commit_spool(self)
+    
+    def abort(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        self.path.unlink(missing_ok=True)
+
+
+class AudioCache:
+    """Local sparse audio store keyed by video ID and format, evicted LRU by cached bytes."""
+    
+    _instance = None
+    
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._lock = threading.RLock()
+            cls._instance._index = None
+            cls._instance._total_bytes = 0
+            cls._instance.directory = None
+        return cls._instance
+    
+    def _configure(self):
+        """Read settings and index existing files on first use (needs app context)."""
+        if self._index is not None:
+            return
+        with self._lock:
+            if self._index is not None:
+                return
+            self.directory = Path(current_app.config.get(
+                'AUDIO_CACHE_DIR', current_app.config['BASE_DIR'] / 'cache' / 'audio'
+            ))
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self.max_bytes = current_app.config.get('AUDIO_CACHE_MAX_BYTES', 2 * 1024 ** 3)
+            self.max_file_bytes = current_app.config.get('AUDIO_CACHE_MAX_FILE_BYTES', 50 * 1024 ** 2)
+            self.meta_flush_bytes = current_app.config.get('AUDIO_CACHE_META_FLUSH_BYTES', 1024 ** 2)
+            self.min_cached_run = current_app.config.get('AUDIO_CACHE_MIN_CACHED_RUN', 64 * 1024)
+            
+            for tmp_path in [*self.directory.glob('.*.tmp'), *self.directory.glob('.*.spool')]:
+                tmp_path.unlink(missing_ok=True)
+            
+            # Rebuild the LRU index from disk, oldest access first
+            entries = []
+            for meta_path in self.directory.glob('*.json'):
+                entry = self._read_entry(meta_path.stem)
+                if entry is None:
+                    meta_path.unlink(missing_ok=True)
+                    continue
+                entries.append((self._data_path(entry).stat().st_mtime, entry))
+            
+            index = OrderedDict()
+            for _, entry in sorted(entries, key=lambda e: e[0]):
+                index[entry['key']] = entry
+                self._total_bytes += entry['cached_bytes']
+            self._index = index
+    
+    @staticmethod
+    def make_key(video_id: str, fmt: str = 'default') -> str:
+        return f"{video_id}.{fmt}"
+    
+    def enabled(self) -> bool:
+        return current_app.config.get('AUDIO_CACHE_ENABLED', True)
+    
+    def lookup(self, video_id: str, fmt: str = 'default') -> Optional[Dict[str, Any]]:
+        """Get the complete or partial cache entry for a video."""
+        self._configure()
+        key = self.make_key(video_id, fmt)
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is not None and not self._data_path(entry).exists():
+                # Evicted by another worker sharing the directory
+                self._forget(key)
+                entry = None
+            elif entry is not None:
+                self._index.move_to_end(key)
+        
+        if entry is None:
+            # Possibly written by another worker sharing the directory
+            entry = self._adopt(key)
+        if entry is None:
+            metrics.incr('audio_cache.miss')
+            return None
+        
+        metrics.incr('audio_cache.hit' if entry['complete'] else 'audio_cache.partial')
+        try:
+            os.utime(self._data_path(entry))
+        except OSError:
+            pass
+        return entry
+    
+    def begin(self, video_id: str, content_type: str, size: int,
+              fmt: str = 'default') -> Optional[Dict[str, Any]]:
+        """Get or create the sparse entry for a file of known size, if it fits the budget."""
+        self._configure()
+        if size <= 0 or size > self.max_file_bytes:
+            return None
+        key = self.make_key(video_id, fmt)
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is not None and entry['size'] == size:
+                return entry
+            if entry is not None:
+                # Upstream file changed; start over
+                self._drop(key)
+            entry = {
+                'key': key,
+                'content_type': content_type,
+                'size': size,
+                'complete': False,
+                'extents': ExtentMap(),
+                'cached_bytes': 0,
+                'unflushed': 0,
+                'created_at': time.time(),
+            }
+            # Full-length sparse file: holes take no disk space until written
+            with open(self.directory / f"{key}.part", 'ab') as f:
+                f.truncate(size)
+            self._index[key] = entry
+        self._write_meta(entry)
+        return entry
+    
+    def covers(self, entry: Dict[str, Any], start: int, end: int) -> bool:
+        """Whether the inclusive range [start, end] is on disk."""
+        with self._lock:
+            return entry['complete'] or entry['extents'].covers(start, end + 1)
+    
+    def plan(self, entry: Dict[str, Any], start: int, end: int) -> List[Tuple[int, int, bool]]:
+        """
+        Split the inclusive range [start, end] into cached and missing runs.
+        
+        Cached runs shorter than AUDIO_CACHE_MIN_CACHED_RUN between two holes
+        are folded into one upstream fetch rather than splitting it.
+        """
+        with self._lock:
+            if entry['complete']:
+                return [(start, end, True)]
+            runs = entry['extents'].plan(start, end + 1)
+        
+        merged = []
+        for i, (run_start, run_end, cached) in enumerate(runs):
+            between_holes = 0 < i < len(runs) - 1
+            if cached and between_holes and run_end - run_start < self.min_cached_run:
+                cached = False
+            if merged and not cached and not merged[-1][2]:
+                merged[-1] = (merged[-1][0], run_end, False)
+            else:
+                merged.append((run_start, run_end, cached))
+        return [(run_start, run_end - 1, cached) for run_start, run_end, cached in merged]
+    
+    def read(self, entry: Dict[str, Any], start: int, end: int) -> Iterator[bytes]:
+        """Yield cached bytes [start, end] (inclusive)."""
+        yield from CachedFile(self, entry, start, end)()
+    
+    def writer(self, entry: Dict[str, Any], offset: int) -> AudioCacheWriter:
+        """Start writing upstream bytes into an entry at an offset."""
+        return AudioCacheWriter(self, entry, offset)
+    
+    def spool(self, video_id: str, content_type: str, fmt: str) -> AudioCacheSpool:
+        """Start collecting a file whose size is only known at the end."""
+        self._configure()
+        return AudioCacheSpool(self, video_id, content_type, fmt)
+    
+    def flush(self, entry: Dict[str, Any]):
+        """Persist an entry's extent map if it has unsaved progress."""
+        with self._lock:
+            if entry['complete'] or not entry['unflushed'] or self._index.get(entry['key']) is not entry:
+                return
+            entry['unflushed'] = 0
+        self._write_meta(entry)
+    
+    def serve(self, entry: Dict[str, Any], range_header: Optional[str] = None):
+        """Build (CachedFile, headers, status) for a request the cache fully covers."""
+        size = entry['size']
+        headers = {
+            'Content-Type': entry['content_type'],
+            'Accept-Ranges': 'bytes',
+            'X-Cache': 'HIT',
+        }
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            headers['Content-Range'] = f"bytes */{size}"
+            return None, headers, 416
+        
+        status = 200
+        start, end = 0, size - 1
+        if byte_range is not None:
+            start, end = byte_range
+            status = 206
+            headers['Content-Range'] = f"bytes {start}-{end}/{size}"
+        headers['Content-Length'] = str(end - start + 1)
+        
+        return CachedFile(self, entry, start, end), headers, status
+    
+    def stats(self) -> Dict[str, Any]:
+        self._configure()
+        with self._lock:
+            return {
+                'files': len(self._index),
+                'complete': sum(1 for entry in self._index.values() if entry['complete']),
+                'bytes': self._total_bytes,
+                'max_bytes': self.max_bytes,
+            }
+    
+    def _data_path(self, entry: Dict[str, Any]) -> Path:
+        return self.directory / f"{entry['key']}.{'audio' if entry['complete'] else 'part'}"
+    
+    def _record(self, entry: Dict[str, Any], offset: int, length: int):
+        """Account for bytes written into an entry; promote it once full."""
+        with self._lock:
+            if entry['complete'] or self._index.get(entry['key']) is not entry:
+                # Promoted or evicted while this write was in flight
+                return
+            before = entry['extents'].total()
+            entry['extents'].add(offset, min(offset + length, entry['size']))
+            added = entry['extents'].total() - before
+            entry['cached_bytes'] += added
+            entry['unflushed'] += added
+            self._total_bytes += added
+            complete = entry['extents'].covers(0, entry['size'])
+            flush = not complete and entry['unflushed'] >= self.meta_flush_bytes
+            if flush:
+                entry['unflushed'] = 0
+        metrics.incr('audio_cache.stored_bytes', added)
+        
+        if complete:
+            self._promote(entry)
+        elif flush:
+            self._write_meta(entry)
+        self._evict()
+    
+    def _commit_spool(self, spool: AudioCacheSpool):
+        """Move a finished spool into place as a fully covered entry."""
+        entry = self.begin(spool.video_id, spool.content_type, spool.size, spool.fmt)
+        if entry is None or entry['complete']:
+            spool.path.unlink(missing_ok=True)
+            return
+        try:
+            os.replace(spool.path, self.directory / f"{entry['key']}.part")
+        except FileNotFoundError:
+            return
+        self._record(entry, 0, spool.size)
+    
+    def _promote(self, entry: Dict[str, Any]):
+        """Rename a fully filled sparse file into place as a complete file."""
+        key = entry['key']
+        with self._lock:
+            try:
+                os.replace(self.directory / f"{key}.part", self.directory / f"{key}.audio")
+            except FileNotFoundError:
+                return
+            entry['complete'] = True
+            entry['unflushed'] = 0
+        self._write_meta(entry)
+        metrics.incr('audio_cache.stored')
+    
+    def _write_meta(self, entry: Dict[str, Any]):
+        """Atomically persist an entry's metadata and extent map."""
+        with self._lock:
+            meta = {
+                'key': entry['key'],
+                'content_type': entry['content_type'],
+                'size': entry['size'],
+                'complete': entry['complete'],
+                'extents': [] if entry['complete'] else entry['extents'].to_list(),
+                'created_at': entry['created_at'],
+            }
+        try:
+            if not meta['complete']:
+                # Recorded extents must survive a crash, so sync their bytes first
+                fd = os.open(self.directory / f"{entry['key']}.part", os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            meta_tmp = self.directory / f".{entry['key']}.{uuid.uuid4().hex}.tmp"
+            with open(meta_tmp, 'w', encoding='utf-8') as f:
+                json.dump(meta, f)
+            os.replace(meta_tmp, self.directory / f"{entry['key']}.json")
+        except FileNotFoundError:
+            # Evicted meanwhile
+            pass
+    
+    def _read_entry(self, key: str) -> Optional[Dict[str, Any]]:
+        """Load an entry from its metadata file, if its data file exists."""
+        try:
+            with open(self.directory / f"{key}.json", 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        complete = meta.get('complete', True)
+        extents = ExtentMap([] if complete else meta.get('extents', []))
+        entry = {
+            'key': key,
+            'content_type': meta['content_type'],
+            'size': meta['size'],
+            'complete': complete,
+            'extents': extents,
+            'cached_bytes': meta['size'] if complete else extents.total(),
+            'unflushed': 0,
+            'created_at': meta.get('created_at', 0),
+        }
+        if not self._data_path(entry).exists():
+            return None
+        return entry
+    
+    def _adopt(self, key: str) -> Optional[Dict[str, Any]]:
+        """Index an entry that appeared on disk after startup."""
+        entry = self._read_entry(key)
+        if entry is None:
+            return None
+        with self._lock:
+            if key in self._index:
+                return self._index[key]
+            self._index[key] = entry
+            self._total_bytes += entry['cached_bytes']
+        return entry
+    
+    def _evict(self):
+        """Delete least recently used files until under the byte budget."""
+        while True:
+            with self._lock:
+                if self._total_bytes <= self.max_bytes or len(self._index) <= 1:
+                    return
+                self._drop(next(iter(self._index)))
+            metrics.incr('audio_cache.evicted')
+    
+    def _drop(self, key: str):
+        with self._lock:
+            self._forget(key)
+            for suffix in ('json', 'audio', 'part'):
+                (self.directory / f"{key}.{suffix}").unlink(missing_ok=True)
+    
+    def _forget(self, key: str):
+        with self._lock:
+            entry = self._index.pop(key, None)
+            if entry is not None:
+                self._total_bytes -= entry['cached_bytes']
+
+
+# Singleton instance
+audio_cache = AudioCache()
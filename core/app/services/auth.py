@@ -2,6 +2,7 @@
 Authentication service - Zero-Gate minimal version.
 Supports ALLOW_ANONYMOUS_ACCESS for frictionless local development.
 """
+import hmac
 from functools import wraps
 from flask import request, current_app, g
 
@@ -35,8 +36,16 @@ def require_api_key(f):
     return decorated
 
 def require_master_key(f):
+    """Decorator to require the X-Master-Key header to match MASTER_API_KEY (never bypassed)."""
     @wraps(f)
     def decorated(*args, **kwargs):
+        from app.middleware import error_response
+        master_key = request.headers.get('X-Master-Key')
+        if not master_key:
+            return error_response('MASTER_KEY_REQUIRED', 'Master key required', 401)
+        expected = current_app.config.get('MASTER_API_KEY') or ''
+        if not expected or not hmac.compare_digest(master_key.encode(), expected.encode()):
+            return error_response('INVALID_MASTER_KEY', 'Invalid master key', 403)
         return f(*args, **kwargs)
     return decorated
 
@@ -0,0 +1,219 @@
+"""
+Egress bandwidth scheduling for audio streams.
+
+Every stream is paced by token buckets: its own, one shared by the streams
+of its API key, and a global one for the whole process. Playback streams
+get a small initial burst and then the real-time rate of the audio plus
+headroom, which is all a player needs. Bulk downloads are not paced per
+connection, but they only take global bandwidth above a reserve kept for
+playback, so they fill the idle uplink without starving listeners.
+"""
+import asyncio
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from flask import current_app
+
+from .metrics import metrics
+
+PLAYBACK = 'playback'
+BULK = 'bulk'
+
+# Longest single sleep while a bulk stream waits for bandwidth above the reserve
+MAX_BULK_WAIT = 0.25
+
+
+class TokenBucket:
+    """Byte-rate bucket; takes may overdraw it and are then paid back in time."""
+    
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+    
+    def take(self, n: int) -> float:
+        """Take `n` bytes now; seconds to wait before sending them."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens -= n
+            return max(0.0, -self._tokens / self.rate)
+    
+    def take_above(self, n: int, reserve: float) -> float:
+        """Take `n` bytes only if `reserve` tokens stay; else seconds until they would (nothing taken)."""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens - n >= reserve:
+                self._tokens -= n
+                return 0.0
+            return (reserve + n - self._tokens) / self.rate
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            self._refill(time.monotonic())
+            return {'rate_kbps': round(self.rate * 8 / 1000), 'tokens': int(self._tokens)}
+
+
+class StreamShaper:
+    """Paces the chunks of one stream through its buckets."""
+    
+    def __init__(self, scheduler: 'BandwidthScheduler', kind: str, key: Optional[str],
+                 own: Optional[TokenBucket], shared: Optional[TokenBucket]):
+        self._scheduler = scheduler
+        self.kind = kind
+        self.key = key
+        self._own = own
+        self._shared = shared
+        self._closed = False
+    
+    @property
+    def limited(self) -> bool:
+        """Whether any bucket applies, i.e. the body has to be sent through pace()."""
+        return bool(self._own or self._shared or self._scheduler._global)
+    
+    @property
+    def rate(self) -> Optional[float]:
+        """This connection's own limit in bytes per second, if it has one."""
+        return self._own.rate if self._own else None
+    
+    def _waits(self, n: int):
+        """Yield the sleeps needed before `n` more bytes may be sent."""
+        delay = max(bucket.take(n) if bucket else 0.0 for bucket in (self._own, self._shared))
+        bucket = self._scheduler._global
+        if bucket is not None and self.kind == PLAYBACK:
+            delay = max(delay, bucket.take(n))
+        if delay:
+            yield delay
+        if bucket is None or self.kind != BULK:
+            return
+        # Bulk bytes wait until the global bucket has them to spare above the playback reserve
+        reserve = bucket.burst * self._scheduler.bulk_reserve
+        while True:
+            delay = bucket.take_above(n, reserve)
+            if not delay:
+                return
+            yield min(delay, MAX_BULK_WAIT)
+    
+    def pace(self, n: int):
+        """Block until `n` more bytes may be sent."""
+        started = time.monotonic()
+        for delay in self._waits(n):
+            time.sleep(delay)
+        self._account(n, time.monotonic() - started)
+    
+    async def apace(self, n: int):
+        """Event-loop version of pace()."""
+        started = time.monotonic()
+        for delay in self._waits(n):
+            await asyncio.sleep(delay)
+        self._account(n, time.monotonic() - started)
+    
+    def _account(self, n: int, waited: float):
+        metrics.incr(f'bandwidth.{self.kind}.bytes', n)
+        if waited >= 0.001:
+            metrics.incr(f'bandwidth.{self.kind}.throttled_ms', int(waited * 1000))
+    
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._scheduler._release(self)
+
+
+class BandwidthScheduler:
+    """Hands out StreamShapers and owns the per-key and global buckets."""
+    
+    _instance = None
+    
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._lock = threading.Lock()
+            cls._instance._configured = False
+            cls._instance._global = None
+            cls._instance._keys = {}  # API key -> [bucket, open streams]
+            cls._instance._streams = {PLAYBACK: 0, BULK: 0}
+        return cls._instance
+    
+    def _configure(self):
+        """Read the limits on first use (needs app context)."""
+        if self._configured:
+            return
+        with self._lock:
+            if self._configured:
+                return
+            config = current_app.config
+            self.enabled = config.get('BANDWIDTH_ENABLED', False)
+            self.playback_kbps = config.get('BANDWIDTH_PLAYBACK_KBPS', 160)
+            self.playback_headroom = config.get('BANDWIDTH_PLAYBACK_HEADROOM', 1.5)
+            self.playback_burst_seconds = config.get('BANDWIDTH_PLAYBACK_BURST_SECONDS', 10)
+            self.bulk_kbps = config.get('BANDWIDTH_BULK_KBPS', 0)
+            self.bulk_reserve = config.get('BANDWIDTH_BULK_RESERVE', 0.25)
+            self.key_kbps = config.get('BANDWIDTH_PER_KEY_KBPS', 0)
+            self.burst_seconds = config.get('BANDWIDTH_BURST_SECONDS', 1)
+            global_kbps = config.get('BANDWIDTH_GLOBAL_KBPS', 0)
+            if global_kbps:
+                self._global = self._bucket(global_kbps, self.burst_seconds)
+            self._configured = True
+    
+    @staticmethod
+    def _bucket(kbps: float, burst_seconds: float) -> TokenBucket:
+        rate = kbps * 1000 / 8
+        return TokenBucket(rate, rate * burst_seconds)
+    
+    def open(self, key: Optional[str], bulk: bool = False, kbps: Optional[int] = None) -> Optional[StreamShaper]:
+        """
+        Start pacing a stream for an API key; None when scheduling is off.
+        
+        `kbps` is the audio bitrate of a playback stream, when known.
+        """
+        self._configure()
+        if not self.enabled:
+            return None
+        
+        if bulk:
+            own = self._bucket(self.bulk_kbps, self.burst_seconds) if self.bulk_kbps else None
+        else:
+            kbps = kbps or self.playback_kbps
+            # Burst of BANDWIDTH_PLAYBACK_BURST_SECONDS of audio, then real time plus headroom
+            own = self._bucket(kbps * self.playback_headroom, self.playback_burst_seconds / self.playback_headroom)
+        
+        kind = BULK if bulk else PLAYBACK
+        with self._lock:
+            self._streams[kind] += 1
+            shared = None
+            if key and self.key_kbps:
+                slot = self._keys.get(key)
+                if slot is None:
+                    slot = self._keys[key] = [self._bucket(self.key_kbps, self.burst_seconds), 0]
+                slot[1] += 1
+                shared = slot[0]
+        return StreamShaper(self, kind, key, own, shared)
+    
+    def _release(self, shaper: StreamShaper):
+        with self._lock:
+            self._streams[shaper.kind] -= 1
+            slot = self._keys.get(shaper.key)
+            if slot is not None:
+                slot[1] -= 1
+                if slot[1] <= 0:
+                    del self._keys[shaper.key]
+    
+    def stats(self) -> Dict[str, Any]:
+        self._configure()
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'streams': dict(self._streams),
+                'keys': len(self._keys),
+                'global': self._global.stats() if self._global else None,
+            }
+
+
+# Singleton instance
+bandwidth = BandwidthScheduler()
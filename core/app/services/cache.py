@@ -1,21 +1,342 @@
 """
 Caching service with Redis and in-memory fallback.
 """
+import hashlib
+import heapq
 import json
+import threading
 import time
-from typing import Any, Optional
+import unicodedata
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Union
 from functools import wraps
 
 from flask import current_app
 
+from .codec import CacheCodec
+from .metrics import metrics
+
+
+MAX_KEY_LENGTH = 200
+
+
+def normalize_query(query: str) -> str:
+    """Normalize free text for cache keys (Unicode form, case, whitespace)."""
+    return ' '.join(unicodedata.normalize('NFKC', query).casefold().split())
+
+
+def make_key(prefix: str, *parts: Any) -> str:
+    """Build a stable cache key, hashing the parts if the key would be too long."""
+    body = ':'.join(str(part) for part in parts)
+    key = f"{prefix}:{body}" if parts else prefix
+    if len(key) > MAX_KEY_LENGTH:
+        key = f"{prefix}:#{hashlib.sha1(body.encode('utf-8')).hexdigest()}"
+    return key
+
+
+def _estimate_size(value: Any) -> int:
+    """Approximate the memory footprint of a cached value in bytes."""
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    if isinstance(value, tuple):
+        return sum(_estimate_size(item) for item in value)
+    try:
+        return len(json.dumps(value, separators=(',', ':'), default=str))
+    except (TypeError, ValueError):
+        return 1024
+
+
+def _prefix_of(key: str) -> str:
+    """The namespace of a cache key, e.g. 'search' for 'search:drake'."""
+    return key.split(':', 1)[0]
+
+
+class CacheStats:
+    """Per-tier, per-key-prefix cache counters, cheap enough to leave on."""
+    
+    # Row layout: hits, misses, sets, evictions, bytes, get_count, get_seconds, set_count, set_seconds
+    _ROW_SIZE = 9
+    
+    def __init__(self):
+        self._rows = {}  # (tier, prefix) -> list of counters
+        self._lock = threading.Lock()
+    
+    def _row(self, tier: str, key: str) -> list:
+        row_key = (tier, _prefix_of(key))
+        row = self._rows.get(row_key)
+        if row is None:
+            row = self._rows[row_key] = [0] * self._ROW_SIZE
+        return row
+    
+    def record_get(self, tier: str, key: str, hit: bool, seconds: float):
+        with self._lock:
+            row = self._row(tier, key)
+            row[0 if hit else 1] += 1
+            row[5] += 1
+            row[6] += seconds
+    
+    def record_set(self, tier: str, key: str, size: int, seconds: float):
+        with self._lock:
+            row = self._row(tier, key)
+            row[2] += 1
+            row[4] += size
+            row[7] += 1
+            row[8] += seconds
+    
+    def record_eviction(self, tier: str, key: str):
+        with self._lock:
+            self._row(tier, key)[3] += 1
+    
+    def snapshot(self) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        """Counters grouped by tier, then key prefix."""
+        with self._lock:
+            rows = {row_key: list(row) for row_key, row in self._rows.items()}
+        
+        result = {}
+        for (tier, prefix), (hits, misses, sets, evictions, size, gets, get_s, set_count, set_s) in rows.items():
+            result.setdefault(tier, {})[prefix] = {
+                'hits': hits,
+                'misses': misses,
+                'hit_ratio': round(hits / (hits + misses), 4) if hits + misses else None,
+                'sets': sets,
+                'evictions': evictions,
+                'bytes': size,
+                'avg_get_ms': round(get_s / gets * 1000, 4) if gets else None,
+                'avg_set_ms': round(set_s / set_count * 1000, 4) if set_count else None,
+            }
+        return result
+    
+    def reset(self):
+        with self._lock:
+            self._rows.clear()
+
+
+class MemoryCache:
+    """Thread-safe in-process LRU cache bounded by entry count and bytes."""
+    
+    def __init__(self, max_entries: int = 10000, max_bytes: int = 64 * 1024 * 1024,
+                 name: str = 'memory', stats: Optional[CacheStats] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.name = name
+        self._stats = stats
+        self._entries = OrderedDict()  # key -> (value, expires_at, size)
+        self._expiry_heap = []  # (expires_at, key), lazily invalidated
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    def get(self, key: str) -> Optional[Any]:
+        """Get a value, refreshing its LRU position."""
+        started = time.perf_counter()
+        value = self._get(key)
+        if self._stats is not None:
+            self._stats.record_get(self.name, key, value is not None, time.perf_counter() - started)
+        return value
+    
+    def _get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[1] <= now:
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+    
+    def set(self, key: str, value: Any, ttl: int = 300) -> bool:
+        """Store a value, evicting least recently used entries over budget."""
+        started = time.perf_counter()
+        size = _estimate_size(value)
+        if size > self.max_bytes:
+            # Too big to keep, but the previous value must not outlive the write
+            self.delete(key)
+            return False
+        
+        now = time.time()
+        expires_at = now + ttl
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (value, expires_at, size)
+            self._bytes += size
+            heapq.heappush(self._expiry_heap, (expires_at, key))
+            
+            self._sweep(now)
+            while self._entries and (len(self._entries) > self.max_entries
+                                     or self._bytes > self.max_bytes):
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+                if self._stats is not None:
+                    self._stats.record_eviction(self.name, oldest)
+            
+            # Overwritten keys leave stale heap nodes behind; compact occasionally
+            if len(self._expiry_heap) > 2 * len(self._entries) + 64:
+                self._expiry_heap = [(exp, k) for k, (_, exp, _) in self._entries.items()]
+                heapq.heapify(self._expiry_heap)
+        
+        if self._stats is not None:
+            self._stats.record_set(self.name, key, size, time.perf_counter() - started)
+        return True
+    
+    def delete(self, key: str) -> bool:
+        """Remove a key if present."""
+        with self._lock:
+            return self._remove(key)
+    
+    def clear(self):
+        """Drop every entry."""
+        with self._lock:
+            self._entries.clear()
+            self._expiry_heap = []
+            self._bytes = 0
+    
+    def reset_stats(self):
+        """Zero the hit/miss/eviction counters."""
+        with self._lock:
+            self.hits = self.misses = self.evictions = self.expirations = 0
+    
+    def stats(self) -> Dict[str, int]:
+        """Snapshot of size and hit/miss/eviction counters."""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def _remove(self, key: str) -> bool:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self._bytes -= entry[2]
+        return True
+    
+    def _sweep(self, now: float):
+        """Pop expired entries off the heap (amortized O(log n) per entry)."""
+        heap = self._expiry_heap
+        while heap and heap[0][0] <= now:
+            expires_at, key = heapq.heappop(heap)
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] == expires_at:
+                self._remove(key)
+                self.expirations += 1
+
+
+class SingleFlight:
+    """Collapse concurrent calls for the same key into a single execution."""
+    
+    def __init__(self):
+        self._calls = {}  # key -> Future of the in-flight call
+        self._lock = threading.Lock()
+    
+    def do(self, key: str, fn: Callable[[], Any], timeout: Optional[float] = None) -> Any:
+        """
+        Run `fn` unless a call for `key` is already in flight, in which case
+        wait up to `timeout` seconds for its result (raises TimeoutError).
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+        
+        if not leader:
+            metrics.incr('singleflight.shared')
+            return future.result(timeout=timeout)
+        
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+    
+    def in_flight(self) -> int:
+        """Number of keys currently being computed."""
+        with self._lock:
+            return len(self._calls)
+
+
+# Shared by every service that fronts an expensive upstream call
+singleflight = SingleFlight()
+
+
+class LeaseLoadFailed(Exception):
+    """The node holding a key's lease failed to load it; carries that node's error message."""
+
+
+class RedisLease:
+    """Redis-backed lease (SET NX PX) that only its owner can release."""
+    
+    _RELEASE_SCRIPT = (
+        "if redis.call('get', KEYS[1]) == ARGV[1] then "
+        "return redis.call('del', KEYS[1]) else return 0 end"
+    )
+    
+    def __init__(self, redis_client, name: str, ttl: float):
+        self._redis = redis_client
+        self.name = name
+        self.ttl = ttl
+        self.token = uuid.uuid4().hex
+    
+    def acquire(self) -> bool:
+        """Try to take the lease; expires after `ttl` seconds if never released."""
+        return bool(self._redis.set(self.name, self.token, nx=True, px=int(self.ttl * 1000)))
+    
+    def release(self) -> bool:
+        """Release the lease if we still own it."""
+        try:
+            return bool(self._redis.eval(self._RELEASE_SCRIPT, 1, self.name, self.token))
+        except Exception:
+            return False
+
 
 class CacheService:
     """Caching service with Redis primary and in-memory fallback."""
     
     _instance = None
     _redis_client = None
-    _memory_cache = {}
-    _memory_expiry = {}
+    _redis_pool = None
+    _redis_lock = threading.Lock()
+    _redis_retry_at = 0.0
+    _redis_backoff = 0
+    _codec = None
+    _stats = CacheStats()
+    _memory_cache = None
+    _memory_lock = threading.Lock()
+    _l1_cache = None
+    _l1_subscriber = None
+    _origin = uuid.uuid4().hex[:12]  # Identifies this process on the invalidation channel
+    _refresh_executor = None
+    _refreshing = set()
+    _refresh_lock = threading.Lock()
     
     def __new__(cls):
         if cls._instance is None:
@@ -23,88 +344,482 @@ class CacheService:
         return cls._instance
     
     def _get_redis(self):
-        """Get Redis client, initializing if needed."""
-        if self._redis_client is None:
-            redis_url = current_app.config.get('REDIS_URL')
-            if redis_url:
-                try:
-                    import redis
-                    self._redis_client = redis.from_url(redis_url)
-                    # Test connection
-                    self._redis_client.ping()
-                    current_app.logger.info("✓ Connected to Redis")
-                except Exception as e:
-                    current_app.logger.warning(f"Redis unavailable, using memory cache: {e}")
-                    self._redis_client = False  # Mark as unavailable
-        return self._redis_client if self._redis_client else None
+        """Get a pooled Redis client, reconnecting with backoff after failures."""
+        if self._redis_client:
+            return self._redis_client
+        
+        redis_url = current_app.config.get('REDIS_URL')
+        if not redis_url or time.time() < self._redis_retry_at:
+            return None
+        
+        with self._redis_lock:
+            if self._redis_client or time.time() < self._redis_retry_at:
+                return self._redis_client or None
+            try:
+                import redis
+                if self._redis_pool is None:
+                    CacheService._redis_pool = redis.ConnectionPool.from_url(
+                        redis_url,
+                        max_connections=current_app.config.get('REDIS_MAX_CONNECTIONS', 50),
+                        socket_timeout=current_app.config.get('REDIS_SOCKET_TIMEOUT', 1.0),
+                        socket_connect_timeout=current_app.config.get('REDIS_CONNECT_TIMEOUT', 1.0),
+                        health_check_interval=current_app.config.get('REDIS_HEALTH_CHECK_INTERVAL', 30),
+                    )
+                client = redis.Redis(connection_pool=self._redis_pool)
+                # Test connection
+                client.ping()
+                CacheService._redis_client = client
+                CacheService._redis_backoff = 0
+                current_app.logger.info("✓ Connected to Redis")
+            except Exception as e:
+                self._redis_unavailable(e)
+        return self._redis_client or None
+    
+    def _redis_unavailable(self, error: Exception):
+        """Fall back to memory and schedule a reconnect with exponential backoff."""
+        max_backoff = current_app.config.get('REDIS_RETRY_MAX_BACKOFF', 30)
+        CacheService._redis_client = None
+        if self._l1_subscriber:
+            try:
+                self._l1_subscriber.stop()
+            except Exception:
+                pass
+        CacheService._l1_subscriber = None
+        CacheService._redis_backoff = min(max(self._redis_backoff * 2, 1), max_backoff)
+        CacheService._redis_retry_at = time.time() + self._redis_backoff
+        current_app.logger.warning(
+            f"Redis unavailable, using memory cache (retry in {self._redis_backoff}s): {error}"
+        )
+    
+    def _handle_redis_error(self, operation: str, error: Exception):
+        """Log a Redis error, dropping the client if the connection itself failed."""
+        current_app.logger.error(f"Redis {operation} error: {error}")
+        try:
+            import redis
+            if isinstance(error, (redis.ConnectionError, redis.TimeoutError)):
+                self._redis_unavailable(error)
+        except ImportError:
+            pass
+    
+    def _get_codec(self) -> CacheCodec:
+        """Get the codec used for values stored in Redis."""
+        if self._codec is None:
+            CacheService._codec = CacheCodec(
+                serializer=current_app.config.get('CACHE_SERIALIZER', 'json'),
+                compression=current_app.config.get('CACHE_COMPRESSION', 'zlib'),
+                threshold=current_app.config.get('CACHE_COMPRESSION_THRESHOLD', 1024),
+            )
+        return self._codec
+    
+    def _get_memory(self) -> MemoryCache:
+        """Get the bounded in-memory fallback cache, sized from config."""
+        if self._memory_cache is None:
+            with self._memory_lock:
+                if self._memory_cache is None:
+                    CacheService._memory_cache = MemoryCache(
+                        max_entries=current_app.config.get('CACHE_MEMORY_MAX_ENTRIES', 10000),
+                        max_bytes=current_app.config.get('CACHE_MEMORY_MAX_BYTES', 64 * 1024 * 1024),
+                        name='memory', stats=self._stats,
+                    )
+        return self._memory_cache
+    
+    def _get_l1(self) -> Optional[MemoryCache]:
+        """Get the short-lived per-process cache that sits in front of Redis."""
+        if not current_app.config.get('CACHE_L1_ENABLED', True):
+            return None
+        if self._l1_cache is None:
+            with self._memory_lock:
+                if self._l1_cache is None:
+                    CacheService._l1_cache = MemoryCache(
+                        max_entries=current_app.config.get('CACHE_L1_MAX_ENTRIES', 2000),
+                        max_bytes=current_app.config.get('CACHE_L1_MAX_BYTES', 16 * 1024 * 1024),
+                        name='l1', stats=self._stats,
+                    )
+        return self._l1_cache
+    
+    def _start_invalidation_listener(self, redis_client):
+        """Subscribe to L1 invalidations published by other workers."""
+        if self._l1_subscriber is not None or not current_app.config.get('CACHE_L1_PUBSUB', True):
+            return
+        channel = current_app.config.get('CACHE_L1_CHANNEL', 'cache:invalidate')
+        l1 = self._get_l1()
+        origin = self._origin
+        
+        def on_message(message):
+            sender, _, key = message['data'].decode('utf-8').partition('|')
+            if sender != origin:
+                l1.delete(key)
+        
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{channel: on_message})
+            CacheService._l1_subscriber = pubsub.run_in_thread(sleep_time=1, daemon=True)
+        except Exception as e:
+            current_app.logger.warning(f"L1 invalidation listener unavailable: {e}")
+            CacheService._l1_subscriber = False
+    
+    def _publish_invalidation(self, pipe, key: str):
+        """Queue an L1 invalidation for other workers onto a Redis pipeline."""
+        if current_app.config.get('CACHE_L1_PUBSUB', True):
+            channel = current_app.config.get('CACHE_L1_CHANNEL', 'cache:invalidate')
+            pipe.publish(channel, f"{self._origin}|{key}")
     
     def get(self, key: str) -> Optional[Any]:
         """Get a value from cache."""
         redis_client = self._get_redis()
         
         if redis_client:
+            l1 = self._get_l1()
+            if l1 is not None:
+                value = l1.get(key)
+                if value is not None:
+                    return value
+                self._start_invalidation_listener(redis_client)
+            started = time.perf_counter()
             try:
-                value = redis_client.get(key)
+                if l1 is None:
+                    value = redis_client.get(key)
+                    pttl = None
+                else:
+                    pipe = redis_client.pipeline(transaction=False)
+                    pipe.get(key)
+                    pipe.pttl(key)
+                    value, pttl = pipe.execute()
+                self._stats.record_get('redis', key, bool(value), time.perf_counter() - started)
                 if value:
-                    return json.loads(value)
+                    value = self._get_codec().decode(value)
+                    if l1 is not None:
+                        self._promote(l1, key, value, pttl)
+                    return value
             except Exception as e:
-                current_app.logger.error(f"Redis get error: {e}")
+                self._handle_redis_error('get', e)
         
         # Fallback to memory cache
-        if key in self._memory_cache:
-            if self._memory_expiry.get(key, 0) > time.time():
-                return self._memory_cache[key]
-            else:
-                # Expired
-                del self._memory_cache[key]
-                del self._memory_expiry[key]
-        
-        return None
+        return self._get_memory().get(key)
     
     def set(self, key: str, value: Any, ttl: int = 300) -> bool:
         """Set a value in cache with TTL (seconds)."""
         redis_client = self._get_redis()
         
         if redis_client:
+            started = time.perf_counter()
             try:
-                redis_client.setex(key, ttl, json.dumps(value))
+                encoded = self._get_codec().encode(value)
+                pipe = redis_client.pipeline(transaction=False)
+                pipe.setex(key, ttl, encoded)
+                self._publish_invalidation(pipe, key)
+                pipe.execute()
+                self._stats.record_set('redis', key, len(encoded), time.perf_counter() - started)
+                l1 = self._get_l1()
+                if l1 is not None:
+                    l1.set(key, value, min(ttl, current_app.config.get('CACHE_L1_TTL', 5)))
                 return True
             except Exception as e:
-                current_app.logger.error(f"Redis set error: {e}")
+                self._handle_redis_error('set', e)
         
         # Fallback to memory cache
-        self._memory_cache[key] = value
-        self._memory_expiry[key] = time.time() + ttl
+        self._get_memory().set(key, value, ttl)
+        return True
+    
+    def get_many(self, keys: List[str]) -> Dict[str, Any]:
+        """Get several values in one round trip; missing keys are omitted."""
+        found = {}
+        redis_client = self._get_redis()
+        
+        if redis_client:
+            l1 = self._get_l1()
+            pending = []
+            for key in keys:
+                value = l1.get(key) if l1 is not None else None
+                if value is not None:
+                    found[key] = value
+                else:
+                    pending.append(key)
+            if not pending:
+                return found
+            
+            started = time.perf_counter()
+            try:
+                pipe = redis_client.pipeline(transaction=False)
+                pipe.mget(pending)
+                if l1 is not None:
+                    for key in pending:
+                        pipe.pttl(key)
+                results = pipe.execute()
+                per_key = (time.perf_counter() - started) / len(pending)
+                for i, (key, raw) in enumerate(zip(pending, results[0])):
+                    self._stats.record_get('redis', key, bool(raw), per_key)
+                    if raw:
+                        value = self._get_codec().decode(raw)
+                        found[key] = value
+                        if l1 is not None:
+                            self._promote(l1, key, value, results[1 + i])
+                return found
+            except Exception as e:
+                self._handle_redis_error('get_many', e)
         
-        # Simple memory cleanup (remove expired entries if cache is large)
-        if len(self._memory_cache) > 1000:
-            self._cleanup_memory_cache()
+        # Fallback to memory cache
+        memory = self._get_memory()
+        for key in keys:
+            if key not in found:
+                value = memory.get(key)
+                if value is not None:
+                    found[key] = value
+        return found
+    
+    def set_many(self, mapping: Dict[str, Any], ttl: int = 300) -> bool:
+        """Set several values with the same TTL in one pipelined round trip."""
+        redis_client = self._get_redis()
+        
+        if redis_client:
+            started = time.perf_counter()
+            try:
+                pipe = redis_client.pipeline(transaction=False)
+                sizes = {}
+                for key, value in mapping.items():
+                    encoded = self._get_codec().encode(value)
+                    sizes[key] = len(encoded)
+                    pipe.setex(key, ttl, encoded)
+                    self._publish_invalidation(pipe, key)
+                pipe.execute()
+                per_key = (time.perf_counter() - started) / max(len(mapping), 1)
+                for key, size in sizes.items():
+                    self._stats.record_set('redis', key, size, per_key)
+                l1 = self._get_l1()
+                if l1 is not None:
+                    l1_ttl = min(ttl, current_app.config.get('CACHE_L1_TTL', 5))
+                    for key, value in mapping.items():
+                        l1.set(key, value, l1_ttl)
+                return True
+            except Exception as e:
+                self._handle_redis_error('set_many', e)
         
+        # Fallback to memory cache
+        memory = self._get_memory()
+        for key, value in mapping.items():
+            memory.set(key, value, ttl)
         return True
     
+    def _promote(self, l1: MemoryCache, key: str, value: Any, pttl: Optional[int]):
+        """Copy a Redis hit into L1, never outliving the Redis entry."""
+        l1_ttl = current_app.config.get('CACHE_L1_TTL', 5)
+        if pttl and pttl > 0:
+            l1_ttl = min(l1_ttl, pttl / 1000)
+        l1.set(key, value, l1_ttl)
+    
     def delete(self, key: str) -> bool:
         """Delete a key from cache."""
         redis_client = self._get_redis()
         
         if redis_client:
             try:
-                redis_client.delete(key)
-            except Exception:
-                pass
+                pipe = redis_client.pipeline(transaction=False)
+                pipe.delete(key)
+                self._publish_invalidation(pipe, key)
+                pipe.execute()
+            except Exception as e:
+                self._handle_redis_error('delete', e)
+            l1 = self._get_l1()
+            if l1 is not None:
+                l1.delete(key)
         
         # Also remove from memory cache
-        self._memory_cache.pop(key, None)
-        self._memory_expiry.pop(key, None)
+        self._get_memory().delete(key)
         
         return True
     
-    def _cleanup_memory_cache(self):
-        """Remove expired entries from memory cache."""
+    def get_or_load(self, key: str, loader: Callable[[], Any], ttl: int = 300,
+                    stale_ttl: Optional[int] = None,
+                    accept: Optional[Callable[[Any], bool]] = None) -> Any:
+        """
+        Read-through lookup with stale-while-revalidate and stale-if-error.
+        
+        Entries are fresh for `ttl` seconds. For a further `stale_ttl` seconds
+        (by default CACHE_STALE_RATIO times `ttl`, capped at CACHE_STALE_TTL)
+        the old value is still returned while a single background refresh runs;
+        if that refresh fails the stale value keeps being served until it expires.
+        A cached value rejected by `accept` is treated as a miss.
+        """
+        if stale_ttl is None:
+            # Short-lived kinds (search) must not be served hours out of date
+            stale_ttl = min(int(ttl * current_app.config.get('CACHE_STALE_RATIO', 1.0)),
+                            current_app.config.get('CACHE_STALE_TTL', 3600))
+        
+        entry = self.get(key)
+        if isinstance(entry, dict) and 'fresh_until' in entry:
+            if accept is None or accept(entry['value']):
+                if entry['fresh_until'] <= time.time():
+                    metrics.incr('cache.stale_served')
+                    self._schedule_refresh(key, loader, ttl, stale_ttl, entry)
+                return entry['value']
+        
+        def load():
+            value = loader()
+            self._store_fresh(key, value, ttl, stale_ttl)
+            return value
+        
+        value = singleflight.do(key, load, current_app.config.get('CACHE_SINGLEFLIGHT_TIMEOUT', 30))
+        if accept is not None and value and not accept(value):
+            # We joined an in-flight load that doesn't satisfy this caller
+            value = load()
+        return value
+    
+    def load_with_lease(self, key: str, loader: Callable[[], Any],
+                        ttl: Union[int, Callable[[Any], int]] = 300,
+                        lease_ttl: Optional[float] = None,
+                        wait_timeout: Optional[float] = None) -> Any:
+        """
+        Cross-node single-flight: compute `key` on one node at a time.
+        
+        The node that wins the `lock:{key}` lease runs `loader` and stores the
+        result; other nodes poll for the result key until it appears, the lease
+        lapses (crashed owner), or `wait_timeout` passes (raises TimeoutError).
+        If the owner's loader raises or returns None, a `failed:{key}` marker
+        makes every caller for CACHE_LEASE_FAILURE_TTL seconds get None or
+        LeaseLoadFailed at once instead of re-running the loader in turn.
+        Without Redis this simply runs the loader. `ttl` may be a function of
+        the loaded value.
+        """
+        ttl_for = ttl if callable(ttl) else (lambda value: ttl)
+        value = self.get(key)
+        if value is not None:
+            return value
+        
+        redis_client = self._get_redis()
+        if not redis_client:
+            value = loader()
+            if value is not None:
+                self.set(key, value, ttl_for(value))
+            return value
+        
+        if lease_ttl is None:
+            lease_ttl = current_app.config.get('CACHE_LEASE_TTL', 30)
+        if wait_timeout is None:
+            wait_timeout = current_app.config.get('CACHE_SINGLEFLIGHT_TIMEOUT', 30)
+        deadline = time.time() + wait_timeout
+        poll_interval = 0.05
+        failed_key = f"failed:{key}"
+        failure_ttl = current_app.config.get('CACHE_LEASE_FAILURE_TTL', 10)
+        
+        while True:
+            lease = RedisLease(redis_client, f"lock:{key}", lease_ttl)
+            try:
+                failure = redis_client.get(failed_key)
+                acquired = failure is None and lease.acquire()
+            except Exception as e:
+                current_app.logger.error(f"Redis lease error: {e}")
+                return loader()
+            
+            if failure is not None:
+                metrics.incr('cache.lease.failed_fast')
+                if failure == b'':
+                    return None
+                raise LeaseLoadFailed(failure.decode('utf-8', 'replace'))
+            
+            if acquired:
+                try:
+                    # Another node may have finished between our miss and the lease
+                    value = self.get(key)
+                    if value is None:
+                        try:
+                            value = loader()
+                        except Exception as e:
+                            # Set before the lease is released, so no waiter re-runs the loader
+                            self._mark_failed(redis_client, failed_key, str(e) or type(e).__name__, failure_ttl)
+                            raise
+                        if value is None:
+                            self._mark_failed(redis_client, failed_key, '', failure_ttl)
+                        else:
+                            self.set(key, value, ttl_for(value))
+                    return value
+                finally:
+                    lease.release()
+            
+            metrics.incr('cache.lease.wait')
+            time.sleep(poll_interval)
+            poll_interval = min(poll_interval * 1.5, 0.5)
+            
+            value = self.get(key)
+            if value is not None:
+                return value
+            if time.time() >= deadline:
+                metrics.incr('cache.lease.timeout')
+                raise TimeoutError(f"Timed out waiting for {key}")
+    
+    @staticmethod
+    def _mark_failed(redis_client, failed_key: str, message: str, ttl: float):
+        """Record a failed lease load ('' for a None result) for other nodes to read."""
+        try:
+            redis_client.set(failed_key, message.encode('utf-8'), px=int(ttl * 1000))
+        except Exception as e:
+            current_app.logger.error(f"Redis lease error: {e}")
+    
+    def _store_fresh(self, key: str, value: Any, ttl: int, stale_ttl: int):
+        """Store a freshly loaded value with soft and hard expiry."""
+        if not value:
+            return
         now = time.time()
-        expired_keys = [k for k, exp in self._memory_expiry.items() if exp < now]
-        for key in expired_keys:
-            self._memory_cache.pop(key, None)
-            self._memory_expiry.pop(key, None)
+        self.set(key, {
+            'value': value,
+            'fresh_until': now + ttl,
+            'expires_at': now + ttl + stale_ttl,
+        }, ttl + stale_ttl)
+    
+    def _schedule_refresh(self, key: str, loader: Callable[[], Any], ttl: int,
+                          stale_ttl: int, entry: Dict[str, Any]):
+        """Refresh a stale entry in the background, at most once per key."""
+        with self._refresh_lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+            if self._refresh_executor is None:
+                CacheService._refresh_executor = ThreadPoolExecutor(
+                    max_workers=current_app.config.get('CACHE_REFRESH_WORKERS', 4),
+                    thread_name_prefix='cache-refresh',
+                )
+        
+        app = current_app._get_current_object()
+        
+        def refresh():
+            with app.app_context():
+                try:
+                    self._store_fresh(key, loader(), ttl, stale_ttl)
+                    metrics.incr('cache.refresh.success')
+                except Exception as e:
+                    metrics.incr('cache.refresh.failure')
+                    app.logger.warning(f"Background refresh failed for {key}: {e}")
+                    # Keep serving the stale value, but back off before retrying upstream
+                    remaining = entry['expires_at'] - time.time()
+                    if remaining > 0:
+                        retry_in = app.config.get('CACHE_REFRESH_RETRY', 30)
+                        self.set(key, dict(entry, fresh_until=time.time() + retry_in),
+                                 int(remaining) + 1)
+                finally:
+                    with self._refresh_lock:
+                        self._refreshing.discard(key)
+        
+        self._refresh_executor.submit(refresh)
+    
+    def stats(self) -> Dict[str, Any]:
+        """Get cache statistics, overall and per tier and key prefix."""
+        stats = {
+            'backend': 'redis' if self._get_redis() else 'memory',
+            'memory': self._get_memory().stats(),
+            'prefixes': self._stats.snapshot(),
+            'in_flight': singleflight.in_flight(),
+        }
+        l1 = self._get_l1()
+        if l1 is not None:
+            stats['l1'] = l1.stats()
+        return stats
+    
+    def reset_stats(self):
+        """Zero all cache counters."""
+        self._stats.reset()
+        self._get_memory().reset_stats()
+        l1 = self._get_l1()
+        if l1 is not None:
+            l1.reset_stats()
 
 
 # Singleton instance
@@ -112,12 +827,14 @@ cache = CacheService()
 
 
 def cached(ttl: int = 300, key_prefix: str = ''):
-    """Decorator to cache function results."""
+    """Decorator to cache function results under `key_prefix` (default: the function's module)."""
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            # Build cache key from function name and arguments
-            cache_key = f"{key_prefix}:{func.__name__}:{str(args)}:{str(kwargs)}"
+            # Build cache key from function name and a digest of the arguments
+            arguments = json.dumps([args, kwargs], sort_keys=True, default=str)
+            cache_key = make_key(key_prefix or func.__module__, func.__qualname__,
+                                 hashlib.sha1(arguments.encode('utf-8')).hexdigest())
             
             # Try to get from cache
             result = cache.get(cache_key)
@@ -0,0 +1,130 @@
+"""
+Serialization codecs for cached values.
+
+Encoded values start with a version byte followed by serializer and
+compression ids, so the codec can change without invalidating the cache.
+Entries written before the header existed are plain JSON and still decode.
+"""
+import json
+import zlib
+from typing import Any
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - optional codec
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional codec
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:  # pragma: no cover - optional codec
+    lz4_frame = None
+
+
+FORMAT_VERSION = 1
+
+SERIALIZERS = {'json': 0, 'msgpack': 1}
+COMPRESSORS = {'none': 0, 'zlib': 1, 'zstd': 2, 'lz4': 3}
+
+
+def _json_dumps(value: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+def _json_loads(data: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def available_serializers() -> list:
+    """Serializers usable in this environment."""
+    return ['json'] + (['msgpack'] if msgpack is not None else [])
+
+
+def available_compressors() -> list:
+    """Compressors usable in this environment."""
+    names = ['none', 'zlib']
+    if zstandard is not None:
+        names.append('zstd')
+    if lz4_frame is not None:
+        names.append('lz4')
+    return names
+
+
+class CacheCodec:
+    """Encode/decode cache values with optional compression above a size threshold."""
+    
+    def __init__(self, serializer: str = 'json', compression: str = 'zlib',
+                 threshold: int = 1024):
+        if serializer not in available_serializers():
+            serializer = 'json'
+        if compression not in available_compressors():
+            compression = 'zlib'
+        self.serializer = serializer
+        self.compression = compression
+        self.threshold = threshold
+        
+        if zstandard is not None:
+            self._zstd_compressor = zstandard.ZstdCompressor(level=3)
+            self._zstd_decompressor = zstandard.ZstdDecompressor()
+    
+    def encode(self, value: Any) -> bytes:
+        """Serialize a value and compress it if it is large enough."""
+        if self.serializer == 'msgpack':
+            payload = msgpack.packb(value, use_bin_type=True)
+        else:
+            payload = _json_dumps(value)
+        
+        compression = 'none'
+        if self.compression != 'none' and len(payload) >= self.threshold:
+            payload = self._compress(payload)
+            compression = self.compression
+        
+        header = bytes((FORMAT_VERSION, SERIALIZERS[self.serializer], COMPRESSORS[compression]))
+        return header + payload
+    
+    def decode(self, data: bytes) -> Any:
+        """Deserialize a value written by any codec version."""
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if not data or data[0] != FORMAT_VERSION:
+            # Legacy entry: plain JSON text
+            return _json_loads(data)
+        
+        serializer, compression = data[1], data[2]
+        payload = self._decompress(compression, data[3:])
+        if serializer == SERIALIZERS['msgpack']:
+            if msgpack is None:
+                raise ValueError("Cached value requires msgpack, which is not installed")
+            return msgpack.unpackb(payload, raw=False)
+        return _json_loads(payload)
+    
+    def _compress(self, payload: bytes) -> bytes:
+        if self.compression == 'zstd':
+            return self._zstd_compressor.compress(payload)
+        if self.compression == 'lz4':
+            return lz4_frame.compress(payload)
+        return zlib.compress(payload, 6)
+    
+    def _decompress(self, compression: int, payload: bytes) -> bytes:
+        if compression == COMPRESSORS['none']:
+            return payload
+        if compression == COMPRESSORS['zlib']:
+            return zlib.decompress(payload)
+        if compression == COMPRESSORS['zstd'] and zstandard is not None:
+            return self._zstd_decompressor.decompress(payload)
+        if compression == COMPRESSORS['lz4'] and lz4_frame is not None:
+            return lz4_frame.decompress(payload)
+        raise ValueError(f"Unsupported cache compression id {compression}")
@@ -0,0 +1,81 @@
+"""
+In-memory cache of the first bytes of popular tracks.
+
+Playback of a popular track can start from its head while the upstream
+connection for the rest of the file is still being set up.
+"""
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from flask import current_app
+
+from .cache import MemoryCache
+from .metrics import metrics
+
+
+class HeadCache:
+    """Per-process store of (content type, file size, head bytes) keyed by video ID."""
+    
+    _instance = None
+    
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._lock = threading.Lock()
+            cls._instance._plays_lock = threading.Lock()
+            cls._instance._heads = None
+            cls._instance._plays = None
+        return cls._instance
+    
+    def _configure(self):
+        """Create the memory tiers from settings on first use (needs app context)."""
+        if self._heads is not None:
+            return
+        with self._lock:
+            if self._heads is not None:
+                return
+            self.head_size = current_app.config.get('STREAM_HEAD_BYTES', 192 * 1024)
+            self.min_plays = current_app.config.get('STREAM_HEAD_MIN_PLAYS', 3)
+            self.play_window = current_app.config.get('STREAM_HEAD_PLAY_WINDOW', 86400)
+            self.ttl = current_app.config.get('STREAM_HEAD_TTL', 86400)
+            self._plays = MemoryCache(
+                max_entries=current_app.config.get('STREAM_HEAD_PLAYS_MAX_ENTRIES', 50000),
+                name='head_plays'
+            )
+            self._heads = MemoryCache(
+                max_entries=current_app.config.get('STREAM_HEAD_MAX_ENTRIES', 1000),
+                max_bytes=current_app.config.get('STREAM_HEAD_CACHE_MAX_BYTES', 128 * 1024 * 1024),
+                name='head'
+            )
+    
+    def enabled(self) -> bool:
+        return current_app.config.get('STREAM_HEAD_ENABLED', True)
+    
+    def record_play(self, video_id: str) -> bool:
+        """Count a play from the start of a track; True once the track is popular."""
+        self._configure()
+        # Read-increment-write as one step, or concurrent plays lose counts
+        with self._plays_lock:
+            plays = (self._plays.get(video_id) or 0) + 1
+            self._plays.set(video_id, plays, self.play_window)
+        return plays >= self.min_plays
+    
+    def get(self, video_id: str) -> Optional[Tuple[str, int, bytes]]:
+        """Get (content type, file size, head) for a track."""
+        self._configure()
+        head = self._heads.get(video_id)
+        metrics.incr('head_cache.hit' if head else 'head_cache.miss')
+        return head
+    
+    def put(self, video_id: str, content_type: str, size: int, head: bytes):
+        """Store a track's head (works outside the app context once configured)."""
+        self._heads.set(video_id, (content_type, size, bytes(head[:self.head_size])), self.ttl)
+        metrics.incr('head_cache.stored')
+    
+    def stats(self) -> Dict[str, Any]:
+        self._configure()
+        return {'heads': self._heads.stats(), 'tracked_plays': len(self._plays)}
+
+
+# Singleton instance
+head_cache = HeadCache()
@@ -0,0 +1,56 @@
+"""
+In-process metrics registry (counters and timings).
+"""
+import threading
+from typing import Any, Dict
+
+
+class MetricsRegistry:
+    """Thread-safe counters and timing summaries kept in process memory."""
+    
+    _instance = None
+    
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._lock = threading.Lock()
+            cls._instance._counters = {}
+            cls._instance._timings = {}
+        return cls._instance
+    
+    def incr(self, name: str, value: int = 1):
+        """Increment a counter."""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+    
+    def observe(self, name: str, value: float):
+        """Record one sample of a timing/size distribution."""
+        with self._lock:
+            timing = self._timings.get(name)
+            if timing is None:
+                self._timings[name] = [1, value, value]
+            else:
+                timing[0] += 1
+                timing[1] += value
+                timing[2] = max(timing[2], value)
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """Get a copy of every counter and timing summary."""
+        with self._lock:
+            return {
+                'counters': dict(self._counters),
+                'timings': {
+                    name: {'count': count, 'avg': total / count, 'max': peak}
+                    for name, (count, total, peak) in self._timings.items()
+                }
+            }
+    
+    def reset(self):
+        """Zero all counters and timings."""
+        with self._lock:
+            self._counters.clear()
+            self._timings.clear()
+
+
+# Singleton instance
+metrics = MetricsRegistry()
@@ -0,0 +1,129 @@
+"""
+InnerTube player endpoint client.
+
+Fetches the formats of a video with a single POST to /youtubei/v1/player as
+the android or ios app, the same request yt-dlp makes for those clients,
+without the rest of yt-dlp's extraction pipeline. Answers are mapped to the
+yt-dlp info dict fields the resolver reads.
+"""
+import re
+from typing import Any, Dict, Optional
+
+import requests
+
+PLAYER_URL = 'https://www.youtube.com/youtubei/v1/player?prettyPrint=false'
+
+CLIENTS = {
+    'android': {
+        'id': 3,
+        'context': {
+            'clientName': 'ANDROID',
+            'clientVersion': '19.44.38',
+            'androidSdkVersion': 30,
+            'osName': 'Android',
+            'osVersion': '11',
+            'userAgent': 'com.google.android.youtube/19.44.38 (Linux; U; Android 11) gzip',
+        },
+    },
+    'ios': {
+        'id': 5,
+        'context': {
+            'clientName': 'IOS',
+            'clientVersion': '19.45.4',
+            'deviceMake': 'Apple',
+            'deviceModel': 'iPhone16,2',
+            'osName': 'iPhone',
+            'osVersion': '18.1.0.22B83',
+            'userAgent': 'com.google.ios.youtube/19.45.4 (iPhone16,2; U; CPU iOS 18_1_0 like Mac OS X;)',
+        },
+    },
+}
+
+EXTENSIONS = {'audio/mp4': 'm4a', 'audio/webm': 'webm', 'video/mp4': 'mp4', 'video/webm': 'webm'}
+
+_CODECS_RE = re.compile(r'codecs="([^"]+)"')
+
+
+class PlayerAPIError(Exception):
+    """The player endpoint gave no directly playable audio."""
+
+
+def fetch_player(session: requests.Session, video_id: str, client: str, timeout: float = 10) -> Dict[str, Any]:
+    """POST a player request as `client` and return the raw JSON answer."""
+    spec = CLIENTS[client]
+    context = dict(spec['context'], hl='en', timeZone='UTC', utcOffsetMinutes=0)
+    resp = session.post(PLAYER_URL, timeout=timeout, json={
+        'context': {'client': context},
+        'videoId': video_id,
+        'playbackContext': {'contentPlaybackContext': {'html5Preference': 'HTML5_PREF_WANTS'}},
+        'contentCheckOk': True,
+        'racyCheckOk': True,
+    }, headers={
+        'User-Agent': context['userAgent'],
+        'X-YouTube-Client-Name': str(spec['id']),
+        'X-YouTube-Client-Version': context['clientVersion'],
+        'Origin': 'https://www.youtube.com',
+    })
+    resp.raise_for_status()
+    return resp.json()
+
+
+def parse_player_response(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Map a player answer to yt-dlp style info: title, duration, url and formats."""
+    status = data.get('playabilityStatus') or {}
+    if status.get('status') != 'OK':
+        raise PlayerAPIError(f"{status.get('status')}: {status.get('reason')}")
+
+    streaming = data.get('streamingData') or {}
+    # Formats behind signatureCipher need yt-dlp's player JS deciphering
+    formats = [_format(fmt) for fmt in (streaming.get('formats') or []) + (streaming.get('adaptiveFormats') or [])
+               if fmt.get('url')]
+    audio_only = sorted((f for f in formats if f['vcodec'] == 'none' and f['acodec'] != 'none'),
+                        key=lambda f: (f['ext'] == 'm4a', f['abr'] or 0), reverse=True)
+    if not audio_only:
+        raise PlayerAPIError('No direct audio URLs in player response')
+
+    details = data.get('videoDetails') or {}
+    return {
+        'title': details.get('title'),
+        'duration': int(details['lengthSeconds']) if details.get('lengthSeconds') else None,
+        # Same preference as the yt-dlp format string: m4a first
+        'url': audio_only[0]['url'],
+        'formats': formats,
+    }
+
+
+def fetch_info(session: requests.Session, video_id: str, client: str, timeout: float = 10) -> Dict[str, Any]:
+    return parse_player_response(fetch_player(session, video_id, client, timeout))
+
+
+def _format(fmt: Dict[str, Any]) -> Dict[str, Any]:
+    mime, _, params = (fmt.get('mimeType') or '').partition(';')
+    match = _CODECS_RE.search(params)
+    codecs = [c.strip() for c in match.group(1).split(',')] if match else []
+    audio = mime.startswith('audio/')
+
+    if audio:
+        acodec, vcodec = (codecs[0] if codecs else None), 'none'
+    else:
+        vcodec = codecs[0] if codecs else None
+        acodec = codecs[1] if len(codecs) > 1 else 'none'
+    bitrate = fmt.get('averageBitrate') or fmt.get('bitrate')
+
+    return {
+        'format_id': str(fmt.get('itag')),
+        'url': fmt['url'],
+        'ext': EXTENSIONS.get(mime),
+        'acodec': acodec,
+        'vcodec': vcodec,
+        'abr': bitrate / 1000 if audio and bitrate else None,
+        'asr': _int(fmt.get('audioSampleRate')),
+        'filesize': _int(fmt.get('contentLength')),
+    }
+
+
+def _int(value: Any) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
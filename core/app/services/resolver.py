@@ -0,0 +1,515 @@
+"""
+Stream URL resolver.
+
+Runs yt-dlp extraction on its own bounded worker pool, caches every audio
+format of a video under `formats:{video_id}` and re-resolves entries in the
+background shortly before they expire, so warm tracks never wait on yt-dlp.
+
+With RESOLVER_BACKEND=process the extraction itself runs in a pool of worker
+processes, each keeping a warm YoutubeDL; only the compact format list is
+sent back to the server process.
+
+With RESOLVER_RACE_CLIENTS the configured player clients are asked in
+parallel instead of one after another; the first playable answer wins, and
+per-client latency and success rate decide the launch order next time.
+
+With RESOLVER_FAST_PATH android/ios resolutions first try a single call to
+the player endpoint (player_api) and only fall back to full yt-dlp
+extraction when that gives no playable audio.
+"""
+import multiprocessing
+import os
+import re
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import requests
+import yt_dlp
+from flask import current_app
+
+from . import player_api
+from .cache import cache, singleflight, make_key, MemoryCache
+from .metrics import metrics
+
+
+_EXPIRE_RE = re.compile(r'[?&/]expire[=/](\d+)')
+
+YDL_OPTIONS = {
+    'format': 'bestaudio[ext=m4a]/bestaudio[ext=webm]/bestaudio/best',
+    'quiet': True,
+    'no_warnings': True,
+    'extract_flat': False,
+    'skip_download': True,
+    'force_ipv4': True,
+}
+
+# Warm YoutubeDL instances of a resolver worker process, by player clients
+_process_ydls: Dict[Tuple[str, ...], yt_dlp.YoutubeDL] = {}
+_process_session: Optional[requests.Session] = None
+
+
+class ResolverBusy(Exception):
+    """The resolver queue is full."""
+
+
+class NoPlayableFormats(Exception):
+    """No player client returned a playable audio format."""
+
+
+def url_expiry(url: Optional[str]) -> Optional[float]:
+    """Expiry timestamp carried by a googlevideo URL (`expire=` or `/expire/`), if any."""
+    match = _EXPIRE_RE.search(url or '')
+    return float(match.group(1)) if match else None
+
+
+def audio_formats(formats: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Audio-capable formats, best bitrate first."""
+    audio = [{
+        'format_id': fmt.get('format_id'),
+        'url': fmt['url'],
+        'ext': fmt.get('ext'),
+        'acodec': fmt.get('acodec'),
+        'abr': fmt.get('abr'),
+        'asr': fmt.get('asr'),
+        'filesize': fmt.get('filesize'),
+        'audio_only': fmt.get('vcodec') == 'none',
+    } for fmt in formats if fmt.get('url') and fmt.get('acodec') not in (None, 'none')]
+    return sorted(audio, key=lambda f: (f['audio_only'], f['abr'] or 0), reverse=True)
+
+
+def ydl_options(clients: Tuple[str, ...]) -> Dict[str, Any]:
+    """YoutubeDL options asking the given player clients, in order."""
+    return dict(YDL_OPTIONS, extractor_args={'youtube': {'player_client': list(clients)}})
+
+
+def compact_info(info: Dict[str, Any]) -> Dict[str, Any]:
+    """Keep the compact, audio-capable part of a yt-dlp style info dict."""
+    formats = audio_formats(info.get('formats') or info.get('requested_formats') or [])
+    
+    audio_url = info.get('url')
+    if not audio_url:
+        for fmt in info.get('requested_formats') or []:
+            if fmt.get('acodec') != 'none' and fmt.get('url'):
+                audio_url = fmt['url']
+                break
+    if not audio_url and formats:
+        audio_url = formats[0]['url']
+    
+    return {
+        'title': info.get('title'),
+        'duration': info.get('duration'),
+        'audio_url': audio_url,
+        'formats': formats,
+    }
+
+
+def extract_formats(ydl: yt_dlp.YoutubeDL, video_id: str) -> Dict[str, Any]:
+    """Run yt-dlp and keep the compact, audio-capable part of its answer."""
+    info = ydl.extract_info(f'https://www.youtube.com/watch?v={video_id}', download=False)
+    return dict(compact_info(info), source='yt-dlp')
+
+
+def resolve_formats(video_id: str, clients: Tuple[str, ...], get_ydl: Callable,
+                    session: Optional[requests.Session], fast_timeout: float) -> Dict[str, Any]:
+    """
+    Compact formats of a video, from the player endpoint when possible.
+    
+    With a session, each client the player endpoint knows is asked directly
+    in order; full yt-dlp extraction is the fallback.
+    """
+    if session is not None:
+        for client in clients:
+            if client not in player_api.CLIENTS:
+                continue
+            started = time.perf_counter()
+            try:
+                info = compact_info(player_api.fetch_info(session, video_id, client, fast_timeout))
+            except (requests.RequestException, ValueError, player_api.PlayerAPIError):
+                metrics.incr('resolver.fast_path.failed')
+                continue
+            metrics.incr('resolver.fast_path.ok')
+            metrics.observe('resolver.fast_path_ms', (time.perf_counter() - started) * 1000)
+            return dict(info, source='player_api')
+    return extract_formats(get_ydl(clients), video_id)
+
+
+def _init_process_worker(clients: Tuple[str, ...]):
+    """Create the YoutubeDL a worker process reuses for all its extractions."""
+    _process_ydls[clients] = yt_dlp.YoutubeDL(ydl_options(clients))
+
+
+def _process_ydl(clients: Tuple[str, ...]) -> yt_dlp.YoutubeDL:
+    if clients not in _process_ydls:
+        _process_ydls[clients] = yt_dlp.YoutubeDL(ydl_options(clients))
+    return _process_ydls[clients]
+
+
+def _extract_in_process(video_id: str, clients: Tuple[str, ...],
+                        fast_path: bool = False, fast_timeout: float = 10) -> Dict[str, Any]:
+    global _process_session
+    if fast_path and _process_session is None:
+        _process_session = requests.Session()
+    return resolve_formats(video_id, clients, _process_ydl, _process_session if fast_path else None, fast_timeout)
+
+
+class StreamResolver:
+    """Resolves and caches stream URLs for videos on a dedicated worker pool."""
+    
+    _instance = None
+    
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._lock = threading.Lock()
+            cls._instance._executor = None
+            cls._instance._processes = None
+            cls._instance._race_executor = None
+            cls._instance._clients = {}
+            cls._instance._slow_path = MemoryCache(max_entries=10000, name='resolver_slow_path')
+            cls._instance._slots = None
+            cls._instance._refreshing = set()
+            cls._instance._local = threading.local()
+        return cls._instance
+    
+    def _get_executor(self) -> ThreadPoolExecutor:
+        """Create the worker pool and its queue bound on first use (needs app context)."""
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    workers = current_app.config.get('RESOLVER_WORKERS', 8)
+                    queue_size = current_app.config.get('RESOLVER_QUEUE_SIZE', 64)
+                    self._slots = threading.BoundedSemaphore(workers + queue_size)
+                    self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='resolver')
+        return self._executor
+    
+    def _get_processes(self) -> ProcessPoolExecutor:
+        """Create the extraction process pool on first use (needs app context)."""
+        if self._processes is None:
+            with self._lock:
+                if self._processes is None:
+                    # Never fork the threaded server: workers start from a clean interpreter
+                    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                    self._processes = ProcessPoolExecutor(
+                        max_workers=current_app.config.get('RESOLVER_PROCESSES') or os.cpu_count(),
+                        mp_context=multiprocessing.get_context(method),
+                        initializer=_init_process_worker,
+                        initargs=(self._player_clients(),),
+                    )
+        return self._processes
+    
+    def _get_race_executor(self) -> ThreadPoolExecutor:
+        """Threads running the per-client extractions of a race (needs app context)."""
+        if self._race_executor is None:
+            with self._lock:
+                if self._race_executor is None:
+                    workers = current_app.config.get('RESOLVER_WORKERS', 8) * len(self._player_clients())
+                    self._race_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='resolver-race')
+        return self._race_executor
+    
+    def resolve(self, video_id: str) -> Dict[str, Any]:
+        """
+        Get the resolved formats of a video.
+        
+        Warm entries come straight from the cache (and are refreshed in the
+        background once inside the refresh margin); misses are resolved on the
+        worker pool, once per video across threads and nodes.
+        """
+        key = make_key('formats', video_id)
+        info = cache.get(key)
+        if info:
+            metrics.incr('resolver.hit')
+            if time.time() >= info['refresh_at']:
+                self._schedule_refresh(video_id)
+            return info
+        
+        metrics.incr('resolver.miss')
+        timeout = current_app.config.get('RESOLVER_TIMEOUT', 30)
+        return singleflight.do(key, lambda: cache.load_with_lease(
+            key, lambda: self._submit(video_id).result(timeout), self._ttl_for
+        ), timeout)
+    
+    def audio_url(self, video_id: str) -> Optional[str]:
+        """Best audio URL of a video."""
+        return self.resolve(video_id).get('audio_url')
+    
+    def invalidate(self, video_id: str):
+        """Forget a video's formats, e.g. after upstream rejected its URL."""
+        metrics.incr('resolver.invalidated')
+        key = make_key('formats', video_id)
+        info = cache.get(key)
+        if info and info.get('source') == 'player_api':
+            # Upstream refused a fast-path URL: give this video full extraction for a while
+            self._slow_path.set(video_id, True, current_app.config.get('RESOLVER_TTL', 3600))
+        cache.delete(key)
+    
+    def stats(self) -> Dict[str, Any]:
+        executor = self._executor
+        processes = self._processes
+        return {
+            'backend': current_app.config.get('RESOLVER_BACKEND', 'thread'),
+            'workers': executor._max_workers if executor else 0,
+            'processes': processes._max_workers if processes else 0,
+            'queued': executor._work_queue.qsize() if executor else 0,
+            'refreshing': len(self._refreshing),
+            'clients': self.client_stats(),
+        }
+    
+    def client_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Per player client attempts, outcomes and latency, in current race order."""
+        with self._lock:
+            return {client: dict(self._clients.get(client) or self._new_client_stats())
+                    for client in self._client_order(self._player_clients())}
+    
+    def _start(self, video_id: str, clients: Tuple[str, ...],
+               executor: Optional[ThreadPoolExecutor] = None) -> Future:
+        """
+        Start one extraction with the given player clients.
+        
+        The process backend always runs it in the process pool; the thread
+        backend runs it on `executor`, or right here when none is given.
+        """
+        fast_path = current_app.config.get('RESOLVER_FAST_PATH', True) and not self._slow_path.get(video_id)
+        fast_timeout = current_app.config.get('RESOLVER_FAST_PATH_TIMEOUT', 5)
+        
+        if current_app.config.get('RESOLVER_BACKEND', 'thread') == 'process':
+            processes = self._get_processes()
+            
+            def drop_broken(f):
+                # A worker died; start a fresh pool for the next extraction
+                if not f.cancelled() and isinstance(f.exception(), BrokenProcessPool):
+                    with self._lock:
+                        if self._processes is processes:
+                            self._processes = None
+            
+            try:
+                future = processes.submit(_extract_in_process, video_id, clients, fast_path, fast_timeout)
+            except BrokenProcessPool:
+                future = Future()
+                future.set_exception(BrokenProcessPool('Resolver process pool is broken'))
+            future.add_done_callback(drop_broken)
+            return future
+        
+        def run():
+            session = self._get_session() if fast_path else None
+            return resolve_formats(video_id, clients, self._get_ydl, session, fast_timeout)
+        
+        if executor is None:
+            future = Future()
+            try:
+                future.set_result(run())
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        
+        app = current_app._get_current_object()
+        return executor.submit(self._in_context, app, run)
+    
+    def _race(self, video_id: str, clients: Tuple[str, ...]) -> Dict[str, Any]:
+        """Ask each player client separately and return the first playable answer."""
+        executor = self._get_race_executor()
+        order = self._client_order(clients)
+        hedge = current_app.config.get('RESOLVER_RACE_HEDGE_MS', 0) / 1000
+        deadline = time.monotonic() + current_app.config.get('RESOLVER_TIMEOUT', 30)
+        started = {}
+        pending = set()
+        errors = []
+        
+        def launch():
+            client = order.pop(0)
+            with self._lock:
+                self._client_stats(client)['attempts'] += 1
+            future = self._start(video_id, (client,), executor)
+            started[future] = (client, time.perf_counter())
+            pending.add(future)
+        
+        launch()
+        while order and not hedge:
+            launch()
+        
+        while pending:
+            timeout = deadline - time.monotonic()
+            if order and hedge:
+                timeout = min(timeout, hedge)
+            done, _ = wait(pending, timeout=max(timeout, 0), return_when=FIRST_COMPLETED)
+            if not done:
+                if order and time.monotonic() < deadline:
+                    # The leader is slow; bring in the next client
+                    launch()
+                    continue
+                break
+            
+            for future in done:
+                pending.discard(future)
+                client, began = started[future]
+                info = self._record_client(client, began, future)
+                if info is not None:
+                    self._abandon(pending, started)
+                    with self._lock:
+                        self._client_stats(client)['wins'] += 1
+                    metrics.incr(f'resolver.client.{client}.won')
+                    return info
+                errors.append(future.exception() or NoPlayableFormats(f"{client} returned no playable audio"))
+            
+            if not pending and order:
+                launch()
+        
+        self._abandon(pending, started)
+        if errors:
+            raise errors[-1]
+        raise TimeoutError(f"No player client answered for {video_id} in time")
+    
+    def _abandon(self, futures, started: Dict[Future, Tuple[str, float]]):
+        """Cancel queued extractions; ones already running finish in the background and still count."""
+        for future in futures:
+            future.cancel()
+            client, began = started[future]
+            future.add_done_callback(lambda f, c=client, b=began: self._record_client(c, b, f))
+    
+    def _record_client(self, client: str, began: float, future: Future) -> Optional[Dict[str, Any]]:
+        """Update a client's latency and success rate; return its answer if playable."""
+        if future.cancelled():
+            with self._lock:
+                self._client_stats(client)['attempts'] -= 1
+            return None
+        latency_ms = (time.perf_counter() - began) * 1000
+        info = None if future.exception() else future.result()
+        playable = bool(info and info.get('audio_url'))
+        
+        with self._lock:
+            stats = self._client_stats(client)
+            stats['ok' if playable else 'failed'] += 1
+            stats['latency_ms'] = latency_ms if stats['latency_ms'] is None \
+                else stats['latency_ms'] * 0.8 + latency_ms * 0.2
+        metrics.incr(f'resolver.client.{client}.{"ok" if playable else "failed"}')
+        metrics.observe(f'resolver.client.{client}_ms', latency_ms)
+        return info if playable else None
+    
+    def _client_stats(self, client: str) -> Dict[str, Any]:
+        if client not in self._clients:
+            self._clients[client] = self._new_client_stats()
+        return self._clients[client]
+    
+    @staticmethod
+    def _new_client_stats() -> Dict[str, Any]:
+        return {'attempts': 0, 'ok': 0, 'failed': 0, 'wins': 0, 'latency_ms': None}
+    
+    def _client_order(self, clients: Tuple[str, ...]) -> List[str]:
+        """Most reliable, then fastest clients first; untried clients keep their configured place."""
+        def score(client):
+            stats = self._clients.get(client)
+            if not stats or not stats['ok'] + stats['failed']:
+                return (0, 0)
+            # Smoothed so one early failure does not bury a client
+            success = (stats['ok'] + 1) / (stats['ok'] + stats['failed'] + 2)
+            return (-round(success, 1), stats['latency_ms'] or 0)
+        
+        return sorted(clients, key=score)
+    
+    def _ttl_for(self, info: Dict[str, Any]) -> int:
+        """Cache an entry until shortly before its URLs expire."""
+        safety = current_app.config.get('RESOLVER_EXPIRY_SAFETY', 60)
+        return max(int(info['expires_at'] - safety - time.time()), 1)
+    
+    def _submit(self, video_id: str):
+        """Queue an extraction on the pool, refusing work when the queue is full."""
+        executor = self._get_executor()
+        if not self._slots.acquire(blocking=False):
+            metrics.incr('resolver.rejected')
+            raise ResolverBusy(f"Resolver queue full, cannot resolve {video_id}")
+        app = current_app._get_current_object()
+        
+        def run():
+            try:
+                with app.app_context():
+                    started = time.perf_counter()
+                    info = self._extract(video_id)
+                    metrics.observe('resolver.extract_ms', (time.perf_counter() - started) * 1000)
+                    return info
+            finally:
+                self._slots.release()
+        
+        return executor.submit(run)
+    
+    def _schedule_refresh(self, video_id: str):
+        """Re-resolve a warm entry in the background before it expires."""
+        with self._lock:
+            if video_id in self._refreshing:
+                return
+            self._refreshing.add(video_id)
+        
+        key = make_key('formats', video_id)
+        logger = current_app.logger
+        
+        def store(future):
+            try:
+                info = future.result()
+                cache.set(key, info, self._ttl_for(info))
+                metrics.incr('resolver.refreshed')
+            except Exception as e:
+                # The current entry stays until it expires
+                logger.warning(f"Background refresh of {video_id} failed: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(video_id)
+        
+        app = current_app._get_current_object()
+        try:
+            future = self._submit(video_id)
+        except ResolverBusy:
+            with self._lock:
+                self._refreshing.discard(video_id)
+            return
+        future.add_done_callback(lambda f: self._in_context(app, store, f))
+    
+    @staticmethod
+    def _in_context(app, fn, *args):
+        with app.app_context():
+            return fn(*args)
+    
+    def _get_ydl(self, clients: Tuple[str, ...]) -> yt_dlp.YoutubeDL:
+        """Per-worker YoutubeDL for a set of player clients, created once per thread."""
+        if not hasattr(self._local, 'ydls'):
+            self._local.ydls = {}
+        if clients not in self._local.ydls:
+            self._local.ydls[clients] = yt_dlp.YoutubeDL(ydl_options(clients))
+        return self._local.ydls[clients]
+    
+    def _get_session(self) -> requests.Session:
+        """Per-worker HTTP session for the player endpoint."""
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+    
+    @staticmethod
+    def _player_clients() -> Tuple[str, ...]:
+        clients = current_app.config.get('RESOLVER_PLAYER_CLIENTS', 'android,ios')
+        return tuple(c.strip() for c in clients.split(',') if c.strip())
+    
+    def _extract(self, video_id: str) -> Dict[str, Any]:
+        """Extract a video's formats on the configured backend and stamp their expiry."""
+        clients = self._player_clients()
+        if current_app.config.get('RESOLVER_RACE_CLIENTS', False) and len(clients) > 1:
+            info = self._race(video_id, clients)
+        else:
+            info = self._start(video_id, clients).result()
+        
+        now = time.time()
+        # URLs die at their own expiry; RESOLVER_TTL only applies when none is given
+        urls = [info['audio_url']] + [f['url'] for f in info['formats']]
+        expiries = [e for e in map(url_expiry, urls) if e]
+        expires_at = min(expiries) if expiries else now + current_app.config.get('RESOLVER_TTL', 3600)
+        
+        return dict(
+            info,
+            video_id=video_id,
+            resolved_at=now,
+            expires_at=expires_at,
+            refresh_at=expires_at - current_app.config.get('RESOLVER_REFRESH_MARGIN', 300),
+        )
+
+
+# Singleton instance
+resolver = StreamResolver()
@@ -0,0 +1,227 @@
+"""
+Time-to-byte seek indexes of DASH audio files.
+
+YouTube's m4a audio is fragmented MP4: an init segment (ftyp, moov) and a
+sidx box listing the duration and size of every fragment. Its WebM audio
+has a Cues element with the cluster position of every cue time. Either way
+the file can be cut at an indexed fragment and, with the header in front,
+played from there.
+"""
+import bisect
+import struct
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# Matroska element IDs (marker bits included)
+EBML = 0x1A45DFA3
+SEGMENT = 0x18538067
+SEEK_HEAD = 0x114D9B74
+SEEK = 0x4DBB
+SEEK_ID = 0x53AB
+SEEK_POSITION = 0x53AC
+INFO = 0x1549A966
+TIMECODE_SCALE = 0x2AD7B1
+CUES = 0x1C53BB6B
+CUE_POINT = 0xBB
+CUE_TIME = 0xB3
+CUE_TRACK_POSITIONS = 0xB7
+CUE_CLUSTER_POSITION = 0xF1
+CLUSTER = 0x1F43B675
+
+# 8-byte EBML size meaning "unknown", written over the Segment size of a cut file
+UNKNOWN_SIZE = b'\x01\xff\xff\xff\xff\xff\xff\xff'
+
+# Reads bytes [start, end] of the file
+Fetch = Callable[[int, int], bytes]
+
+
+class IndexParseError(ValueError):
+    """The data is not a container this module can index, or is truncated."""
+
+
+def parse_index(head: bytes, size: int, fetch: Fetch) -> Optional[Dict[str, Any]]:
+    """
+    Build the seek index of a file from its first bytes.
+    
+    `fetch` is only called when the index lies beyond `head`. Returns
+    {container, size, header, points} with `points` as (seconds, offset)
+    pairs in file order, or None when the file has no usable index.
+    """
+    try:
+        if head[4:8] == b'ftyp':
+            return _parse_mp4(head, size, fetch)
+        if head[:4] == EBML.to_bytes(4, 'big'):
+            return _parse_webm(head, size, fetch)
+    except (IndexParseError, struct.error):
+        return None
+    return None
+
+
+def locate(index: Dict[str, Any], seconds: float) -> Tuple[float, int]:
+    """(start time, byte offset) of the last indexed fragment starting at or before `seconds`."""
+    points = index['points']
+    i = bisect.bisect_right([t for t, _ in points], seconds) - 1
+    return tuple(points[max(i, 0)])
+
+
+def _parse_mp4(head: bytes, size: int, fetch: Fetch) -> Optional[Dict[str, Any]]:
+    pos = 0
+    moov = False
+    while pos + 8 <= len(head):
+        box_size, kind = struct.unpack_from('>I4s', head, pos)
+        header = 8
+        if box_size == 1:
+            box_size, header = struct.unpack_from('>Q', head, pos + 8)[0], 16
+        elif box_size == 0:
+            box_size = size - pos
+        if box_size < header:
+            raise IndexParseError(f"Bad {kind!r} box at {pos}")
+        
+        if kind == b'moov':
+            moov = True
+        elif kind == b'sidx':
+            if not moov:
+                return None
+            box = head[pos:pos + box_size]
+            if len(box) < box_size:
+                box = fetch(pos, pos + box_size - 1)
+            return {
+                'container': 'mp4',
+                'size': size,
+                'header': head[:pos],
+                'points': _sidx_points(box[header:], pos + box_size),
+            }
+        elif kind in (b'moof', b'mdat'):
+            # Media before any sidx: not a DASH on-demand file
+            return None
+        pos += box_size
+    raise IndexParseError("No sidx box in the head of the file")
+
+
+def _sidx_points(body: bytes, anchor: int) -> list:
+    """(seconds, offset) of every subsegment of a sidx box body ending at `anchor`."""
+    version = body[0]
+    timescale, = struct.unpack_from('>I', body, 8)
+    if version == 0:
+        earliest, first_offset = struct.unpack_from('>II', body, 12)
+        pos = 20
+    else:
+        earliest, first_offset = struct.unpack_from('>QQ', body, 12)
+        pos = 28
+    count, = struct.unpack_from('>H', body, pos + 2)
+    pos += 4
+    
+    points = []
+    time, offset = earliest, anchor + first_offset
+    for _ in range(count):
+        reference, duration = struct.unpack_from('>II', body, pos)
+        if reference >> 31:
+            # Points at another sidx; YouTube files only have one level
+            raise IndexParseError("Hierarchical sidx is not supported")
+        points.append((time / timescale, offset))
+        time += duration
+        offset += reference & 0x7FFFFFFF
+        pos += 12
+    return points
+
+
+def _parse_webm(head: bytes, size: int, fetch: Fetch) -> Optional[Dict[str, Any]]:
+    element, length, pos = _element(head, 0)
+    size_start = pos + length + 4
+    element, length, segment = _element(head, pos + length)
+    if element != SEGMENT:
+        raise IndexParseError("No Segment element")
+    
+    timecode_scale = 1000000
+    cues = cues_position = None
+    pos = segment
+    while True:
+        element, length, body = _element(head, pos)
+        if element == CLUSTER:
+            break
+        if body + length > len(head):
+            raise IndexParseError("Header does not fit in the head of the file")
+        if element == SEEK_HEAD:
+            for seek in _children(head, body, body + length, SEEK):
+                target = dict(_fields(head, seek))
+                if _uint(target.get(SEEK_ID, b'')) == CUES and SEEK_POSITION in target:
+                    cues_position = segment + _uint(target[SEEK_POSITION])
+        elif element == INFO:
+            scale = dict(_fields(head, (body, body + length))).get(TIMECODE_SCALE)
+            if scale:
+                timecode_scale = _uint(scale)
+        elif element == CUES:
+            cues = head[pos:body + length]
+        pos = body + length
+    
+    if cues is None:
+        if cues_position is None:
+            return None
+        # Cues written after the clusters: read the element header, then the rest
+        start = fetch(cues_position, cues_position + 11)
+        element, length, body = _element(start, 0)
+        if element != CUES:
+            raise IndexParseError(f"SeekHead points to {element:#x}, not Cues")
+        cues = fetch(cues_position, cues_position + body + length - 1)
+    
+    element, length, body = _element(cues, 0)
+    points = []
+    for cue in _children(cues, body, body + length, CUE_POINT):
+        fields = dict(_fields(cues, cue))
+        if CUE_TIME not in fields or CUE_TRACK_POSITIONS not in fields:
+            continue
+        positions = fields[CUE_TRACK_POSITIONS]
+        cluster = dict(_fields(positions, (0, len(positions)))).get(CUE_CLUSTER_POSITION)
+        if cluster is not None:
+            points.append((_uint(fields[CUE_TIME]) * timecode_scale / 1e9, segment + _uint(cluster)))
+    if not points:
+        return None
+    
+    # The cut file is shorter than the Segment says; declare its size unknown
+    header = bytearray(head[:pos])
+    if segment - size_start == len(UNKNOWN_SIZE):
+        header[size_start:segment] = UNKNOWN_SIZE
+    return {'container': 'webm', 'size': size, 'header': bytes(header), 'points': sorted(points)}
+
+
+def _vint(data: bytes, pos: int, keep_marker: bool) -> Tuple[int, int]:
+    """(value, length) of the EBML variable-length integer at `pos`."""
+    if pos >= len(data):
+        raise IndexParseError("Truncated EBML data")
+    first = data[pos]
+    length = 9 - first.bit_length() if first else 9
+    if length > 8 or pos + length > len(data):
+        raise IndexParseError(f"Bad EBML integer at {pos}")
+    value = first if keep_marker else first & (0xFF >> length)
+    for byte in data[pos + 1:pos + length]:
+        value = (value << 8) | byte
+    return value, length
+
+
+def _element(data: bytes, pos: int) -> Tuple[int, int, int]:
+    """(element ID, body length, body offset) of the element at `pos`."""
+    element, id_length = _vint(data, pos, True)
+    length, size_length = _vint(data, pos + id_length, False)
+    return element, length, pos + id_length + size_length
+
+
+def _fields(data: bytes, span: Tuple[int, int]):
+    """(element ID, body bytes) of every child in data[start:end]."""
+    pos, end = span
+    while pos < end:
+        element, length, body = _element(data, pos)
+        yield element, data[body:body + length]
+        pos = body + length
+
+
+def _children(data: bytes, start: int, end: int, wanted: int):
+    """(start, end) spans of the bodies of children with the given ID."""
+    pos = start
+    while pos < end:
+        element, length, body = _element(data, pos)
+        if element == wanted:
+            yield body, body + length
+        pos = body + length
+
+
+def _uint(data: bytes) -> int:
+    return int.from_bytes(data, 'big')
@@ -0,0 +1,231 @@
+"""
+Bitrate and codec variants of a stream.
+
+A requested quality is served from the closest native YouTube format when
+one is near enough; otherwise the best audio is piped through ffmpeg. The
+number of concurrent ffmpeg processes is capped so transcoding cannot take
+every core.
+"""
+import os
+import shutil
+import subprocess
+import threading
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from flask import current_app
+
+from .metrics import metrics
+
+# Target bitrates (kbps) of the ?quality= presets
+QUALITY_KBPS = {'low': 48, 'medium': 96, 'high': 160}
+
+CODECS = {
+    'opus': {'encoder': 'libopus', 'format': 'webm', 'content_type': 'audio/webm', 'native': 'opus'},
+    'aac': {'encoder': 'aac', 'format': 'adts', 'content_type': 'audio/aac', 'native': 'mp4a'},
+    'mp3': {'encoder': 'libmp3lame', 'format': 'mp3', 'content_type': 'audio/mpeg', 'native': None},
+}
+
+# Codec used when a client only asks for a quality or bitrate
+DEFAULT_CODEC = 'opus'
+
+
+class TranscodeError(Exception):
+    """ffmpeg failed or exited with an error."""
+
+
+def parse_target(quality: Optional[str], codec: Optional[str],
+                 kbps: Optional[str]) -> Optional[Tuple[Optional[str], int]]:
+    """
+    (codec or None for any, target kbps) from ?quality=, ?codec= and ?kbps=.
+    
+    None when no variant was asked for; ValueError for unknown values.
+    """
+    if not (quality or codec or kbps):
+        return None
+    if quality and quality not in QUALITY_KBPS:
+        raise ValueError(f"quality must be one of {', '.join(QUALITY_KBPS)}")
+    if codec and codec not in CODECS:
+        raise ValueError(f"codec must be one of {', '.join(CODECS)}")
+    if kbps:
+        if not kbps.isdigit() or not 16 <= int(kbps) <= 320:
+            raise ValueError("kbps must be between 16 and 320")
+        return codec, int(kbps)
+    return codec, QUALITY_KBPS[quality or 'high']
+
+
+def variant_key(codec: str, kbps: int) -> str:
+    """Audio cache format key of a transcoded output."""
+    return f"{codec}-{kbps}k"
+
+
+def pick_native(formats: List[Dict[str, Any]], codec: Optional[str], kbps: int,
+                tolerance: Optional[float] = None) -> Optional[Dict[str, Any]]:
+    """
+    Audio-only native format closest to `kbps` (in `codec`, if given).
+    
+    Only formats within `tolerance` of the target, as a fraction of it,
+    qualify; None accepts any bitrate.
+    """
+    native = CODECS[codec]['native'] if codec else ''
+    if native is None:
+        return None
+    candidates = [f for f in formats
+                  if f.get('audio_only') and f.get('abr') and (f.get('acodec') or '').startswith(native)]
+    if not candidates:
+        return None
+    best = min(candidates, key=lambda f: abs(f['abr'] - kbps))
+    if tolerance is not None and abs(best['abr'] - kbps) > kbps * tolerance:
+        return None
+    return best
+
+
+class Transcoder:
+    """Runs streaming ffmpeg transcodes under a process-wide concurrency cap."""
+    
+    _instance = None
+    
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._lock = threading.Lock()
+            cls._instance._slots = None
+            cls._instance._running = 0
+        return cls._instance
+    
+    def _get_slots(self) -> threading.BoundedSemaphore:
+        """Create the process cap on first use (needs app context)."""
+        if self._slots is None:
+            with self._lock:
+                if self._slots is None:
+                    self.max_processes = current_app.config.get('TRANSCODE_MAX_PROCESSES') \
+                        or max((os.cpu_count() or 2) // 2, 1)
+                    self._slots = threading.BoundedSemaphore(self.max_processes)
+        return self._slots
+    
+    def available(self) -> bool:
+        """Whether transcoding is enabled and ffmpeg can be found."""
+        return current_app.config.get('TRANSCODE_ENABLED', True) and \
+            shutil.which(current_app.config.get('TRANSCODE_FFMPEG', 'ffmpeg')) is not None
+    
+    def acquire(self) -> bool:
+        """Reserve an ffmpeg slot, waiting up to TRANSCODE_QUEUE_TIMEOUT; pass it to transcode()."""
+        if self._get_slots().acquire(timeout=current_app.config.get('TRANSCODE_QUEUE_TIMEOUT', 2)):
+            return True
+        metrics.incr('transcode.busy')
+        return False
+    
+    def release(self):
+        self._slots.release()
+    
+    def transcode(self, source: Iterator[bytes], codec: str, kbps: int,
+                  on_close: Optional[Callable[[], None]] = None) -> 'TranscodeOutput':
+        """
+        Pipe `source` through ffmpeg; iterate the result for the encoded output.
+        
+        Must be called with a slot from acquire(). The output owns the slot
+        from then on and releases it, and calls `on_close`, once it is
+        exhausted or closed, including when it is closed without ever being
+        iterated.
+        """
+        spec = CODECS[codec]
+        cmd = [
+            current_app.config.get('TRANSCODE_FFMPEG', 'ffmpeg'),
+            '-hide_banner', '-loglevel', 'error',
+            '-i', 'pipe:0', '-vn', '-c:a', spec['encoder'], '-b:a', f'{kbps}k', '-f', spec['format'], 'pipe:1',
+        ]
+        return TranscodeOutput(self, cmd, source, on_close)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'running': self._running,
+            'max_processes': self.max_processes if self._slots else 0,
+        }
+
+
+class TranscodeOutput:
+    """Encoded output of one ffmpeg run, holding its slot until exhausted or closed."""
+    
+    def __init__(self, transcoder: Transcoder, cmd: List[str], source: Iterator[bytes],
+                 on_close: Optional[Callable[[], None]] = None):
+        self._transcoder = transcoder
+        self._cmd = cmd
+        self._source = source
+        self._on_close = on_close
+        self._chunks = None
+        self._finished = False
+        self._lock = threading.Lock()
+    
+    def __iter__(self) -> Iterator[bytes]:
+        if self._chunks is None:
+            self._chunks = self._run()
+        return self._chunks
+    
+    def close(self):
+        """Stop ffmpeg if it is running and give back the slot; safe to call more than once."""
+        if self._chunks is not None:
+            # Runs _run's cleanup if it was started
+            self._chunks.close()
+        self._finish()
+    
+    def _finish(self):
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+        try:
+            if self._on_close:
+                self._on_close()
+        finally:
+            self._transcoder.release()
+    
+    def _feed(self, proc):
+        try:
+            for chunk in self._source:
+                proc.stdin.write(chunk)
+        except (BrokenPipeError, ValueError):
+            # ffmpeg exited or the output side was closed
+            pass
+        finally:
+            close = getattr(self._source, 'close', None)
+            if close:
+                close()
+            try:
+                proc.stdin.close()
+            except (BrokenPipeError, OSError):
+                pass
+    
+    def _run(self) -> Iterator[bytes]:
+        transcoder = self._transcoder
+        try:
+            proc = subprocess.Popen(self._cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except BaseException:
+            self._finish()
+            raise
+        with transcoder._lock:
+            transcoder._running += 1
+        metrics.incr('transcode.started')
+        feeder = threading.Thread(target=self._feed, args=(proc,), name='transcode-feed', daemon=True)
+        feeder.start()
+        try:
+            while True:
+                data = proc.stdout.read1(64 * 1024)
+                if not data:
+                    break
+                yield data
+            if proc.wait() != 0:
+                raise TranscodeError(proc.stderr.read().decode(errors='replace').strip()[-500:])
+            metrics.incr('transcode.completed')
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+            proc.stdout.close()
+            proc.stderr.close()
+            feeder.join(timeout=5)
+            with transcoder._lock:
+                transcoder._running -= 1
+            self._finish()
+
+
+# Singleton instance
+transcoder = Transcoder()
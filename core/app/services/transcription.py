@@ -8,6 +8,9 @@ from typing import Optional, Dict, Any
 import yt_dlp
 from flask import current_app
 
+from .cache import cache, singleflight
+from .validation import is_valid_video_id
+
 
 class TranscriptionService:
     """Service for transcribing audio using Whisper AI."""
@@ -41,19 +44,40 @@ class TranscriptionService:
     
     def get_cached_lyrics(self, video_id: str) -> Optional[Dict[str, Any]]:
         """Get cached lyrics if available."""
+        if not is_valid_video_id(video_id):
+            return None
         cache_file = self._get_cache_dir() / f"{video_id}.json"
         if cache_file.exists():
             with open(cache_file, 'r', encoding='utf-8') as f:
                 return json.load(f)
-        return None
+        # Transcribed on another node
+        return cache.get(f"lyrics:{video_id}")
     
     def transcribe(self, video_id: str) -> Dict[str, Any]:
         """Transcribe a video's audio using Whisper AI."""
+        if not is_valid_video_id(video_id):
+            raise ValueError(f"Invalid video ID: {video_id}")
+        
         # Check cache first
         cached = self.get_cached_lyrics(video_id)
         if cached and cached.get('source') == 'whisper_ai':
             return cached
         
+        # Concurrent requests for the same video share one download + transcription,
+        # within this process and across nodes (other nodes wait for the result key)
+        wait_timeout = current_app.config.get('TRANSCRIBE_WAIT_TIMEOUT', 300)
+        return singleflight.do(
+            f"transcribe:{video_id}",
+            lambda: cache.load_with_lease(
+                f"lyrics:{video_id}", lambda: self._transcribe(video_id), 86400,
+                lease_ttl=current_app.config.get('TRANSCRIBE_LEASE_TTL', 600),
+                wait_timeout=wait_timeout
+            ),
+            wait_timeout
+        )
+    
+    def _transcribe(self, video_id: str) -> Dict[str, Any]:
+        """Download and transcribe a video's audio (uncached)."""
         cache_dir = self._get_cache_dir()
         cache_dir.mkdir(parents=True, exist_ok=True)
         
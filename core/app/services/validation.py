@@ -0,0 +1,48 @@
+"""
+Cheap syntactic validation of YouTube / YouTube Music identifiers.
+"""
+import re
+
+VIDEO_ID_RE = re.compile(r'^[A-Za-z0-9_-]{11}$')
+ARTIST_ID_RE = re.compile(r'^(UC|MPLA)[A-Za-z0-9_-]{10,64}$')
+ALBUM_ID_RE = re.compile(r'^MPRE[A-Za-z0-9_-]{5,64}$')
+
+# Upstream answers that mean the item is gone rather than a transient failure. Kept
+# narrow: looser phrases also appear in local or bot-check failures on playable videos
+# (yt-dlp's "Requested format is not available", "ffmpeg not found")
+_NOT_FOUND_HTTP_RE = re.compile(r'\bhttp(?: error)? (?:404|410)\b')
+_NOT_FOUND_MARKERS = (
+    'video unavailable', 'private video', 'has been removed', 'has been terminated',
+)
+# HTTP statuses of responses attached to upstream exceptions that mean the same
+_NOT_FOUND_STATUSES = (404, 410)
+
+
+def is_valid_video_id(video_id: str) -> bool:
+    """Check that a string looks like an 11-character YouTube video ID."""
+    return bool(video_id and VIDEO_ID_RE.match(video_id))
+
+
+def is_valid_artist_id(artist_id: str) -> bool:
+    """Check that a string looks like a channel (UC...) or artist browse ID."""
+    return bool(artist_id and ARTIST_ID_RE.match(artist_id))
+
+
+def is_valid_album_id(album_id: str) -> bool:
+    """Check that a string looks like an album browse ID (MPREb_...)."""
+    return bool(album_id and ALBUM_ID_RE.match(album_id))
+
+
+def is_not_found_error(error: Exception) -> bool:
+    """
+    Classify an upstream exception as "not found" (vs. transient).
+    
+    Only an explicit answer from upstream counts. Anything else, including
+    the KeyError/IndexError of a page ytmusicapi could not parse, is
+    transient: a layout change must not mark every ID missing for minutes.
+    """
+    status = getattr(getattr(error, 'response', None), 'status_code', None)
+    if status is not None:
+        return status in _NOT_FOUND_STATUSES
+    message = str(error).lower()
+    return bool(_NOT_FOUND_HTTP_RE.search(message)) or any(marker in message for marker in _NOT_FOUND_MARKERS)
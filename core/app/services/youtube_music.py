@@ -1,15 +1,33 @@
 """
 YouTube Music service wrapper.
 """
-from typing import Optional, List, Dict, Any
+import base64
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Dict, Any, Callable, Tuple
+import time
 
 from ytmusicapi import YTMusic
 from flask import current_app
-import yt_dlp
 import threading
 import requests
 
-from .cache import cache
+from .audio_cache import audio_cache, parse_content_range, parse_range
+from .cache import cache, make_key, normalize_query
+from .head_cache import head_cache
+from .metrics import metrics
+from .resolver import resolver, ResolverBusy
+from . import seek_index
+from .transcoder import transcoder, CODECS, DEFAULT_CODEC, TranscodeError, pick_native, variant_key
+from .validation import is_valid_video_id, is_valid_artist_id, is_valid_album_id, is_not_found_error
+
+
+class UpstreamError(Exception):
+    """Transient failure talking to YouTube / YouTube Music."""
+
+
+# googlevideo answers these once a signed URL has expired or been revoked
+STALE_URL_STATUSES = (403, 410)
 
 
 class YouTubeMusicService:
@@ -17,6 +35,9 @@ class YouTubeMusicService:
     
     _instance = None
     _ytmusic = None
+    _head_executor = None
+    _head_executor_lock = threading.Lock()
+    _download_executor = None
     
     def __new__(cls):
         if cls._instance is None:
@@ -57,56 +78,88 @@ class YouTubeMusicService:
             }
         }
     
+    def _lookup(self, kind: str, item_id: str, load: Callable[[], Any]) -> Any:
+        """
+        Run an upstream lookup behind a short-lived negative cache.
+        
+        Returns None for items upstream reports as missing and raises
+        UpstreamError for transient failures; both outcomes are remembered
+        so repeated requests for the same ID don't reach upstream.
+        """
+        missing_key = make_key('missing', kind, item_id)
+        status = cache.get(missing_key)
+        if status == 'not_found':
+            return None
+        if status == 'error':
+            raise UpstreamError(f"Upstream unavailable for {kind} {item_id}, retry shortly")
+        
+        try:
+            return load()
+        except (ResolverBusy, TimeoutError):
+            # Local overload or a wait on our side, not an upstream answer; don't remember it
+            raise
+        except Exception as e:
+            if is_not_found_error(e):
+                metrics.incr(f'negative_cache.{kind}.not_found')
+                cache.set(missing_key, 'not_found', current_app.config.get('NEGATIVE_CACHE_TTL', 600))
+                return None
+            metrics.incr(f'negative_cache.{kind}.error')
+            cache.set(missing_key, 'error', current_app.config.get('NEGATIVE_CACHE_ERROR_TTL', 30))
+            raise UpstreamError(f"Upstream error for {kind} {item_id}: {e}") from e
+    
     def search(self, query: str, limit: int = 20) -> List[Dict[str, Any]]:
         """Search for songs."""
-        # Check cache first
-        cache_key = f"search:{query}:{limit}"
-        cached_result = cache.get(cache_key)
-        if cached_result:
-            return cached_result
+        normalized = normalize_query(query)
+        # One entry per query holding the largest result set fetched so far;
+        # smaller limits are served by slicing it
+        largest = {'limit': current_app.config.get('SEARCH_MIN_FETCH_LIMIT', 20)}
         
-        results = self._ytmusic.search(query, filter='songs', limit=limit)
-        formatted = [self._format_track(track) for track in results]
+        def covers(entry):
+            largest['limit'] = max(largest['limit'], entry['limit'])
+            # A result shorter than its limit is exhaustive
+            return entry['limit'] >= limit or len(entry['tracks']) < entry['limit']
         
-        # Cache for 5 minutes
-        cache.set(cache_key, formatted, current_app.config.get('CACHE_TTL_SEARCH', 300))
+        def load():
+            fetch_limit = max(limit, largest['limit'])
+            results = self._ytmusic.search(normalized, filter='songs', limit=fetch_limit)
+            return {
+                'limit': fetch_limit,
+                'tracks': [self._format_track(track) for track in results]
+            }
         
-        return formatted
+        # Cache for 5 minutes
+        entry = cache.get_or_load(make_key('search', normalized), load,
+                                  current_app.config.get('CACHE_TTL_SEARCH', 300), accept=covers)
+        return entry['tracks'][:limit]
     
     def get_recommendations(self, video_id: str, limit: int = 20) -> List[Dict[str, Any]]:
         """Get song recommendations based on a video."""
-        cache_key = f"recommendations:{video_id}:{limit}"
-        cached_result = cache.get(cache_key)
-        if cached_result:
-            return cached_result
-        
-        watch_playlist = self._ytmusic.get_watch_playlist(videoId=video_id, limit=limit)
-        
-        if not watch_playlist or 'tracks' not in watch_playlist:
+        if not is_valid_video_id(video_id):
             return []
         
-        tracks = []
-        for track in watch_playlist['tracks']:
-            track_id = track.get('videoId')
-            if track_id and track_id != video_id:
-                tracks.append(self._format_track(track))
+        def load():
+            watch_playlist = self._ytmusic.get_watch_playlist(videoId=video_id, limit=limit)
+            
+            if not watch_playlist or 'tracks' not in watch_playlist:
+                return []
+            
+            tracks = []
+            for track in watch_playlist['tracks']:
+                track_id = track.get('videoId')
+                if track_id and track_id != video_id:
+                    tracks.append(self._format_track(track))
+            return tracks
         
         # Cache for 30 minutes
-        cache.set(cache_key, tracks, current_app.config.get('CACHE_TTL_RECOMMENDATIONS', 1800))
-        
-        return tracks
+        return cache.get_or_load(f"recommendations:{video_id}:{limit}", load,
+                                 current_app.config.get('CACHE_TTL_RECOMMENDATIONS', 1800))
     
     def get_artist(self, artist_id: str) -> Optional[Dict[str, Any]]:
         """Get artist information."""
-        cache_key = f"artist:{artist_id}"
-        cached_result = cache.get(cache_key)
-        if cached_result:
-            return cached_result
-        
-        try:
+        def load():
             artist = self._ytmusic.get_artist(artist_id)
             
-            result = {
+            return {
                 'id': artist_id,
                 'name': artist.get('name'),
                 'description': artist.get('description'),
@@ -121,26 +174,25 @@ class YouTubeMusicService:
                     'images': [{'url': thumb.get('url')} for thumb in album.get('thumbnails', [])]
                 } for album in artist.get('albums', {}).get('results', [])[:10]]
             }
-            
+        
+        if not is_valid_artist_id(artist_id):
+            return None
+        
+        try:
             # Cache for 1 hour
-            cache.set(cache_key, result, current_app.config.get('CACHE_TTL_ARTIST', 3600))
-            
-            return result
-        except Exception as e:
+            return self._lookup('artist', artist_id, lambda: cache.get_or_load(
+                f"artist:{artist_id}", load, current_app.config.get('CACHE_TTL_ARTIST', 3600)
+            ))
+        except UpstreamError as e:
             current_app.logger.error(f"Error getting artist {artist_id}: {e}")
-            return None
+            raise
     
     def get_album(self, album_id: str) -> Optional[Dict[str, Any]]:
         """Get album information."""
-        cache_key = f"album:{album_id}"
-        cached_result = cache.get(cache_key)
-        if cached_result:
-            return cached_result
-        
-        try:
+        def load():
             album = self._ytmusic.get_album(album_id)
             
-            result = {
+            return {
                 'id': album_id,
                 'name': album.get('title'),
                 'artists': [{'name': artist.get('name'), 'id': artist.get('id')} 
@@ -152,23 +204,22 @@ class YouTubeMusicService:
                           for thumb in album.get('thumbnails', [])],
                 'tracks': [self._format_track(track) for track in album.get('tracks', [])]
             }
-            
+        
+        if not is_valid_album_id(album_id):
+            return None
+        
+        try:
             # Cache for 1 hour
-            cache.set(cache_key, result, current_app.config.get('CACHE_TTL_ALBUM', 3600))
-            
-            return result
-        except Exception as e:
+            return self._lookup('album', album_id, lambda: cache.get_or_load(
+                f"album:{album_id}", load, current_app.config.get('CACHE_TTL_ALBUM', 3600)
+            ))
+        except UpstreamError as e:
             current_app.logger.error(f"Error getting album {album_id}: {e}")
-            return None
+            raise
     
     def get_trending(self, region: str = 'US') -> List[Dict[str, Any]]:
         """Get trending songs."""
-        cache_key = f"trending:{region}"
-        cached_result = cache.get(cache_key)
-        if cached_result:
-            return cached_result
-        
-        try:
+        def load():
             # Get charts
             charts = self._ytmusic.get_charts(region)
             
@@ -177,23 +228,18 @@ class YouTubeMusicService:
                 items = charts['songs'].get('items', [])
                 for item in items[:50]:
                     trending_tracks.append(self._format_track(item))
-            
-            # Cache for 30 minutes
-            cache.set(cache_key, trending_tracks, 1800)
-            
             return trending_tracks
+        
+        try:
+            # Cache for 30 minutes
+            return cache.get_or_load(f"trending:{region}", load, 1800)
         except Exception as e:
             current_app.logger.error(f"Error getting trending: {e}")
             return []
     
     def get_genres(self) -> List[Dict[str, Any]]:
         """Get available mood/genre categories."""
-        cache_key = "genres"
-        cached_result = cache.get(cache_key)
-        if cached_result:
-            return cached_result
-        
-        try:
+        def load():
             mood_categories = self._ytmusic.get_mood_categories()
             
             genres = []
@@ -204,152 +250,750 @@ class YouTubeMusicService:
                         'name': playlist.get('title'),
                         'category': category
                     })
-            
-            # Cache for 24 hours
-            cache.set(cache_key, genres, 86400)
-            
             return genres
+        
+        try:
+            # Cache for 24 hours
+            return cache.get_or_load("genres", load, 86400)
         except Exception as e:
             current_app.logger.error(f"Error getting genres: {e}")
             return []
     
     def get_genre_playlists(self, params: str) -> List[Dict[str, Any]]:
         """Get playlists for a mood/genre."""
-        cache_key = f"genre_playlists:{params}"
-        cached_result = cache.get(cache_key)
-        if cached_result:
-            return cached_result
-        
-        try:
+        def load():
             playlists = self._ytmusic.get_mood_playlists(params)
             
-            result = [{
+            return [{
                 'id': p.get('playlistId'),
                 'name': p.get('title'),
                 'description': p.get('subtitle'),
                 'images': [{'url': thumb.get('url')} for thumb in p.get('thumbnails', [])]
             } for p in playlists]
-            
+        
+        try:
             # Cache for 1 hour
-            cache.set(cache_key, result, 3600)
-            
-            return result
+            return cache.get_or_load(make_key('genre_playlists', params), load, 3600)
         except Exception as e:
             current_app.logger.error(f"Error getting genre playlists: {e}")
             return []
+
     def get_streaming_url(self, video_id: str) -> Optional[Dict[str, Any]]:
-        """Get track streaming info using yt-dlp."""
+        """Get track streaming info from the shared resolver."""
+        if not is_valid_video_id(video_id):
+            return None
+        
         try:
-            ydl_opts = {
-                'format': 'bestaudio/best',
-                'quiet': True,
-                'no_warnings': True,
-                'extract_flat': False,
-            }
-            
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(f'https://music.youtube.com/watch?v={video_id}', download=False)
-                return {
-                    'videoId': video_id,
-                    'audioUrl': info.get('url'),
-                    'title': info.get('title'),
-                    'duration': info.get('duration')
-                }
+            info = self._lookup('track', video_id, lambda: resolver.resolve(video_id))
         except Exception as e:
             current_app.logger.error(f"Error getting streaming URL for {video_id}: {e}")
             return None
+        if not info:
+            return None
+        # Fresh dict: routes add fields to it
+        return {
+            'videoId': video_id,
+            'audioUrl': info.get('audio_url'),
+            'title': info.get('title'),
+            'duration': info.get('duration')
+        }
 
     # Thread-local storage for reuse
     _local = threading.local()
 
-    def _get_resources(self):
-        """Get thread-local YDL and Session to avoid re-init overhead."""
-        if not hasattr(self._local, 'ydl'):
-            # Pre-initialize YDL with fast options
-            ydl_opts = {
-                'format': 'bestaudio[ext=m4a]/bestaudio[ext=webm]/bestaudio/best',
-                'quiet': True,
-                'no_warnings': True,
-                'extract_flat': False,
-                'skip_download': True,
-                'force_ipv4': True,
-                'extractor_args': {'youtube': {'player_client': ['android', 'ios']}},
-            }
-            self._local.ydl = yt_dlp.YoutubeDL(ydl_opts)
-            
+    def _get_session(self) -> requests.Session:
+        """Get a thread-local Session to keep upstream connections alive."""
         if not hasattr(self._local, 'session'):
             # Persist TCP connections
             self._local.session = requests.Session()
-            
-        return self._local.ydl, self._local.session
+        return self._local.session
 
-    def stream_track(self, video_id: str, range_header: str = None):
-        """Get a generator and headers for streaming directly from YouTube."""
-        try:
-            # Check cache for audio URL
-            cache_key = f"stream_url:{video_id}"
-            audio_url = cache.get(cache_key)
-            
-            ydl, session = self._get_resources()
-            
-            if not audio_url:
-                # Use persistent YDL instance
-                info = ydl.extract_info(f'https://www.youtube.com/watch?v={video_id}', download=False)
+    def _get_audio_url(self, video_id: str, format_id: Optional[str] = None) -> Optional[str]:
+        """Get the best audio URL for a video, or that of one format, from the shared resolver."""
+        info = self._lookup('track', video_id, lambda: resolver.resolve(video_id))
+        if not info:
+            return None
+        if format_id:
+            return next((f['url'] for f in info['formats'] if f['format_id'] == format_id), None)
+        return info.get('audio_url')
+
+    def _fetch_upstream(self, app, session, video_id: str, audio_url: str, headers: Dict[str, str],
+                        format_id: Optional[str] = None):
+        """GET an audio URL; if upstream rejects it as stale, re-resolve and retry once."""
+        resp = session.get(audio_url, headers=headers, stream=True, timeout=30)
+        if resp.status_code not in STALE_URL_STATUSES:
+            return resp, audio_url
+        
+        resp.close()
+        metrics.incr('stream.stale_url')
+        with app.app_context():
+            resolver.invalidate(video_id)
+            audio_url = self._get_audio_url(video_id, format_id)
+        if not audio_url:
+            raise UpstreamError(f"No audio URL for {video_id}")
+        return session.get(audio_url, headers=headers, stream=True, timeout=30), audio_url
+
+    def _stream_sparse(self, video_id: str, entry: Dict[str, Any], audio_url: str, session,
+                       start: int, end: int, ranged: bool):
+        """Serve [start, end] from cached extents, fetching only the holes upstream."""
+        size = entry['size']
+        response_headers = {
+            'Content-Type': entry['content_type'],
+            'Accept-Ranges': 'bytes',
+            'Content-Length': str(end - start + 1),
+            'X-Cache': 'PARTIAL',
+        }
+        if ranged:
+            response_headers['Content-Range'] = f"bytes {start}-{end}/{size}"
+        
+        runs = audio_cache.plan(entry, start, end)
+        app = current_app._get_current_object()
+        logger = current_app.logger
+        
+        def generate():
+            nonlocal audio_url
+            for run_start, run_end, cached in runs:
+                if cached:
+                    yield from audio_cache.read(entry, run_start, run_end)
+                    continue
                 
-                audio_url = info.get('url')
-                if not audio_url:
-                    if info.get('requested_formats'):
-                        for fmt in info['requested_formats']:
-                            if fmt.get('acodec') != 'none':
-                                audio_url = fmt.get('url')
-                                break
-                    elif info.get('formats'):
-                        for fmt in info['formats']:
-                            if fmt.get('acodec') != 'none' and fmt.get('url'):
-                                audio_url = fmt.get('url')
-                                break
+                try:
+                    resp, audio_url = self._open_range(app, session, video_id, audio_url, run_start, run_end, size)
+                except Exception as e:
+                    logger.error(f"Upstream refused range {run_start}-{run_end} for {entry['key']}: {e}")
+                    return
                 
-                if audio_url:
-                    cache.set(cache_key, audio_url, 3600)
-            
+                yield from self._relay(app, video_id, audio_url, resp, run_start, run_end,
+                                       audio_cache.writer(entry, run_start), size=size)
+        
+        return generate, response_headers, 206 if ranged else 200
+
+    def stream_track(self, video_id: str, range_header: str = None, download: bool = False,
+                     variant: Optional[Tuple[Optional[str], int]] = None, seek: Optional[float] = None):
+        """
+        Get a generator and headers for streaming directly from YouTube.
+        
+        With `download`, whole-file requests are fetched as parallel upstream
+        range segments instead of one throttled connection. A `variant`
+        (codec or None, kbps) from transcoder.parse_target selects a lower
+        bitrate or another codec. `seek` starts playback at a time in seconds.
+        """
+        if not is_valid_video_id(video_id):
+            return None, None, 400
+        
+        if variant:
+            return self._stream_variant(video_id, range_header, *variant)
+        if seek:
+            return self._stream_seek(video_id, seek)
+        
+        # Downloads are whole files and not plays
+        download = download and not range_header and current_app.config.get('STREAM_DOWNLOAD_ENABLED', True)
+        use_head_cache = head_cache.enabled() and not download
+        from_start = not range_header or range_header.replace(' ', '').startswith('bytes=0-')
+        popular = use_head_cache and from_start and head_cache.record_play(video_id)
+        
+        use_audio_cache = audio_cache.enabled()
+        entry = audio_cache.lookup(video_id) if use_audio_cache else None
+        if entry:
+            try:
+                byte_range = parse_range(range_header, entry['size'])
+            except ValueError:
+                return audio_cache.serve(entry, range_header)
+            start, end = byte_range or (0, entry['size'] - 1)
+            if audio_cache.covers(entry, start, end):
+                return audio_cache.serve(entry, range_header)
+        
+        if use_head_cache:
+            head = head_cache.get(video_id)
+            streamed = head and self._stream_from_head(video_id, head, range_header, use_audio_cache)
+            if streamed:
+                return streamed
+        
+        try:
+            audio_url = self._get_audio_url(video_id)
             if not audio_url:
                 return None, None, 404
             
-            upstream_headers = {}
-            if range_header:
-                upstream_headers['Range'] = range_header
+            session = self._get_session()
             
-            # Use persistent Session
-            resp = session.get(audio_url, headers=upstream_headers, stream=True, timeout=30)
+            if download:
+                streamed = self._stream_segmented(video_id, audio_url, entry, use_audio_cache)
+                if streamed:
+                    return streamed
             
-            content_type = resp.headers.get('Content-Type', 'audio/webm')
-            response_headers = {
-                'Content-Type': content_type,
-                'Accept-Ranges': 'bytes',
-            }
+            if entry:
+                # Size is known: mix cached extents with upstream fetches for the holes
+                generate, response_headers, status_code = self._stream_sparse(
+                    video_id, entry, audio_url, session, start, end, byte_range is not None
+                )
+                if popular and start == 0:
+                    generate = self._capture_head(video_id, entry['content_type'], entry['size'], generate)
+                return generate, response_headers, status_code
             
-            status_code = resp.status_code
-            if range_header and status_code == 206:
-                response_headers['Content-Range'] = resp.headers.get('Content-Range')
+            return self._passthrough(video_id, audio_url, session, range_header, use_audio_cache, popular)
+                
+        except Exception as e:
+            current_app.logger.error(f"Error streaming track {video_id}: {e}")
+            return None, None, 500
+
+    def _passthrough(self, video_id: str, audio_url: str, session, range_header: Optional[str],
+                     use_audio_cache: bool, popular: bool = False, format_id: Optional[str] = None):
+        """
+        Relay one upstream request, teeing whatever part of the file it is
+        into the audio cache (under `format_id` when not the default audio).
+        """
+        upstream_headers = {}
+        if range_header:
+            upstream_headers['Range'] = range_header
+        
+        resp, audio_url = self._fetch_upstream(
+            current_app._get_current_object(), session, video_id, audio_url, upstream_headers, format_id
+        )
+        
+        content_type = resp.headers.get('Content-Type', 'audio/webm')
+        response_headers = {
+            'Content-Type': content_type,
+            'Accept-Ranges': 'bytes',
+        }
+        
+        status_code = resp.status_code
+        if range_header and status_code == 206:
+            response_headers['Content-Range'] = resp.headers.get('Content-Range')
+            response_headers['Content-Length'] = resp.headers.get('Content-Length')
+        else:
+            if 'Content-Length' in resp.headers:
                 response_headers['Content-Length'] = resp.headers.get('Content-Length')
+            status_code = 200
+        
+        writer = None
+        offset, total = self._body_position(resp)
+        if use_audio_cache and total:
+            entry = audio_cache.begin(video_id, content_type, total, format_id or 'default')
+            if entry:
+                writer = audio_cache.writer(entry, offset)
+        
+        length = resp.headers.get('Content-Length')
+        last = offset + int(length) - 1 if length and length.isdigit() else None
+        app = current_app._get_current_object()
+        
+        def generate():
+            return self._relay(app, video_id, audio_url, resp, offset, last, writer, format_id, total)
+        
+        def close():
+            # The relay closes both itself; this covers a body that is never read
+            resp.close()
+            if writer:
+                writer.close()
+        
+        generate.close = close
+        if popular and offset == 0 and total:
+            generate = self._capture_head(video_id, content_type, total, generate)
+        return generate, response_headers, status_code
+
+    def _stream_seek(self, video_id: str, seconds: float):
+        """
+        Start a stream at the indexed fragment at or before `seconds`.
+        
+        The body is the file's header followed by the file from that
+        fragment on, so it plays as a file of its own; X-Seek-Time says
+        where it really starts.
+        """
+        try:
+            index = self._seek_index(video_id)
+        except Exception as e:
+            current_app.logger.warning(f"Could not index {video_id} for seeking: {e}")
+            index = None
+        if not index:
+            metrics.incr('stream.seek.unindexed')
+            return self.stream_track(video_id)
+        
+        start_time, offset = seek_index.locate(index, seconds)
+        generate, headers, status = self.stream_track(video_id, f"bytes={offset}-")
+        content_range = parse_content_range((headers or {}).get('Content-Range'))
+        if status != 206 or not content_range or content_range[2] != index['size']:
+            if generate and status in (200, 206):
+                # The file changed since it was indexed; serve it from the start
+                if getattr(generate, 'close', None):
+                    generate.close()
+                cache.delete(make_key('seek_index', video_id))
+                return self.stream_track(video_id)
+            return generate, headers, status
+        
+        header = index['header']
+        metrics.incr('stream.seek')
+        
+        def seeking():
+            yield header
+            yield from generate()
+        
+        if getattr(generate, 'close', None):
+            seeking.close = generate.close
+        response_headers = {
+            'Content-Type': headers['Content-Type'],
+            'Content-Length': str(len(header) + index['size'] - offset),
+            'Accept-Ranges': 'none',
+            'X-Seek-Time': f"{start_time:.3f}",
+        }
+        if 'X-Cache' in headers:
+            response_headers['X-Cache'] = headers['X-Cache']
+        return seeking, response_headers, 200
+
+    def _seek_index(self, video_id: str) -> Optional[Dict[str, Any]]:
+        """The seek index of a track's audio, read from its head once and then cached."""
+        key = make_key('seek_index', video_id)
+        cached = cache.get(key)
+        if cached is not None:
+            metrics.incr('stream.seek_index.hit')
+            return dict(cached, header=base64.b64decode(cached['header'])) if cached.get('points') else None
+        metrics.incr('stream.seek_index.miss')
+        
+        audio_url = self._get_audio_url(video_id)
+        if not audio_url:
+            return None
+        app = current_app._get_current_object()
+        session = self._get_session()
+        
+        def fetch(start, end):
+            resp, _ = self._open_range(app, session, video_id, audio_url, start, end, size)
+            try:
+                return resp.content
+            finally:
+                resp.close()
+        
+        probe = current_app.config.get('SEEK_INDEX_PROBE_BYTES', 64 * 1024)
+        entry = audio_cache.lookup(video_id) if audio_cache.enabled() else None
+        if entry and audio_cache.covers(entry, 0, min(probe, entry['size']) - 1):
+            size = entry['size']
+            head = b''.join(audio_cache.read(entry, 0, min(probe, size) - 1))
+        else:
+            resp, _ = self._open_range(app, session, video_id, audio_url, 0, probe - 1)
+            try:
+                head, size = resp.content, parse_content_range(resp.headers.get('Content-Range'))[2]
+            finally:
+                resp.close()
+        
+        index = seek_index.parse_index(head, size, fetch)
+        if index is None:
+            # Also a truncated or unparsed head, so only briefly
+            cache.set(key, {'points': []}, current_app.config.get('SEEK_INDEX_MISS_TTL', 300))
+            return None
+        cache.set(key, dict(index, header=base64.b64encode(index['header']).decode('ascii')),
+                  current_app.config.get('SEEK_INDEX_TTL', 86400))
+        return index
+
+    def _stream_variant(self, video_id: str, range_header: Optional[str], codec: Optional[str], kbps: int):
+        """
+        Serve a bitrate/codec variant: the closest native format when one is
+        within TRANSCODE_NATIVE_TOLERANCE of the target, else an ffmpeg
+        transcode of the best audio, cached once complete.
+        """
+        try:
+            info = self._lookup('track', video_id, lambda: resolver.resolve(video_id))
+            if not info:
+                return None, None, 404
+            formats = info.get('formats') or []
+            
+            native = pick_native(formats, codec, kbps, current_app.config.get('TRANSCODE_NATIVE_TOLERANCE', 0.35))
+            if native:
+                metrics.incr('stream.variant.native')
+                return self._stream_native(video_id, native, range_header)
+            
+            codec = codec or DEFAULT_CODEC
+            use_audio_cache = audio_cache.enabled()
+            entry = audio_cache.lookup(video_id, variant_key(codec, kbps)) if use_audio_cache else None
+            if entry and entry['complete']:
+                metrics.incr('stream.variant.cached')
+                return audio_cache.serve(entry, range_header)
+            
+            if transcoder.available() and transcoder.acquire():
+                return self._stream_transcoded(video_id, info, codec, kbps, use_audio_cache)
+            
+            # No ffmpeg or no free slot: the nearest native bitrate in any codec beats failing
+            native = pick_native(formats, None, kbps)
+            if not native:
+                return None, None, 503
+            metrics.incr('stream.variant.fallback')
+            return self._stream_native(video_id, native, range_header)
+        
+        except Exception as e:
+            current_app.logger.error(f"Error streaming {video_id} at {codec or 'any'}/{kbps}k: {e}")
+            return None, None, 500
+
+    def _stream_native(self, video_id: str, fmt: Dict[str, Any], range_header: Optional[str]):
+        """Serve one native format, cached under its format ID."""
+        format_id = fmt['format_id']
+        use_audio_cache = audio_cache.enabled()
+        entry = audio_cache.lookup(video_id, format_id) if use_audio_cache else None
+        if entry:
+            try:
+                byte_range = parse_range(range_header, entry['size'])
+            except ValueError:
+                return audio_cache.serve(entry, range_header)
+            start, end = byte_range or (0, entry['size'] - 1)
+            if audio_cache.covers(entry, start, end):
+                return audio_cache.serve(entry, range_header)
+        return self._passthrough(video_id, fmt['url'], self._get_session(), range_header, use_audio_cache,
+                                 format_id=format_id)
+
+    def _stream_transcoded(self, video_id: str, info: Dict[str, Any], codec: str, kbps: int,
+                           use_audio_cache: bool):
+        """
+        Pipe the best audio through ffmpeg, holding a slot taken by the caller.
+        
+        The output length is unknown up front, so it is sent whole without
+        ranges and only added to the audio cache once ffmpeg succeeds. The
+        returned generator has a close() that frees the slot and the upstream
+        response even if the body is never read (e.g. for HEAD).
+        """
+        app = current_app._get_current_object()
+        try:
+            resp, audio_url = self._fetch_upstream(app, self._get_session(), video_id, info['audio_url'], {})
+            if resp.status_code != 200:
+                resp.close()
+                raise UpstreamError(f"Upstream returned HTTP {resp.status_code} for {video_id}")
+            length = resp.headers.get('Content-Length')
+            last = int(length) - 1 if length and length.isdigit() else None
+            relay = self._relay(app, video_id, audio_url, resp, 0, last, size=None if last is None else last + 1)
+            output = transcoder.transcode(relay, codec, kbps, on_close=resp.close)
+        except Exception:
+            transcoder.release()
+            raise
+        
+        content_type = CODECS[codec]['content_type']
+        key = variant_key(codec, kbps)
+        
+        def generate():
+            spool = audio_cache.spool(video_id, content_type, key) if use_audio_cache else None
+            try:
+                for chunk in output:
+                    if spool:
+                        spool.write(chunk)
+                    yield chunk
+                if spool:
+                    spool.commit()
+            except TranscodeError as e:
+                app.logger.error(f"Transcode of {video_id} to {key} failed: {e}")
+            finally:
+                output.close()
+                if spool:
+                    spool.abort()
+        
+        generate.close = output.close
+        headers = {'Content-Type': content_type, 'Accept-Ranges': 'none', 'X-Transcode': key}
+        return generate, headers, 200
+
+    def _stream_segmented(self, video_id: str, audio_url: str, entry: Optional[Dict[str, Any]],
+                          use_audio_cache: bool):
+        """
+        Serve a whole file as segments fetched over several upstream connections.
+        
+        Segments are fetched up to STREAM_DOWNLOAD_PARALLELISM at a time and
+        yielded in order; each is written to the audio cache as it lands, and
+        extents already cached are read from disk instead.
+        """
+        app = current_app._get_current_object()
+        logger = current_app.logger
+        segment_size = current_app.config.get('STREAM_DOWNLOAD_SEGMENT_BYTES', 1024 * 1024)
+        parallelism = current_app.config.get('STREAM_DOWNLOAD_PARALLELISM', 4)
+        executor = self._get_download_executor()
+        urls = [audio_url]
+        first = b''
+        
+        if entry:
+            size, content_type = entry['size'], entry['content_type']
+        else:
+            # The first segment also tells us the size and type of the file
+            resp, urls[0] = self._fetch_upstream(
+                app, self._get_session(), video_id, audio_url, {'Range': f"bytes=0-{segment_size - 1}"}
+            )
+            try:
+                offset, size = self._body_position(resp)
+                if resp.status_code != 206 or offset != 0 or not size:
+                    return None
+                content_type = resp.headers.get('Content-Type', 'audio/webm')
+                first = resp.content
+            finally:
+                resp.close()
+            entry = audio_cache.begin(video_id, content_type, size) if use_audio_cache else None
+            if entry:
+                writer = audio_cache.writer(entry, 0)
+                writer.write(first)
+                writer.close()
+        
+        runs = audio_cache.plan(entry, len(first), size - 1) if entry else [(len(first), size - 1, False)]
+        parts = []
+        for run_start, run_end, cached in runs:
+            if cached:
+                parts.append((run_start, run_end, True))
             else:
-                if 'Content-Length' in resp.headers:
-                    response_headers['Content-Length'] = resp.headers.get('Content-Length')
-                status_code = 200
+                parts.extend((s, min(s + segment_size, run_end + 1) - 1, False)
+                             for s in range(run_start, run_end + 1, segment_size))
+        
+        def fetch(start, end):
+            with app.app_context():
+                started = time.perf_counter()
+                retries = app.config.get('STREAM_RESUME_RETRIES', 3)
+                data = bytearray()
+                while True:
+                    # A dropped segment is re-requested from the first missing byte
+                    try:
+                        resp, urls[0] = self._open_range(
+                            app, self._get_session(), video_id, urls[0], start + len(data), end, size
+                        )
+                        try:
+                            for chunk in resp.iter_content(chunk_size=64 * 1024):
+                                data += chunk
+                        finally:
+                            resp.close()
+                        if len(data) == end - start + 1:
+                            break
+                        error = UpstreamError(f"Short segment {start}-{end} of {video_id}: {len(data)} bytes")
+                    except requests.RequestException as e:
+                        error = e
+                    if retries <= 0:
+                        metrics.incr('stream.resume_failed')
+                        raise error
+                    retries -= 1
+                    metrics.incr('stream.resume')
+                if entry:
+                    writer = audio_cache.writer(entry, start)
+                    writer.write(data)
+                    writer.close()
+                metrics.observe('stream.segment_ms', (time.perf_counter() - started) * 1000)
+                return bytes(data)
+        
+        def generate():
+            pending = deque()
+            queued = iter(parts)
+            
+            def fill():
+                while sum(1 for _, future in pending if future) < parallelism:
+                    part = next(queued, None)
+                    if part is None:
+                        return
+                    start, end, cached = part
+                    pending.append((part, None if cached else executor.submit(fetch, start, end)))
             
-            def generate():
+            try:
+                if first:
+                    yield first
+                fill()
+                while pending:
+                    (start, end, cached), future = pending.popleft()
+                    if cached:
+                        yield from audio_cache.read(entry, start, end)
+                        continue
+                    try:
+                        data = future.result()
+                    except Exception as e:
+                        logger.error(f"Error downloading {start}-{end} of {video_id}: {e}")
+                        return
+                    fill()
+                    yield data
+            finally:
+                # Segments already in flight still land in the cache
+                for _, future in pending:
+                    if future:
+                        future.cancel()
+        
+        metrics.incr('stream.download')
+        response_headers = {
+            'Content-Type': content_type,
+            'Accept-Ranges': 'bytes',
+            'Content-Length': str(size),
+        }
+        return generate, response_headers, 200
+
+    def _get_download_executor(self) -> ThreadPoolExecutor:
+        """Shared pool fetching download segments (needs app context)."""
+        with self._head_executor_lock:
+            if self._download_executor is None:
+                YouTubeMusicService._download_executor = ThreadPoolExecutor(
+                    max_workers=current_app.config.get('STREAM_DOWNLOAD_WORKERS', 32),
+                    thread_name_prefix='stream-download',
+                )
+        return self._download_executor
+
+    def _stream_from_head(self, video_id: str, head, range_header: Optional[str], use_audio_cache: bool):
+        """Start playback from a cached head while the rest of the file is fetched in parallel."""
+        content_type, size, data = head
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            return None
+        start, end = byte_range or (0, size - 1)
+        if start >= len(data):
+            return None
+        
+        response_headers = {
+            'Content-Type': content_type,
+            'Accept-Ranges': 'bytes',
+            'Content-Length': str(end - start + 1),
+            'X-Cache': 'HEAD',
+        }
+        if byte_range is not None:
+            response_headers['Content-Range'] = f"bytes {start}-{end}/{size}"
+        
+        tail = None
+        writer = None
+        released = [False]
+        if end >= len(data):
+            # Resolve the URL and connect for the rest while the head plays
+            with self._head_executor_lock:
+                if self._head_executor is None:
+                    YouTubeMusicService._head_executor = ThreadPoolExecutor(
+                        max_workers=current_app.config.get('STREAM_HEAD_WORKERS', 16),
+                        thread_name_prefix='stream-tail',
+                    )
+            tail = self._head_executor.submit(
+                self._open_tail, current_app._get_current_object(), video_id, len(data), end, size
+            )
+            if use_audio_cache:
+                entry = audio_cache.begin(video_id, content_type, size)
+                if entry:
+                    writer = audio_cache.writer(entry, len(data))
+        logger = current_app.logger
+        
+        app = current_app._get_current_object()
+        
+        def release():
+            # Until the relay takes them over, the tail connection and the writer are ours to free
+            if released[0]:
+                return
+            released[0] = True
+            if tail is not None:
+                # Client left during the head (or never read it); drop the connection once it opens
+                tail.add_done_callback(lambda f: f.exception() is None and f.result()[0].close())
+            if writer:
+                writer.close()
+        
+        def generate():
+            try:
+                yield data[start:end + 1]
+                if tail is None:
+                    return
+                try:
+                    resp, audio_url = tail.result()
+                except Exception as e:
+                    logger.error(f"Error fetching the rest of {video_id} after its head: {e}")
+                    return
+                released[0] = True
+                yield from self._relay(app, video_id, audio_url, resp, len(data), end, writer, size=size)
+            finally:
+                release()
+        
+        generate.close = release
+        return generate, response_headers, 206 if byte_range is not None else 200
+
+    def _open_tail(self, app, video_id: str, offset: int, end: int, size: int):
+        """Open the upstream response for bytes [offset, end] of a file of known size: (resp, url)."""
+        with app.app_context():
+            audio_url = self._get_audio_url(video_id)
+            if not audio_url:
+                raise UpstreamError(f"No audio URL for {video_id}")
+            return self._open_range(app, self._get_session(), video_id, audio_url, offset, end, size)
+
+    def _open_range(self, app, session, video_id: str, audio_url: str, start: int,
+                    end: Optional[int] = None, size: Optional[int] = None, format_id: Optional[str] = None):
+        """
+        Open an upstream 206 response starting exactly at `start`: (resp, url).
+        
+        With `size`, the file upstream must still be that long; bytes of a
+        different file must not be spliced into a body or cache entry.
+        """
+        resp, audio_url = self._fetch_upstream(
+            app, session, video_id, audio_url, {'Range': f"bytes={start}-{'' if end is None else end}"}, format_id
+        )
+        content_range = parse_content_range(resp.headers.get('Content-Range'))
+        if resp.status_code != 206 or not content_range or content_range[0] != start:
+            resp.close()
+            raise UpstreamError(f"Upstream returned HTTP {resp.status_code} for {video_id} from byte {start}")
+        if size is not None and content_range[2] != size:
+            resp.close()
+            metrics.incr('stream.size_mismatch')
+            raise UpstreamError(f"Upstream size of {video_id} is {content_range[2]}, expected {size}")
+        return resp, audio_url
+
+    def _relay(self, app, video_id: str, audio_url: str, resp, start: int, end: Optional[int], writer=None,
+               format_id: Optional[str] = None, size: Optional[int] = None):
+        """
+        Yield an upstream body that starts at byte `start`, resuming after drops.
+        
+        If the connection fails, or closes before `end`, the rest is requested
+        with `Range: bytes=<position>-` (re-resolving a stale URL) and spliced
+        into the same body, up to STREAM_RESUME_RETRIES times. A resume whose
+        file is not `size` bytes long ends the body instead.
+        """
+        retries = app.config.get('STREAM_RESUME_RETRIES', 3)
+        position = start
+        try:
+            while True:
                 try:
                     for chunk in resp.iter_content(chunk_size=8192):
                         if chunk:
+                            if writer:
+                                writer.write(chunk)
+                            position += len(chunk)
                             yield chunk
-                finally:
-                    resp.close()
-            
-            return generate, response_headers, status_code
+                    if end is None or position > end:
+                        return
+                    error = UpstreamError(f"Upstream closed at byte {position} of {end + 1}")
+                except requests.RequestException as e:
+                    error = e
+                resp.close()
                 
-        except Exception as e:
-            current_app.logger.error(f"Error streaming track {video_id}: {e}")
-            return None, None, 500
+                if retries <= 0:
+                    metrics.incr('stream.resume_failed')
+                    app.logger.error(f"Gave up resuming {video_id} at byte {position}: {error}")
+                    return
+                retries -= 1
+                metrics.incr('stream.resume')
+                started = time.perf_counter()
+                try:
+                    resp, audio_url = self._open_range(
+                        app, self._get_session(), video_id, audio_url, position, end, size, format_id
+                    )
+                except Exception as e:
+                    metrics.incr('stream.resume_failed')
+                    app.logger.error(f"Could not resume {video_id} at byte {position} after {error}: {e}")
+                    return
+                metrics.observe('stream.resume_ms', (time.perf_counter() - started) * 1000)
+        finally:
+            resp.close()
+            if writer:
+                writer.close()
+
+    @staticmethod
+    def _capture_head(video_id: str, content_type: str, size: int, generate):
+        """Wrap a generator for a body starting at offset 0 so its first bytes fill the head cache."""
+        def capturing():
+            head = bytearray()
+            for chunk in generate():
+                if head is not None:
+                    head += chunk
+                    if len(head) >= head_cache.head_size:
+                        head_cache.put(video_id, content_type, size, head)
+                        head = None
+                yield chunk
+            if head is not None and len(head) == size:
+                # Whole file is smaller than a head
+                head_cache.put(video_id, content_type, size, head)
+        
+        if getattr(generate, 'close', None):
+            capturing.close = generate.close
+        return capturing
+
+    @staticmethod
+    def _body_position(resp):
+        """(offset, total size) of an upstream response body within the file."""
+        if resp.status_code == 200:
+            length = resp.headers.get('Content-Length')
+            return 0, int(length) if length and length.isdigit() else None
+        if resp.status_code == 206:
+            content_range = parse_content_range(resp.headers.get('Content-Range'))
+            if content_range:
+                return content_range[0], content_range[2]
+        return 0, None
 
 
 # Singleton instance
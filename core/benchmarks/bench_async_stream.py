@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Load test for the ASGI streaming proxy: thousands of concurrent listeners per process.
+
+Starts a paced fake googlevideo upstream and one uvicorn worker serving
+app.asgi, then opens many concurrent streams and reports time to first
+byte, completion and the server's threads and memory.
+
+Run with: python benchmarks/bench_async_stream.py [--streams 2000] [--size-kb 256] [--seconds 10]
+"""
+import argparse
+import asyncio
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent))
+
+VIDEO_ID = 'dQw4w9WgXcQ'
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def make_upstream():
+    """Fake googlevideo: BENCH_SIZE bytes paced over BENCH_SECONDS, honouring Range."""
+    size = int(os.environ['BENCH_SIZE'])
+    seconds = float(os.environ['BENCH_SECONDS'])
+    chunk = 16 * 1024
+    data = os.urandom(size)
+
+    async def upstream(scope, receive, send):
+        if scope['type'] != 'http':
+            return
+        headers = dict(scope['headers'])
+        start, end, status = 0, size - 1, 200
+        if b'range' in headers:
+            first, _, last = headers[b'range'].decode()[6:].partition('-')
+            start, end, status = int(first), int(last) if last else size - 1, 206
+        body = data[start:end + 1]
+        response_headers = [(b'content-type', b'audio/mp4'), (b'content-length', str(len(body)).encode())]
+        if status == 206:
+            response_headers.append((b'content-range', f'bytes {start}-{end}/{size}'.encode()))
+        await send({'type': 'http.response.start', 'status': status, 'headers': response_headers})
+        delay = seconds * chunk / size
+        for i in range(0, len(body), chunk):
+            await send({'type': 'http.response.body', 'body': body[i:i + chunk], 'more_body': True})
+            await asyncio.sleep(delay)
+        await send({'type': 'http.response.body', 'body': b''})
+
+    raise_fd_limit()
+    return upstream
+
+
+def make_app():
+    """The real ASGI app with only URL resolution pointed at the fake upstream."""
+    from app import create_app
+    from app.asgi import create_asgi_app
+    from app.services.resolver import resolver
+
+    raise_fd_limit()
+    flask_app = create_app()
+    flask_app.config.update(AUDIO_CACHE_ENABLED=False, STREAM_HEAD_ENABLED=False)
+    resolver._extract = lambda video_id: {
+        'video_id': video_id, 'title': None, 'duration': None, 'formats': [],
+        'audio_url': os.environ['BENCH_UPSTREAM_URL'],
+        'expires_at': time.time() + 3600, 'refresh_at': time.time() + 3300,
+    }
+    return create_asgi_app(flask_app)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def serve(factory: str, port: int, env: dict) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', '--factory', f'bench_async_stream:{factory}',
+         '--app-dir', str(BENCH_DIR), '--port', str(port), '--log-level', 'warning',
+         '--backlog', '8192', '--limit-concurrency', '100000'],
+        cwd=BENCH_DIR.parent, env=env
+    )
+
+
+def proc_status(pid: int) -> dict:
+    fields = {}
+    for line in Path(f'/proc/{pid}/status').read_text().splitlines():
+        key, _, value = line.partition(':')
+        fields[key] = value.strip()
+    return {'threads': int(fields['Threads']), 'rss_mb': int(fields['VmRSS'].split()[0]) / 1024}
+
+
+async def wait_ready(url: str):
+    import httpx
+    async with httpx.AsyncClient() as client:
+        for _ in range(100):
+            try:
+                await client.get(url, timeout=1)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f'{url} did not start')
+
+
+async def listener(client, url: str, started: float, results: list):
+    first_byte = None
+    received = 0
+    try:
+        async with client.stream('GET', url, headers={'X-API-Key': 'bench'}) as resp:
+            async for chunk in resp.aiter_raw():
+                if first_byte is None:
+                    first_byte = time.perf_counter() - started
+                received += len(chunk)
+        results.append((first_byte, received, None))
+    except Exception as e:
+        results.append((first_byte, received, type(e).__name__))
+
+
+async def run(args, app_url: str, server_pid: int):
+    import httpx
+    await wait_ready(app_url + '/api/v1/health')
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=0)
+    results = []
+    peak = {'threads': 0, 'rss_mb': 0}
+
+    async def sample():
+        while True:
+            status = proc_status(server_pid)
+            peak.update({k: max(peak[k], v) for k, v in status.items()})
+            await asyncio.sleep(0.5)
+
+    sampler = asyncio.ensure_future(sample())
+    async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(60, pool=None)) as client:
+        stream_url = f'{app_url}/api/v1/tracks/stream/{VIDEO_ID}'
+        started = time.perf_counter()
+        await asyncio.gather(*(listener(client, stream_url, started, results) for _ in range(args.streams)))
+        elapsed = time.perf_counter() - started
+    sampler.cancel()
+    return results, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--streams', type=int, default=2000, help='concurrent listeners')
+    parser.add_argument('--size-kb', type=int, default=256, help='track size')
+    parser.add_argument('--seconds', type=float, default=10, help='upstream pacing per track')
+    args = parser.parse_args()
+    raise_fd_limit()
+
+    upstream_port, app_port = free_port(), free_port()
+    env = dict(os.environ, BENCH_SIZE=str(args.size_kb * 1024), BENCH_SECONDS=str(args.seconds),
+               BENCH_UPSTREAM_URL=f'http://127.0.0.1:{upstream_port}/videoplayback')
+    upstream = serve('make_upstream', upstream_port, env)
+    server = serve('make_app', app_port, env)
+    try:
+        results, elapsed, peak = asyncio.run(run(args, f'http://127.0.0.1:{app_port}', server.pid))
+    finally:
+        for proc in (server, upstream):
+            proc.terminate()
+            proc.wait()
+
+    complete = [r for r in results if r[2] is None and r[1] == args.size_kb * 1024]
+    ttfb = sorted(r[0] for r in results if r[0] is not None)
+    errors = {}
+    for r in results:
+        if r[2]:
+            errors[r[2]] = errors.get(r[2], 0) + 1
+
+    print(f"{args.streams} concurrent streams of {args.size_kb} KB paced over {args.seconds:g} s")
+    print(f"  complete     {len(complete)}/{args.streams}  errors {errors or 'none'}")
+    print(f"  wall         {elapsed:.1f} s")
+    if ttfb:
+        print(f"  ttfb p50     {ttfb[len(ttfb) // 2] * 1000:.0f} ms")
+        print(f"  ttfb p99     {ttfb[int(len(ttfb) * 0.99)] * 1000:.0f} ms")
+    print(f"  server peak  {peak['threads']} threads, {peak['rss_mb']:.0f} MB RSS (one process)")
+
+
+if __name__ == '__main__':
+    main()
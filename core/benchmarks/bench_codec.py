@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Cache codec benchmark: bytes stored and encode/decode time per payload shape.
+
+Run with: python benchmarks/bench_codec.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app.services.codec import CacheCodec, available_compressors, available_serializers
+
+
+def make_track(i):
+    """A track shaped like YouTubeMusicService._format_track output."""
+    video_id = f'vid{i:08d}'
+    return {
+        'id': video_id,
+        'name': f'Track Number {i}',
+        'artists': [{'name': 'Some Artist', 'id': 'UCabcdefghijklmnopqrstuv'}],
+        'album': {
+            'name': 'Some Album',
+            'id': 'MPREb_abcdefghijk',
+            'images': [{'url': f'https://i.ytimg.com/vi/{video_id}/maxresdefault.jpg', 'height': 640, 'width': 640}]
+        },
+        'duration_ms': 215000,
+        'uri': f'ytmusic:{video_id}',
+        'external_urls': {'youtube': f'https://music.youtube.com/watch?v={video_id}'}
+    }
+
+
+PAYLOADS = {
+    'search (20)': [make_track(i) for i in range(20)],
+    'trending (50)': [make_track(i) for i in range(50)],
+    'album (14)': {
+        'id': 'MPREb_abcdefghijk', 'name': 'Some Album', 'year': '2024',
+        'artists': [{'name': 'Some Artist', 'id': 'UCabcdefghijklmnopqrstuv'}],
+        'track_count': 14, 'duration': '48 minutes',
+        'images': [{'url': 'https://lh3.googleusercontent.com/abc=w544-h544', 'width': 544, 'height': 544}],
+        'tracks': [make_track(i) for i in range(14)],
+    },
+    'stream_url': 'https://rr3---sn-abc.googlevideo.com/videoplayback?expire=1700000000&itag=140&source=youtube',
+}
+
+
+def bench(codec, value, rounds=2000):
+    encoded = codec.encode(value)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        codec.encode(value)
+    encode_us = (time.perf_counter() - start) / rounds * 1e6
+    start = time.perf_counter()
+    for _ in range(rounds):
+        codec.decode(encoded)
+    decode_us = (time.perf_counter() - start) / rounds * 1e6
+    return len(encoded), encode_us, decode_us
+
+
+def main():
+    print(f"{'payload':<15} {'codec':<16} {'bytes':>8} {'encode µs':>10} {'decode µs':>10}")
+    for name, value in PAYLOADS.items():
+        for serializer in available_serializers():
+            for compression in available_compressors():
+                codec = CacheCodec(serializer=serializer, compression=compression)
+                size, enc, dec = bench(codec, value)
+                print(f"{name:<15} {serializer + '+' + compression:<16} {size:>8} {enc:>10.1f} {dec:>10.1f}")
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Resolution latency: player endpoint fast path vs full yt-dlp extraction.
+
+Resolves the same videos both ways against YouTube, one at a time with warm
+sessions, and reports p50/p95 latency and failures per method. Needs network
+access; offline runs only report the failures.
+
+Run with: python benchmarks/bench_fast_resolver.py [--rounds 3] [--client android]
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent))
+
+VIDEO_IDS = [
+    'dQw4w9WgXcQ', 'kJQP7kiw5Fk', 'JGwWNGJdvx8', 'RgKAFK5djSk', 'OPf0YbXqDm0', 'fRh_vgS2dFE',
+    '09R8_2nJtjg', 'CevxZvSJLk8', 'hT_nvWreIhg', 'YQHsXMglC9A', 'pRpeEdMmmQ0', 'lp-EO5I60KA',
+]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)] if values else float('nan')
+
+
+def measure(name, resolve, video_ids):
+    latencies, errors = [], []
+    for video_id in video_ids:
+        started = time.perf_counter()
+        try:
+            info = resolve(video_id)
+            if not info.get('audio_url'):
+                raise ValueError('no audio URL')
+        except Exception as e:
+            errors.append(f"{video_id}: {str(e).splitlines()[0][:100]}")
+            continue
+        latencies.append((time.perf_counter() - started) * 1000)
+    print(f"{name:<12}{len(latencies):>4}/{len(video_ids):<4}{percentile(latencies, 0.5):>10.0f}"
+          f"{percentile(latencies, 0.95):>10.0f}")
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=3, help='passes over the video list')
+    parser.add_argument('--client', default='android', help='player client for both methods')
+    args = parser.parse_args()
+
+    import requests
+    import yt_dlp
+    from app.services import player_api
+    from app.services.resolver import compact_info, extract_formats, ydl_options
+
+    clients = (args.client,)
+    session = requests.Session()
+    ydl = yt_dlp.YoutubeDL(ydl_options(clients))
+    video_ids = VIDEO_IDS * args.rounds
+
+    print(f"{len(video_ids)} resolutions per method as {args.client}\n")
+    print(f"{'method':<12}{'ok':>9}{'p50 ms':>10}{'p95 ms':>10}")
+    errors = measure('player_api', lambda v: compact_info(player_api.fetch_info(session, v, args.client)), video_ids)
+    errors += measure('yt-dlp', lambda v: extract_formats(ydl, v), video_ids)
+    for error in errors[:10]:
+        print(f"  error {error}")
+
+
+if __name__ == '__main__':
+    main()
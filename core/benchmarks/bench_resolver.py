@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Resolutions per second of the stream URL resolver, thread vs process backend.
+
+Runs batches of extractions through StreamResolver for each backend and
+worker count. By default every extraction is a real yt-dlp call against
+YouTube; with --synthetic each one is simulated as network wait followed by
+GIL-holding parse/decipher work, which is what separates the two backends.
+
+Run with: python benchmarks/bench_resolver.py [--workers 1,2,4,8] [--videos 64] [--synthetic]
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import wait
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent))
+
+VIDEO_IDS = [
+    'dQw4w9WgXcQ', 'kJQP7kiw5Fk', 'JGwWNGJdvx8', 'RgKAFK5djSk', 'OPf0YbXqDm0', 'fRh_vgS2dFE',
+    '09R8_2nJtjg', 'CevxZvSJLk8', 'hT_nvWreIhg', 'YQHsXMglC9A', 'pRpeEdMmmQ0', 'lp-EO5I60KA',
+]
+
+
+class SyntheticYDL:
+    """Stands in for YoutubeDL: sleeps like a player request, then burns CPU like parsing it."""
+
+    def __init__(self, latency_ms: float, cpu_ms: float):
+        self.latency = latency_ms / 1000
+        self.cpu = cpu_ms / 1000
+        self.response = json.dumps({'streamingData': {'adaptiveFormats': [{
+            'itag': 140 + i, 'mimeType': 'audio/mp4; codecs="mp4a.40.2"', 'bitrate': 130000 + i,
+            'signatureCipher': f"s={'x' * 100}&sp=sig&url=https%3A%2F%2Frr1.googlevideo.com%2Fvideoplayback%3Fexpire%3D{2000000000 + i}",
+        } for i in range(40)]}})
+
+    def extract_info(self, url, download=False):
+        time.sleep(self.latency)
+        started = time.thread_time()
+        while True:
+            formats = json.loads(self.response)['streamingData']['adaptiveFormats']
+            urls = [re.sub(r'%3F|%3D|%2F|%3A', '/', f['signatureCipher'])[::-1] for f in formats]
+            if time.thread_time() - started >= self.cpu:
+                break
+        return {'title': 'Song', 'duration': 212, 'formats': [
+            {'format_id': str(f['itag']), 'url': f'https://rr1.googlevideo.com/videoplayback?expire={2000000000 + i}&u={len(u)}',
+             'ext': 'm4a', 'acodec': 'mp4a.40.2', 'vcodec': 'none', 'abr': f['bitrate'] / 1000}
+            for i, (f, u) in enumerate(zip(formats, urls))
+        ]}
+
+
+def _init_synthetic_worker(clients):
+    """Process-backend initializer used instead of the real warm YoutubeDL."""
+    import app.services.resolver
+    sys.modules['app.services.resolver']._process_ydls[clients] = SyntheticYDL(
+        float(os.environ['BENCH_LATENCY_MS']), float(os.environ['BENCH_CPU_MS'])
+    )
+
+
+def reset(resolver):
+    """Drop the resolver's pools so the next run builds them with the new settings."""
+    for pool in (resolver._executor, resolver._processes, resolver._race_executor):
+        if pool:
+            pool.shutdown(wait=True)
+    resolver._executor = resolver._processes = resolver._race_executor = resolver._slots = None
+
+
+def run(app, resolver, backend: str, workers: int, videos: int) -> dict:
+    app.config.update(RESOLVER_BACKEND=backend, RESOLVER_WORKERS=workers,
+                      RESOLVER_PROCESSES=workers, RESOLVER_QUEUE_SIZE=videos)
+    reset(resolver)
+    with app.app_context():
+        # Warm the pools (process start-up and YoutubeDL creation) outside the timing
+        started = time.perf_counter()
+        wait([resolver._submit(VIDEO_IDS[i % len(VIDEO_IDS)]) for i in range(workers)])
+        warmup = time.perf_counter() - started
+
+        started = time.perf_counter()
+        futures = [resolver._submit(VIDEO_IDS[i % len(VIDEO_IDS)]) for i in range(videos)]
+        done, _ = wait(futures)
+        elapsed = time.perf_counter() - started
+    errors = sum(1 for f in done if f.exception())
+    return {'rate': (videos - errors) / elapsed, 'errors': errors, 'warmup': warmup}
+
+
+def main():
+    cpus = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--workers', default=','.join(str(2 ** i) for i in range(4) if 2 ** i <= max(cpus, 8)),
+                        help='comma-separated worker counts')
+    parser.add_argument('--backends', default='thread,process')
+    parser.add_argument('--videos', type=int, default=64, help='extractions per run')
+    parser.add_argument('--synthetic', action='store_true', help='simulate extraction instead of calling YouTube')
+    parser.add_argument('--latency-ms', type=float, default=150, help='synthetic network wait per extraction')
+    parser.add_argument('--cpu-ms', type=float, default=40, help='synthetic CPU work per extraction')
+    args = parser.parse_args()
+
+    from app import create_app
+    from app.services.resolver import resolver
+    resolver_module = sys.modules['app.services.resolver']
+
+    app = create_app()
+    app.config.update(RESOLVER_TIMEOUT=600, RESOLVER_FAST_PATH=not args.synthetic)
+    if args.synthetic:
+        os.environ.update(BENCH_LATENCY_MS=str(args.latency_ms), BENCH_CPU_MS=str(args.cpu_ms))
+        synthetic = SyntheticYDL(args.latency_ms, args.cpu_ms)
+        resolver._get_ydl = lambda clients: synthetic
+        resolver_module._init_process_worker = _init_synthetic_worker
+        print(f"synthetic extraction: {args.latency_ms:g} ms wait + {args.cpu_ms:g} ms CPU")
+    else:
+        print("live yt-dlp extraction")
+    print(f"{args.videos} extractions per run, {cpus} CPUs\n")
+    print(f"{'backend':<9}{'workers':>8}{'res/s':>10}{'errors':>8}{'warm-up':>10}")
+
+    try:
+        for backend in args.backends.split(','):
+            for workers in map(int, args.workers.split(',')):
+                result = run(app, resolver, backend, workers, args.videos)
+                print(f"{backend:<9}{workers:>8}{result['rate']:>10.1f}{result['errors']:>8}"
+                      f"{result['warmup']:>9.2f}s")
+    finally:
+        reset(resolver)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Cached-audio streaming benchmark: Python generator vs wsgi.file_wrapper/sendfile.
+
+Seeds one file into a temporary audio cache, starts gunicorn once per
+AUDIO_CACHE_SENDFILE_MODE and streams it with many concurrent clients,
+reporting throughput and server CPU time.
+
+Run with: python benchmarks/bench_stream.py [--streams 128] [--rounds 3] [--size-mb 4]
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+
+CORE_DIR = Path(__file__).resolve().parent.parent
+VIDEO_ID = 'dQw4w9WgXcQ'
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+
+
+def seed_cache(directory: Path, size: int):
+    """Write a complete cache entry the way AudioCache would."""
+    directory.mkdir(parents=True, exist_ok=True)
+    key = f'{VIDEO_ID}.default'
+    (directory / f'{key}.audio').write_bytes(os.urandom(size))
+    (directory / f'{key}.json').write_text(json.dumps({
+        'key': key, 'content_type': 'audio/mp4', 'size': size,
+        'complete': True, 'extents': [], 'created_at': time.time()
+    }))
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def cpu_seconds(pid: int) -> float:
+    """User + system CPU time of a process and its children (Linux /proc)."""
+    total = 0.0
+    pids = [pid] + [int(p) for p in os.listdir('/proc') if p.isdigit() and _ppid(int(p)) == pid]
+    for p in pids:
+        try:
+            fields = Path(f'/proc/{p}/stat').read_text().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        total += (int(fields[11]) + int(fields[12])) / CLK_TCK
+    return total
+
+
+def _ppid(pid: int) -> int:
+    try:
+        return int(Path(f'/proc/{pid}/stat').read_text().rsplit(')', 1)[1].split()[1])
+    except (OSError, IndexError, ValueError):
+        return -1
+
+
+def start_server(mode: str, cache_dir: Path, threads: int):
+    port = free_port()
+    env = dict(os.environ, AUDIO_CACHE_DIR=str(cache_dir), AUDIO_CACHE_SENDFILE_MODE=mode)
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-w', '1', '-k', 'gthread', '--threads', str(threads),
+         '-b', f'127.0.0.1:{port}', '--log-level', 'warning', 'app:create_app()'],
+        cwd=CORE_DIR, env=env
+    )
+    base = f'http://127.0.0.1:{port}'
+    for _ in range(100):
+        try:
+            requests.get(f'{base}/api/v1/health', timeout=1)
+            return proc, base
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError('gunicorn did not start')
+
+
+def stream_once(base: str) -> int:
+    received = 0
+    with requests.get(f'{base}/api/v1/tracks/stream/{VIDEO_ID}', headers={'X-API-Key': 'bench'},
+                      stream=True, timeout=60) as resp:
+        resp.raise_for_status()
+        for chunk in resp.iter_content(chunk_size=65536):
+            received += len(chunk)
+    return received
+
+
+def run(mode: str, cache_dir: Path, streams: int, rounds: int):
+    proc, base = start_server(mode, cache_dir, streams)
+    try:
+        stream_once(base)  # warm up
+        cpu_before = cpu_seconds(proc.pid)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=streams) as pool:
+            total = sum(pool.map(lambda _: stream_once(base), range(streams * rounds)))
+        elapsed = time.perf_counter() - started
+        cpu = cpu_seconds(proc.pid) - cpu_before
+    finally:
+        proc.terminate()
+        proc.wait()
+    return total, elapsed, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--streams', type=int, default=128, help='concurrent streams')
+    parser.add_argument('--rounds', type=int, default=3, help='streams per client')
+    parser.add_argument('--size-mb', type=float, default=4, help='cached file size')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache_dir = Path(tmp) / 'audio'
+        seed_cache(cache_dir, int(args.size_mb * 1024 * 1024))
+
+        print(f"{args.streams} concurrent streams x {args.rounds} rounds of {args.size_mb} MB\n")
+        print(f"{'mode':<10}{'MB/s':>10}{'wall s':>10}{'server cpu s':>14}{'cpu ms/MB':>12}")
+        for mode, label in (('off', 'generator'), ('wsgi', 'sendfile')):
+            total, elapsed, cpu = run(mode, cache_dir, args.streams, args.rounds)
+            mb = total / 1024 / 1024
+            print(f"{label:<10}{mb / elapsed:>10.1f}{elapsed:>10.2f}{cpu:>14.2f}{cpu * 1000 / mb:>12.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -79,7 +79,7 @@ def main():
             filename = f"{clean_filename(artist)} - {clean_filename(title)}.mp3"
             
             # 5. Download
-            stream_url = f"{API_URL}/tracks/stream/{video_id}"
+            stream_url = f"{API_URL}/tracks/stream/{video_id}?download=1"
             print(f"\nDownloading to '{filename}'...")
             
             download = requests.get(stream_url, headers=headers, stream=True)
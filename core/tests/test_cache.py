@@ -0,0 +1,325 @@
+"""
+Tests for the caching service.
+"""
+import threading
+import time
+
+import pytest
+
+from app.services.cache import MemoryCache, CacheService, SingleFlight, cache, cached
+from app.services.codec import CacheCodec, available_compressors, available_serializers
+from app.services.metrics import metrics
+
+
+def test_memory_cache_evicts_least_recently_used():
+    """Test that the entry budget evicts the LRU key first."""
+    mem = MemoryCache(max_entries=2)
+    mem.set('a', 1)
+    mem.set('b', 2)
+    assert mem.get('a') == 1
+    mem.set('c', 3)
+    
+    assert mem.get('b') is None
+    assert mem.get('a') == 1
+    assert mem.get('c') == 3
+    assert mem.stats()['evictions'] == 1
+
+
+def test_memory_cache_respects_byte_budget():
+    """Test that the byte budget bounds total stored size."""
+    mem = MemoryCache(max_entries=100, max_bytes=100)
+    for i in range(10):
+        mem.set(f'k{i}', 'x' * 30)
+    
+    stats = mem.stats()
+    assert stats['bytes'] <= 100
+    assert stats['entries'] == 3
+    assert mem.set('huge', 'x' * 500) is False
+
+
+def test_memory_cache_oversized_set_drops_old_value():
+    """Test that a value too big to store still replaces the key's previous value."""
+    mem = MemoryCache(max_entries=100, max_bytes=100)
+    mem.set('k', 'x' * 30)
+    
+    assert mem.set('k', 'y' * 500) is False
+    assert mem.get('k') is None
+    assert mem.stats()['bytes'] == 0
+
+
+def test_memory_cache_expires_entries():
+    """Test that expired entries are swept and counted."""
+    mem = MemoryCache()
+    mem.set('short', 'v', ttl=0)
+    mem.set('long', 'v', ttl=60)
+    
+    assert mem.get('short') is None
+    assert mem.get('long') == 'v'
+    assert mem.stats()['expirations'] == 1
+    assert len(mem) == 1
+
+
+@pytest.fixture
+def redis_cache(app, monkeypatch):
+    """Cache service backed by an in-process fake Redis."""
+    import fakeredis
+    from app.services.cache import CacheService, cache
+    
+    app.config['CACHE_L1_PUBSUB'] = False
+    monkeypatch.setattr(CacheService, '_redis_client', fakeredis.FakeRedis())
+    monkeypatch.setattr(CacheService, '_l1_cache', None)
+    return cache
+
+
+def test_l1_promotes_redis_hits(redis_cache):
+    """Test that Redis hits are served from L1 on the next lookup."""
+    redis_client = redis_cache._get_redis()
+    redis_client.setex('trending:US', 60, '[1, 2, 3]')
+    
+    assert redis_cache.get('trending:US') == [1, 2, 3]
+    
+    redis_client.delete('trending:US')
+    assert redis_cache.get('trending:US') == [1, 2, 3]
+    assert redis_cache.stats()['l1']['hits'] == 1
+
+
+def test_l1_dropped_on_delete(redis_cache):
+    """Test that deleting a key clears both tiers."""
+    redis_cache.set('genres', ['pop'], ttl=60)
+    redis_cache.delete('genres')
+    
+    assert redis_cache.get('genres') is None
+
+
+@pytest.fixture
+def memory_cache(app, monkeypatch):
+    """Cache service using a fresh in-memory store."""
+    monkeypatch.setattr(CacheService, '_memory_cache', None)
+    metrics.reset()
+    return cache
+
+
+def _wait_for_refresh(key, timeout=2):
+    deadline = time.time() + timeout
+    while key in CacheService._refreshing and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def test_stale_value_served_while_refreshing(memory_cache):
+    """Test that a stale entry is returned and refreshed in the background."""
+    memory_cache.get_or_load('trending:US', lambda: ['old'], ttl=0, stale_ttl=60)
+    
+    assert memory_cache.get_or_load('trending:US', lambda: ['new'], ttl=60) == ['old']
+    _wait_for_refresh('trending:US')
+    
+    assert memory_cache.get_or_load('trending:US', lambda: ['newer'], ttl=60) == ['new']
+    assert metrics.snapshot()['counters']['cache.refresh.success'] == 1
+
+
+def test_stale_value_served_when_refresh_fails(memory_cache):
+    """Test that upstream errors keep the stale entry alive."""
+    def failing():
+        raise RuntimeError('upstream down')
+    
+    memory_cache.get_or_load('genres', lambda: ['pop'], ttl=0, stale_ttl=60)
+    
+    assert memory_cache.get_or_load('genres', failing, ttl=60) == ['pop']
+    _wait_for_refresh('genres')
+    
+    assert memory_cache.get_or_load('genres', failing, ttl=60) == ['pop']
+    assert metrics.snapshot()['counters']['cache.refresh.failure'] == 1
+
+
+def test_stale_window_follows_fresh_ttl(app, memory_cache, monkeypatch):
+    """Test that the default stale window scales with the fresh TTL, up to CACHE_STALE_TTL."""
+    def window(key, ttl):
+        memory_cache.get_or_load(key, lambda: ['v'], ttl=ttl)
+        entry = memory_cache.get(key)
+        return round(entry['expires_at'] - entry['fresh_until'])
+    
+    assert window('search:drake', 300) == 300
+    assert window('genres', 86400) == app.config['CACHE_STALE_TTL']
+    monkeypatch.setitem(app.config, 'CACHE_STALE_RATIO', 0.5)
+    assert window('trending:US', 1800) == 900
+
+
+def test_singleflight_coalesces_concurrent_calls():
+    """Test that concurrent callers for one key share a single execution."""
+    flight = SingleFlight()
+    calls = []
+    release = threading.Event()
+    
+    def slow():
+        calls.append(1)
+        release.wait(2)
+        return 'url'
+    
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do('stream_url:x', slow, 2)))
+               for _ in range(8)]
+    for t in threads:
+        t.start()
+    while flight.in_flight() == 0:
+        time.sleep(0.01)
+    time.sleep(0.05)
+    release.set()
+    for t in threads:
+        t.join()
+    
+    assert calls == [1]
+    assert results == ['url'] * 8
+
+
+def test_singleflight_wait_timeout():
+    """Test that followers give up after the wait timeout."""
+    flight = SingleFlight()
+    release = threading.Event()
+    leader = threading.Thread(target=lambda: flight.do('album:x', lambda: release.wait(2)))
+    leader.start()
+    while flight.in_flight() == 0:
+        time.sleep(0.01)
+    
+    with pytest.raises(TimeoutError):
+        flight.do('album:x', lambda: 'unused', timeout=0.05)
+    release.set()
+    leader.join()
+
+
+def test_lease_lets_one_node_compute(redis_cache):
+    """Test that a held lease makes other callers wait for the result key."""
+    from app.services.cache import RedisLease
+    
+    redis_client = redis_cache._get_redis()
+    lease = RedisLease(redis_client, 'lock:stream_url:abc', ttl=5)
+    assert lease.acquire()
+    assert not RedisLease(redis_client, 'lock:stream_url:abc', ttl=5).acquire()
+    
+    def owner_finishes():
+        time.sleep(0.1)
+        redis_client.setex('stream_url:abc', 60, '"https://example.com/a"')
+        lease.release()
+    
+    owner = threading.Thread(target=owner_finishes)
+    owner.start()
+    result = redis_cache.load_with_lease('stream_url:abc', lambda: 'duplicate work', ttl=60,
+                                         wait_timeout=2)
+    
+    owner.join()
+    assert result == 'https://example.com/a'
+    assert redis_client.get('lock:stream_url:abc') is None
+
+
+def test_lease_expires_for_crashed_owner(redis_cache):
+    """Test that an abandoned lease lapses and another caller takes over."""
+    from app.services.cache import RedisLease
+    
+    RedisLease(redis_cache._get_redis(), 'lock:lyrics:abc', ttl=0.1).acquire()
+    
+    result = redis_cache.load_with_lease('lyrics:abc', lambda: {'lyrics': 'la'}, ttl=60,
+                                         wait_timeout=2)
+    assert result == {'lyrics': 'la'}
+
+
+def test_failed_lease_load_is_not_retried_by_waiters(app, redis_cache):
+    """Test that when the lease owner's load fails, waiting nodes fail fast instead of re-running it."""
+    from app.services.cache import LeaseLoadFailed
+    
+    calls = []
+    
+    def failing():
+        calls.append('owner')
+        time.sleep(0.1)
+        raise RuntimeError('upstream down')
+    
+    def owner():
+        with app.app_context():
+            with pytest.raises(RuntimeError):
+                redis_cache.load_with_lease('lyrics:xyz', failing, ttl=60)
+    
+    thread = threading.Thread(target=owner)
+    thread.start()
+    time.sleep(0.02)
+    started = time.time()
+    with pytest.raises(LeaseLoadFailed, match='upstream down'):
+        redis_cache.load_with_lease('lyrics:xyz', lambda: calls.append('waiter'), ttl=60, wait_timeout=5)
+    thread.join()
+    assert calls == ['owner']
+    assert time.time() - started < 1
+    
+    # A None result is shared the same way
+    assert redis_cache.load_with_lease('lyrics:none', lambda: calls.append('first'), ttl=60) is None
+    assert redis_cache.load_with_lease('lyrics:none', lambda: calls.append('second'), ttl=60) is None
+    assert calls == ['owner', 'first']
+
+
+def test_get_many_and_set_many(redis_cache):
+    """Test batch operations against Redis."""
+    redis_cache.set_many({'album:a': {'id': 'a'}, 'album:b': {'id': 'b'}}, ttl=60)
+    
+    found = redis_cache.get_many(['album:a', 'album:b', 'album:missing'])
+    assert found == {'album:a': {'id': 'a'}, 'album:b': {'id': 'b'}}
+
+
+def test_redis_reconnect_backs_off(app, monkeypatch):
+    """Test that a failed connection is retried later instead of disabled forever."""
+    monkeypatch.setattr(CacheService, '_redis_client', None)
+    monkeypatch.setattr(CacheService, '_redis_pool', None)
+    monkeypatch.setattr(CacheService, '_redis_retry_at', 0.0)
+    monkeypatch.setattr(CacheService, '_redis_backoff', 0)
+    app.config['REDIS_URL'] = 'redis://127.0.0.1:1/0'
+    
+    assert cache._get_redis() is None
+    assert CacheService._redis_retry_at > time.time()
+    
+    # Within the backoff window no connection attempt is made
+    monkeypatch.setattr(CacheService, '_redis_retry_at', time.time() + 60)
+    assert cache._get_redis() is None
+    
+    monkeypatch.setattr(CacheService, '_redis_retry_at', 0.0)
+    cache._get_redis()
+    assert CacheService._redis_backoff == 2
+
+
+@pytest.mark.parametrize('serializer', available_serializers())
+@pytest.mark.parametrize('compression', available_compressors())
+def test_codec_round_trip(serializer, compression):
+    """Test that every available codec combination round-trips payloads."""
+    codec = CacheCodec(serializer=serializer, compression=compression, threshold=64)
+    value = {'tracks': [{'id': f'vid{i}', 'name': 'Song', 'duration_ms': 1000 * i} for i in range(20)]}
+    
+    encoded = codec.encode(value)
+    assert encoded[0] == 1
+    assert codec.decode(encoded) == value
+
+
+def test_codec_decodes_legacy_json():
+    """Test that entries written as plain JSON still decode."""
+    codec = CacheCodec(serializer='msgpack', compression='zstd')
+    assert codec.decode(b'{"id": "abc"}') == {'id': 'abc'}
+
+
+def test_make_key_normalizes_and_bounds_length():
+    """Test that keys are stable across query variants and never unbounded."""
+    from app.services.cache import make_key, normalize_query
+    
+    assert normalize_query('  Ｄrake\tFeat.  RIHANNA ') == 'drake feat. rihanna'
+    assert make_key('search', normalize_query('Drake')) == make_key('search', normalize_query('DRAKE '))
+    
+    long_key = make_key('genre_playlists', 'x' * 1000)
+    assert len(long_key) < 100
+    assert long_key == make_key('genre_playlists', 'x' * 1000)
+
+
+def test_cached_decorator_keys_under_prefix(memory_cache):
+    """Test that decorated results are cached under the given prefix."""
+    memory_cache.reset_stats()
+    calls = []
+    
+    @cached(ttl=60, key_prefix='lyrics')
+    def lookup(video_id):
+        calls.append(video_id)
+        return {'id': video_id}
+    
+    assert lookup('abc') == lookup('abc') == {'id': 'abc'}
+    assert calls == ['abc']
+    assert memory_cache.stats()['prefixes']['memory']['lyrics']['hits'] == 1
@@ -0,0 +1,53 @@
+"""
+Tests for the metrics endpoints.
+"""
+import pytest
+
+from app.services.cache import CacheService, cache
+
+
+def test_metrics_report_cache_prefixes(app, client, master_headers, monkeypatch):
+    """Test that cache activity shows up per tier and key prefix."""
+    monkeypatch.setattr(CacheService, '_memory_cache', None)
+    cache.reset_stats()
+    
+    cache.set('search:drake', ['a'], ttl=60)
+    cache.get('search:drake')
+    cache.get('search:missing')
+    
+    response = client.get('/api/v1/metrics', headers=master_headers)
+    assert response.status_code == 200
+    search = response.json['data']['cache']['prefixes']['memory']['search']
+    assert search['hits'] == 1
+    assert search['misses'] == 1
+    assert search['sets'] == 1
+    assert search['hit_ratio'] == 0.5
+
+
+def test_metrics_reset(app, client, master_headers):
+    """Test that counters can be reset."""
+    cache.set('album:x', {'id': 'x'}, ttl=60)
+    
+    response = client.post('/api/v1/metrics/reset', headers=master_headers)
+    assert response.status_code == 200
+    
+    response = client.get('/api/v1/metrics', headers=master_headers)
+    assert response.json['data']['cache']['prefixes'] == {}
+
+
+def test_metrics_require_master_key(app, client):
+    """Test that metrics cannot be read or reset without the master key."""
+    cache.set('album:x', {'id': 'x'}, ttl=60)
+    
+    response = client.get('/api/v1/metrics')
+    assert response.status_code == 401
+    assert response.json['error']['code'] == 'MASTER_KEY_REQUIRED'
+    
+    response = client.post('/api/v1/metrics/reset')
+    assert response.status_code == 401
+    
+    response = client.post('/api/v1/metrics/reset', headers={'X-Master-Key': 'wrong'})
+    assert response.status_code == 403
+    assert response.json['error']['code'] == 'INVALID_MASTER_KEY'
+    
+    assert 'album' in cache.stats()['prefixes']['memory']
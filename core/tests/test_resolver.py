@@ -0,0 +1,279 @@
+"""
+Tests for the stream URL resolver.
+"""
+import json
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from app.services.cache import CacheService, MemoryCache
+from app.services.player_api import parse_player_response, PlayerAPIError
+from app.services.resolver import resolver, compact_info, ResolverBusy, url_expiry
+
+VIDEO_ID = 'dQw4w9WgXcQ'
+
+
+@pytest.fixture
+def extract(app, monkeypatch):
+    """A fresh resolver pool whose extractions are counted instead of hitting YouTube."""
+    monkeypatch.setattr(CacheService, '_memory_cache', None)
+    monkeypatch.setattr(resolver, '_executor', None)
+    monkeypatch.setattr(resolver, '_slots', None)
+    calls = []
+    
+    def fake_extract(video_id):
+        calls.append(video_id)
+        return {
+            'video_id': video_id, 'title': 'Song', 'duration': 212, 'formats': [],
+            'audio_url': f'https://upstream.test/{len(calls)}',
+            'expires_at': time.time() + 3600, 'refresh_at': time.time() + 3300,
+        }
+    
+    monkeypatch.setattr(resolver, '_extract', fake_extract)
+    return calls
+
+
+def test_track_endpoints_share_one_resolution(client, extract):
+    """Test that /tracks/<id>, /track/<id> and warm lookups reuse the cached formats."""
+    first = client.get(f'/api/v1/tracks/{VIDEO_ID}', headers={'X-API-Key': 'test'}).get_json()
+    second = client.get(f'/api/v1/track/{VIDEO_ID}', headers={'X-API-Key': 'test'}).get_json()
+    
+    assert first['data']['audioUrl'] == second['data']['audioUrl'] == 'https://upstream.test/1'
+    assert first['data']['thumbnail']
+    assert 'thumbnail' not in resolver.resolve(VIDEO_ID)
+    assert extract == [VIDEO_ID]
+
+
+def test_entries_refresh_before_expiry(app, extract, monkeypatch):
+    """Test that an entry inside its refresh margin is served and re-resolved in the background."""
+    fake_extract = resolver._extract
+    
+    def due_for_refresh(video_id):
+        info = fake_extract(video_id)
+        return dict(info, refresh_at=time.time() - 1) if len(extract) == 1 else info
+    
+    monkeypatch.setattr(resolver, '_extract', due_for_refresh)
+    assert resolver.audio_url(VIDEO_ID) == 'https://upstream.test/1'
+    assert resolver.audio_url(VIDEO_ID) == 'https://upstream.test/1'
+    deadline = time.time() + 2
+    while resolver.audio_url(VIDEO_ID) != 'https://upstream.test/2' and time.time() < deadline:
+        time.sleep(0.01)
+    assert resolver.audio_url(VIDEO_ID) == 'https://upstream.test/2'
+    assert len(extract) == 2
+
+
+def test_full_queue_rejects_work(app, extract, monkeypatch):
+    """Test that the pool refuses work beyond its workers plus queue."""
+    app.config.update(RESOLVER_WORKERS=1, RESOLVER_QUEUE_SIZE=0)
+    release = threading.Event()
+    monkeypatch.setattr(resolver, '_extract', lambda video_id: release.wait(2))
+    
+    running = resolver._submit(VIDEO_ID)
+    with pytest.raises(ResolverBusy):
+        resolver._submit('aaaaaaaaaaa')
+    release.set()
+    running.result(2)
+
+
+def test_entries_live_until_url_expiry(app, monkeypatch):
+    """Test that cache lifetime and refresh follow the googlevideo expire= parameter."""
+    expire = int(time.time()) + 21600
+    url = f'https://rr1.googlevideo.com/videoplayback?expire={expire}&itag=140'
+    assert url_expiry(url) == expire
+    assert url_expiry('https://rr1.googlevideo.com/videoplayback/expire/123/itag/140') == 123
+    assert url_expiry('https://example.com/a') is None
+    
+    class FakeYDL:
+        def extract_info(self, url_, download=False):
+            return {'title': 'Song', 'url': url, 'formats': [{'url': url, 'acodec': 'mp4a', 'vcodec': 'none'}]}
+    
+    monkeypatch.setattr(resolver, '_get_ydl', lambda clients: FakeYDL())
+    info = resolver._extract(VIDEO_ID)
+    assert info['expires_at'] == expire
+    assert info['refresh_at'] == expire - 300
+    assert expire - 61 <= time.time() + resolver._ttl_for(info) <= expire - 59
+
+
+def test_process_backend_returns_compact_formats(app, monkeypatch):
+    """Test that the process backend extracts in the pool and only gets the format list back."""
+    from concurrent.futures import Future
+    resolver_module = sys.modules['app.services.resolver']
+    
+    url = 'https://rr1.googlevideo.com/videoplayback?expire=2000000000&itag=251'
+    submitted = []
+    
+    class FakeYDL:
+        def extract_info(self, url_, download=False):
+            return {
+                'title': 'Song', 'duration': 212, 'thumbnails': [{}] * 50, 'subtitles': {'en': []},
+                'formats': [
+                    {'format_id': '251', 'url': url, 'ext': 'webm', 'acodec': 'opus', 'vcodec': 'none', 'abr': 160},
+                    {'format_id': '18', 'url': url, 'ext': 'mp4', 'acodec': 'mp4a', 'vcodec': 'avc1', 'abr': 96},
+                    {'format_id': '137', 'url': url, 'acodec': 'none', 'vcodec': 'avc1'},
+                ],
+            }
+    
+    class FakePool:
+        def submit(self, fn, *args):
+            submitted.append(fn)
+            future = Future()
+            future.set_result(fn(*args))
+            return future
+    
+    app.config['RESOLVER_BACKEND'] = 'process'
+    monkeypatch.setattr(resolver_module, '_process_ydls', {('android', 'ios'): FakeYDL()})
+    monkeypatch.setattr(resolver, '_get_processes', lambda: FakePool())
+    monkeypatch.setattr(resolver, '_get_ydl', lambda clients: pytest.fail('thread backend used'))
+    
+    info = resolver._extract(VIDEO_ID)
+    assert submitted == [resolver_module._extract_in_process]
+    assert set(resolver_module._extract_in_process(VIDEO_ID, ('android', 'ios'))) == {'title', 'duration', 'audio_url', 'formats', 'source'}
+    assert [f['format_id'] for f in info['formats']] == ['251', '18']
+    assert info['audio_url'] == url
+    assert info['expires_at'] == 2000000000
+
+
+@pytest.fixture
+def race(app, monkeypatch):
+    """Racing enabled over fake android/ios clients with per-client behaviour."""
+    app.config.update(RESOLVER_RACE_CLIENTS=True, RESOLVER_PLAYER_CLIENTS='android,ios')
+    monkeypatch.setattr(resolver, '_race_executor', None)
+    monkeypatch.setattr(resolver, '_clients', {})
+    behaviour = {}
+    
+    class FakeYDL:
+        def __init__(self, client):
+            self.client = client
+        
+        def extract_info(self, url, download=False):
+            delay, error = behaviour[self.client]
+            time.sleep(delay)
+            if error:
+                raise error
+            audio = f'https://rr1.googlevideo.com/videoplayback?expire=2000000000&c={self.client}'
+            return {'title': 'Song', 'formats': [{'url': audio, 'acodec': 'opus', 'vcodec': 'none'}]}
+    
+    monkeypatch.setattr(resolver, '_get_ydl', lambda clients: FakeYDL(clients[0]))
+    return behaviour
+
+
+def test_race_takes_first_playable_client(app, race):
+    """Test that a slow client does not hold up the answer and ordering follows latency."""
+    race.update(android=(0.5, None), ios=(0, None))
+    
+    started = time.monotonic()
+    info = resolver._extract(VIDEO_ID)
+    assert time.monotonic() - started < 0.4
+    assert info['audio_url'].endswith('c=ios')
+    
+    deadline = time.time() + 2
+    while resolver.client_stats()['android']['ok'] == 0 and time.time() < deadline:
+        time.sleep(0.01)
+    stats = resolver.client_stats()
+    assert list(stats) == ['ios', 'android']
+    assert stats['ios']['wins'] == 1 and stats['android']['wins'] == 0
+    assert stats['android']['ok'] == 1 and stats['android']['latency_ms'] >= 500
+
+
+def test_race_survives_failing_client(app, race):
+    """Test that a client error falls through to the next answer and demotes that client."""
+    race.update(android=(0, RuntimeError('Sign in to confirm you are not a bot')), ios=(0.05, None))
+    
+    for _ in range(3):
+        assert resolver._extract(VIDEO_ID)['audio_url'].endswith('c=ios')
+    stats = resolver.client_stats()
+    assert list(stats) == ['ios', 'android']
+    assert stats['android']['failed'] >= 1
+    
+    race.update(ios=(0, RuntimeError('blocked')))
+    with pytest.raises(RuntimeError):
+        resolver._extract(VIDEO_ID)
+
+
+FIXTURES = Path(__file__).parent / 'fixtures'
+
+
+@pytest.fixture
+def player(app, monkeypatch):
+    """Fast path enabled, with the player endpoint answering from recorded fixtures."""
+    app.config.update(RESOLVER_FAST_PATH=True, RESOLVER_RACE_CLIENTS=False, RESOLVER_PLAYER_CLIENTS='android,ios')
+    monkeypatch.setattr(CacheService, '_memory_cache', None)
+    monkeypatch.setattr(resolver, '_slow_path', MemoryCache(name='test_slow_path'))
+    answers = {'ANDROID': 'player_android.json', 'IOS': 'player_android.json'}
+    calls = []
+    
+    class FakeResponse:
+        def __init__(self, fixture):
+            self.fixture = fixture
+        
+        def raise_for_status(self):
+            pass
+        
+        def json(self):
+            return json.loads((FIXTURES / self.fixture).read_text())
+    
+    class FakeSession:
+        def post(self, url, json=None, headers=None, timeout=None):
+            client = json['context']['client']['clientName']
+            calls.append((client, json['videoId'], headers['X-YouTube-Client-Name']))
+            return FakeResponse(answers[client])
+    
+    class FakeYDL:
+        def extract_info(self, url, download=False):
+            calls.append(('yt-dlp', url))
+            return {'title': 'Song', 'url': 'https://upstream.test/ydl', 'formats': []}
+    
+    monkeypatch.setattr(resolver, '_get_session', lambda: FakeSession())
+    monkeypatch.setattr(resolver, '_get_ydl', lambda clients: FakeYDL())
+    return answers, calls
+
+
+def test_player_response_maps_to_formats():
+    """Test that a recorded player answer maps to the same format dicts as yt-dlp's."""
+    info = compact_info(parse_player_response(json.loads((FIXTURES / 'player_android.json').read_text())))
+    
+    assert info['title'].startswith('Rick Astley')
+    assert info['duration'] == 212
+    assert [f['format_id'] for f in info['formats']] == ['251', '140', '249', '18']
+    assert 'itag=140' in info['audio_url']
+    m4a = info['formats'][1]
+    assert (m4a['ext'], m4a['acodec'], m4a['abr'], m4a['asr'], m4a['filesize'], m4a['audio_only']) == \
+        ('m4a', 'mp4a.40.2', 129.509, 44100, 3433514, True)
+    assert info['formats'][-1]['audio_only'] is False
+    
+    with pytest.raises(PlayerAPIError, match='LOGIN_REQUIRED'):
+        parse_player_response(json.loads((FIXTURES / 'player_login_required.json').read_text()))
+
+
+def test_fast_path_skips_yt_dlp(app, player):
+    """Test that android answers from the player endpoint without running yt-dlp."""
+    _, calls = player
+    info = resolver._extract(VIDEO_ID)
+    
+    assert calls == [('ANDROID', VIDEO_ID, '3')]
+    assert info['source'] == 'player_api'
+    assert info['expires_at'] == 1760812345
+
+
+def test_fast_path_falls_back_to_yt_dlp(app, player):
+    """Test that a refused player request tries the next client, then full extraction."""
+    answers, calls = player
+    answers.update(ANDROID='player_login_required.json', IOS='player_login_required.json')
+    info = resolver._extract(VIDEO_ID)
+    
+    assert [c[0] for c in calls] == ['ANDROID', 'IOS', 'yt-dlp']
+    assert info['source'] == 'yt-dlp'
+    assert info['audio_url'] == 'https://upstream.test/ydl'
+
+
+def test_rejected_fast_path_url_uses_yt_dlp_next(app, player):
+    """Test that once upstream refuses a fast-path URL the video is re-resolved with yt-dlp."""
+    _, calls = player
+    assert resolver.resolve(VIDEO_ID)['source'] == 'player_api'
+    resolver.invalidate(VIDEO_ID)
+    
+    assert resolver.resolve(VIDEO_ID)['source'] == 'yt-dlp'
+    assert [c[0] for c in calls] == ['ANDROID', 'yt-dlp']
@@ -37,3 +37,20 @@ def test_search_with_query(client, auth_headers, mocker):
     assert response.status_code == 200
     assert 'data' in response.json
     assert 'tracks' in response.json['data']
+
+
+def test_search_cache_normalizes_queries_and_reuses_limits(app, mocker, monkeypatch):
+    """Test that query variants and smaller limits are served from one cache entry."""
+    from app.services.cache import CacheService
+    from app.services.youtube_music import ytmusic
+    
+    monkeypatch.setattr(CacheService, '_memory_cache', None)
+    upstream = mocker.patch.object(
+        ytmusic._ytmusic, 'search',
+        side_effect=lambda query, filter, limit: [{'videoId': f'v{i}', 'title': query} for i in range(limit)]
+    )
+    
+    assert len(ytmusic.search('Drake', limit=50)) == 50
+    assert len(ytmusic.search('drake ', limit=20)) == 20
+    assert len(ytmusic.search('DRAKE', limit=5)) == 5
+    assert upstream.call_count == 1
@@ -0,0 +1,779 @@
+"""
+Tests for audio streaming and the on-disk audio cache.
+"""
+import asyncio
+import re
+import struct
+import sys
+import threading
+import time
+
+import httpx
+import pytest
+import requests
+
+import app.asgi as asgi_module
+import app.routes.tracks as tracks_routes
+from app import limiter
+from app.asgi import create_asgi_app
+from app.services.async_stream import AsyncStreamer
+from app.services import bandwidth as bandwidth_module, seek_index
+from app.services.audio_cache import audio_cache, parse_range
+from app.services.bandwidth import bandwidth
+from app.services.cache import CacheService, cache, make_key
+from app.services.head_cache import head_cache
+from app.services.metrics import metrics
+from app.services.resolver import resolver
+from app.services.transcoder import transcoder
+from app.services.youtube_music import ytmusic
+
+AUDIO = bytes(range(256)) * 400  # 100 KB of fake audio
+VIDEO_ID = 'dQw4w9WgXcQ'
+
+# Audio-only formats as the resolver lists them, best first
+FORMATS = [
+    {'format_id': '251', 'url': 'https://upstream.test/251', 'acodec': 'opus', 'abr': 135.2, 'audio_only': True},
+    {'format_id': '140', 'url': 'https://upstream.test/140', 'acodec': 'mp4a.40.2', 'abr': 129.5, 'audio_only': True},
+    {'format_id': '250', 'url': 'https://upstream.test/250', 'acodec': 'opus', 'abr': 64.8, 'audio_only': True},
+    {'format_id': '249', 'url': 'https://upstream.test/249', 'acodec': 'opus', 'abr': 50.1, 'audio_only': True},
+]
+
+
+class FakeUpstream:
+    """Stands in for googlevideo: a requests.Session serving AUDIO with Range support."""
+    
+    def __init__(self, data=AUDIO):
+        self.data = data
+        self.requests = []
+        self.urls = []
+        self.stale_urls = set()
+        self.drops = []  # Body sizes after which the next responses reset
+        self.stale_after_drop = False
+    
+    def get(self, url, headers=None, stream=True, timeout=None):
+        self.requests.append(dict(headers or {}))
+        self.urls.append(url)
+        if url in self.stale_urls:
+            return FakeResponse(b'', status_code=403)
+        response = FakeResponse(self.data, (headers or {}).get('Range'))
+        response.drop_after = self.drops.pop(0) if self.drops else None
+        if self.stale_after_drop:
+            response.on_drop = lambda: self.stale_urls.add(url)
+        return response
+
+
+class FakeResponse:
+    def __init__(self, data, range_header=None, status_code=200):
+        self.status_code = status_code
+        self.headers = {'Content-Type': 'audio/mp4', 'Content-Length': str(len(data))}
+        self._body = data
+        if range_header:
+            start, end = re.match(r'bytes=(\d+)-(\d*)', range_header).groups()
+            start = int(start)
+            end = int(end) if end else len(data) - 1
+            self._body = data[start:end + 1]
+            self.status_code = 206
+            self.headers['Content-Range'] = f"bytes {start}-{end}/{len(data)}"
+            self.headers['Content-Length'] = str(len(self._body))
+    
+    drop_after = None
+    on_drop = None
+    
+    def iter_content(self, chunk_size=8192):
+        for i in range(0, len(self._body), chunk_size):
+            if self.drop_after is not None and i >= self.drop_after:
+                if self.on_drop:
+                    self.on_drop()
+                raise requests.exceptions.ChunkedEncodingError('Connection reset by peer')
+            yield self._body[i:i + chunk_size]
+    
+    @property
+    def content(self):
+        return self._body
+    
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def upstream(app, tmp_path, monkeypatch):
+    """Fresh caches and a fake upstream for every streaming test."""
+    app.config['AUDIO_CACHE_DIR'] = tmp_path / 'audio'
+    monkeypatch.setattr(CacheService, '_memory_cache', None)
+    monkeypatch.setattr(audio_cache, '_index', None)
+    monkeypatch.setattr(audio_cache, '_total_bytes', 0)
+    monkeypatch.setattr(head_cache, '_heads', None)
+    monkeypatch.setattr(head_cache, '_plays', None)
+    
+    fake = FakeUpstream()
+    monkeypatch.setattr(ytmusic, '_get_session', lambda: fake)
+    resolutions = []
+    
+    def fake_extract(video_id):
+        resolutions.append(video_id)
+        return {
+            'video_id': video_id, 'title': 'Song', 'duration': 1, 'formats': [],
+            'audio_url': f'https://upstream.test/audio/{len(resolutions)}',
+            'expires_at': time.time() + 3600, 'refresh_at': time.time() + 3300,
+        }
+    
+    monkeypatch.setattr(resolver, '_extract', fake_extract)
+    fake.resolutions = resolutions
+    return fake
+
+
+def test_parse_range():
+    """Test single byte-range parsing."""
+    assert parse_range(None, 100) is None
+    assert parse_range('bytes=0-', 100) == (0, 99)
+    assert parse_range('bytes=10-19', 100) == (10, 19)
+    assert parse_range('bytes=-10', 100) == (90, 99)
+    assert parse_range('bytes=50-500', 100) == (50, 99)
+    with pytest.raises(ValueError):
+        parse_range('bytes=100-', 100)
+
+
+def test_stream_fills_audio_cache(client, upstream):
+    """Test that a full play is cached and later plays and ranges come from disk."""
+    response = client.get(f'/api/v1/tracks/stream/{VIDEO_ID}')
+    assert response.data == AUDIO
+    assert len(upstream.requests) == 1
+    
+    response = client.get(f'/api/v1/tracks/stream/{VIDEO_ID}')
+    assert response.data == AUDIO
+    assert response.headers['X-Cache'] == 'HIT'
+    
+    response = client.get(f'/api/v1/tracks/stream/{VIDEO_ID}', headers={'Range': 'bytes=1000-1999'})
+    assert response.status_code == 206
+    assert response.data == AUDIO[1000:2000]
+    assert response.headers['Content-Range'] == f'bytes 1000-1999/{len(AUDIO)}'
+    assert len(upstream.requests) == 1
+
+
+def test_interrupted_stream_keeps_only_received_bytes(app, upstream):
+    """Test that a half-read stream is cached as a partial entry covering only what arrived."""
+    generate, headers, status = ytmusic.stream_track(VIDEO_ID)
+    body = generate()
+    received = next(body)
+    body.close()
+    
+    entry = audio_cache.lookup(VIDEO_ID)
+    assert not entry['complete']
+    assert audio_cache.covers(entry, 0, len(received) - 1)
+    assert not audio_cache.covers(entry, 0, len(AUDIO) - 1)
+    assert not (audio_cache.directory / f"{entry['key']}.audio").exists()
+
+
+def test_sparse_ranges_fetch_only_holes(client, upstream):
+    """Test that seeks are served from cached extents plus upstream fetches for the gaps."""
+    stream = f'/api/v1/tracks/stream/{VIDEO_ID}'
+    assert client.get(stream, headers={'Range': 'bytes=0-29999'}).data == AUDIO[:30000]
+    assert client.get(stream, headers={'Range': 'bytes=70000-'}).data == AUDIO[70000:]
+    assert len(upstream.requests) == 2
+    
+    response = client.get(stream, headers={'Range': 'bytes=10000-79999'})
+    assert response.status_code == 206
+    assert response.data == AUDIO[10000:80000]
+    assert response.headers['X-Cache'] == 'PARTIAL'
+    assert upstream.requests[-1]['Range'] == 'bytes=30000-69999'
+    
+    # Every byte has now arrived: the file is complete and served locally
+    entry = audio_cache.lookup(VIDEO_ID)
+    assert entry['complete']
+    response = client.get(stream)
+    assert response.data == AUDIO
+    assert response.headers['X-Cache'] == 'HIT'
+    assert len(upstream.requests) == 3
+
+
+def test_cached_file_served_through_file_wrapper(app, client, upstream, mocker):
+    """Test that cached files use the zero-copy path with correct ranges, or nginx when configured."""
+    wrap_file = mocker.spy(tracks_routes, 'wrap_file')
+    stream = f'/api/v1/tracks/stream/{VIDEO_ID}'
+    client.get(stream).data
+    
+    response = client.get(stream, headers={'Range': 'bytes=90000-'})
+    assert response.status_code == 206
+    assert response.data == AUDIO[90000:]
+    assert response.headers['Content-Length'] == str(len(AUDIO) - 90000)
+    assert wrap_file.call_count == 1
+    
+    # Bounded ranges can't rely on the server stopping at Content-Length
+    response = client.get(stream, headers={'Range': 'bytes=10-19'})
+    assert response.data == AUDIO[10:20]
+    assert wrap_file.call_count == 1
+    
+    app.config['AUDIO_CACHE_SENDFILE_MODE'] = 'x-accel'
+    response = client.get(stream, headers={'Range': 'bytes=10-19'})
+    assert response.status_code == 200
+    assert response.headers['X-Accel-Redirect'] == f'/_audio_cache/{VIDEO_ID}.default.audio'
+    assert 'Content-Range' not in response.headers
+    assert len(upstream.requests) == 1
+
+
+def test_popular_track_starts_from_head(app, client, upstream):
+    """Test that a popular track plays its cached head and splices the upstream tail after it."""
+    app.config.update(AUDIO_CACHE_ENABLED=False, STREAM_HEAD_MIN_PLAYS=2, STREAM_HEAD_BYTES=16384)
+    stream = f'/api/v1/tracks/stream/{VIDEO_ID}'
+    assert client.get(stream).data == AUDIO
+    assert head_cache.get(VIDEO_ID) is None
+    assert client.get(stream).data == AUDIO
+    
+    response = client.get(stream)
+    assert response.headers['X-Cache'] == 'HEAD'
+    assert response.data == AUDIO
+    assert upstream.requests[-1]['Range'] == f'bytes=16384-{len(AUDIO) - 1}'
+    
+    # Ranges inside the head never touch upstream
+    response = client.get(stream, headers={'Range': 'bytes=100-199'})
+    assert response.data == AUDIO[100:200]
+    assert len(upstream.requests) == 3
+
+
+def test_concurrent_plays_are_all_counted(app, upstream):
+    """Test that plays recorded from many threads at once all count toward popularity."""
+    app.config['STREAM_HEAD_MIN_PLAYS'] = 400
+    
+    def play():
+        with app.app_context():
+            for _ in range(50):
+                head_cache.record_play(VIDEO_ID)
+    
+    threads = [threading.Thread(target=play) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    assert head_cache._plays.get(VIDEO_ID) == 400
+    with app.app_context():
+        assert head_cache.record_play(VIDEO_ID)
+
+
+def test_asgi_stream_keeps_headers_and_ranges(app, upstream, monkeypatch):
+    """Test the async proxy: Range passthrough, sparse hole fill, errors and Flask fallthrough."""
+    seen = []
+    
+    def googlevideo(request):
+        seen.append(request.headers.get('Range'))
+        fake = FakeResponse(AUDIO, request.headers.get('Range'))
+        return httpx.Response(fake.status_code, headers=fake.headers, content=fake._body)
+    
+    monkeypatch.setattr(AsyncStreamer, '_get_client',
+                        lambda self: httpx.AsyncClient(transport=httpx.MockTransport(googlevideo)))
+    asgi = create_asgi_app(app)
+    stream = f'/api/v1/tracks/stream/{VIDEO_ID}'
+    
+    async def run():
+        transport = httpx.ASGITransport(app=asgi)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test',
+                                     headers={'X-API-Key': 'test'}) as client:
+            return [
+                await client.get(stream, headers={'Range': 'bytes=0-29999'}),
+                await client.get(stream, headers={'Range': 'bytes=10000-49999'}),
+                await client.get('/api/v1/tracks/stream/not-an-id'),
+                await client.get('/api/v1/health'),
+            ]
+    
+    first, sparse, invalid, health = asyncio.run(run())
+    assert first.status_code == 206
+    assert first.content == AUDIO[:30000]
+    assert first.headers['Content-Range'] == f'bytes 0-29999/{len(AUDIO)}'
+    assert sparse.content == AUDIO[10000:50000]
+    assert sparse.headers['X-Cache'] == 'PARTIAL'
+    assert seen == ['bytes=0-29999', 'bytes=30000-49999']
+    assert invalid.status_code == 400
+    assert invalid.json()['error']['code'] == 'STREAM_ERROR'
+    assert health.status_code == 200
+
+
+def test_stale_url_is_re_resolved_once(client, upstream):
+    """Test that a 403 on a cached URL re-resolves it and the play still succeeds."""
+    upstream.stale_urls.add('https://upstream.test/audio/1')
+    
+    response = client.get(f'/api/v1/tracks/stream/{VIDEO_ID}')
+    assert response.status_code == 200
+    assert response.data == AUDIO
+    assert upstream.resolutions == [VIDEO_ID, VIDEO_ID]
+    assert len(upstream.requests) == 2
+
+
+def test_download_fetches_parallel_segments(app, client, upstream):
+    """Test that ?download=1 splits the file into range segments, reassembled in order and cached."""
+    app.config.update(STREAM_DOWNLOAD_SEGMENT_BYTES=16384, STREAM_DOWNLOAD_PARALLELISM=3)
+    stream = f'/api/v1/tracks/stream/{VIDEO_ID}'
+    assert client.get(stream, headers={'Range': 'bytes=20000-89999'}).data == AUDIO[20000:90000]
+    
+    response = client.get(f'{stream}?download=1')
+    assert response.status_code == 200
+    assert response.headers['Content-Length'] == str(len(AUDIO))
+    assert response.data == AUDIO
+    
+    ranges = sorted(tuple(map(int, re.findall(r'\d+', r['Range']))) for r in upstream.requests[1:])
+    # Segments cover everything but the extent already cached, never more than a segment each
+    assert ranges[0] == (0, 16383)
+    assert all(end - start < 16384 for start, end in ranges)
+    assert sum(end - start + 1 for start, end in ranges) == len(AUDIO) - 70000
+    assert audio_cache.lookup(VIDEO_ID)['complete']
+    
+    # Unknown size: the first segment doubles as the probe
+    other = 'kJQP7kiw5Fk'
+    seen = len(upstream.requests)
+    assert client.get(f'/api/v1/tracks/stream/{other}?download=1').data == AUDIO
+    assert upstream.requests[seen]['Range'] == 'bytes=0-16383'
+    assert len(upstream.requests) - seen == 7
+
+
+def test_dropped_upstream_resumes_in_same_response(client, upstream):
+    """Test that a reset mid-stream is resumed from the sent offset, re-resolving a stale URL."""
+    metrics.reset()
+    upstream.drops = [30000, 70000]
+    
+    response = client.get(f'/api/v1/tracks/stream/{VIDEO_ID}')
+    assert response.data == AUDIO
+    assert [r.get('Range') for r in upstream.requests] == [None, 'bytes=32768-102399']
+    
+    # This time the URL expires with the connection: resume re-resolves it
+    other = 'kJQP7kiw5Fk'
+    upstream.requests.clear()
+    upstream.drops = [40960]
+    upstream.stale_after_drop = True
+    response = client.get(f'/api/v1/tracks/stream/{other}', headers={'Range': 'bytes=0-89999'})
+    assert response.data == AUDIO[:90000]
+    assert upstream.resolutions == [VIDEO_ID, other, other]
+    assert [r.get('Range') for r in upstream.requests] == ['bytes=0-89999', 'bytes=40960-89999', 'bytes=40960-89999']
+    
+    counters = metrics.snapshot()
+    assert counters['counters']['stream.resume'] == 2
+    assert 'stream.resume_failed' not in counters['counters']
+    assert audio_cache.lookup(VIDEO_ID)['complete']
+
+
+def test_changed_upstream_file_is_not_spliced_in(client, upstream, monkeypatch):
+    """Test that resumes and hole fills stop when the upstream file no longer has the known size."""
+    metrics.reset()
+    get = upstream.get
+    
+    def replacing_get(url, **kwargs):
+        response = get(url, **kwargs)
+        response.on_drop = lambda: setattr(upstream, 'data', AUDIO[:50000])
+        return response
+    
+    monkeypatch.setattr(upstream, 'get', replacing_get)
+    upstream.drops = [30000]
+    response = client.get(f'/api/v1/tracks/stream/{VIDEO_ID}')
+    assert response.data == AUDIO[:32768]
+    assert upstream.requests[-1]['Range'] == 'bytes=32768-102399'
+    
+    # The cached extent says 100 KB; the hole is not filled from the 50 KB file
+    response = client.get(f'/api/v1/tracks/stream/{VIDEO_ID}', headers={'Range': 'bytes=10000-49999'})
+    assert response.data == AUDIO[10000:32768]
+    assert upstream.requests[-1]['Range'] == 'bytes=32768-49999'
+    
+    entry = audio_cache.lookup(VIDEO_ID)
+    assert entry['size'] == len(AUDIO)
+    assert not entry['complete']
+    assert metrics.snapshot()['counters']['stream.size_mismatch'] == 2
+
+
+def test_async_disconnect_during_head_closes_tail(app, upstream, monkeypatch):
+    """Test that leaving during the head closes a tail that has already connected."""
+    app.config.update(AUDIO_CACHE_ENABLED=False, STREAM_HEAD_BYTES=16384)
+    with app.app_context():
+        head_cache.get(VIDEO_ID)  # Configure the tiers
+    head_cache.put(VIDEO_ID, 'audio/mp4', len(AUDIO), AUDIO)
+    closed = []
+    
+    class Body(httpx.AsyncByteStream):
+        async def __aiter__(self):
+            yield AUDIO[16384:]
+        
+        async def aclose(self):
+            closed.append(True)
+    
+    def googlevideo(request):
+        fake = FakeResponse(AUDIO, request.headers.get('Range'))
+        return httpx.Response(fake.status_code, headers=fake.headers, stream=Body())
+    
+    monkeypatch.setattr(AsyncStreamer, '_get_client',
+                        lambda self: httpx.AsyncClient(transport=httpx.MockTransport(googlevideo)))
+    streamer = AsyncStreamer(app)
+    
+    async def run():
+        body, headers, status = await streamer.stream(VIDEO_ID)
+        assert headers['X-Cache'] == 'HEAD'
+        assert await body.__anext__() == AUDIO[:16384]
+        for _ in range(100):
+            if upstream.resolutions:
+                break
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)  # Let the tail connect
+        await body.aclose()
+    
+    asyncio.run(run())
+    assert closed == [True]
+
+
+def test_asgi_stream_resumes_after_drop(app, upstream, monkeypatch):
+    """Test that the async proxy splices a resumed upstream request into the same response."""
+    seen = []
+    
+    def googlevideo(request):
+        seen.append(request.headers.get('Range'))
+        fake = FakeResponse(AUDIO, request.headers.get('Range'))
+        
+        async def body():
+            yield fake._body[:70000]
+            if len(seen) == 1:
+                raise httpx.ReadError('Connection reset by peer')
+            yield fake._body[70000:]
+        
+        return httpx.Response(fake.status_code, headers=fake.headers, content=body())
+    
+    monkeypatch.setattr(AsyncStreamer, '_get_client',
+                        lambda self: httpx.AsyncClient(transport=httpx.MockTransport(googlevideo)))
+    asgi = create_asgi_app(app)
+    
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=asgi), base_url='http://test',
+                                     headers={'X-API-Key': 'test'}) as client:
+            return await client.get(f'/api/v1/tracks/stream/{VIDEO_ID}')
+    
+    response = asyncio.run(run())
+    assert response.content == AUDIO
+    # Only whole 64 KB chunks reached the client before the reset
+    assert seen == [None, f'bytes=65536-{len(AUDIO) - 1}']
+
+
+def test_asgi_stream_is_rate_limited(app, upstream, monkeypatch):
+    """Test that streams served on the event loop count against the default rate limit."""
+    def googlevideo(request):
+        fake = FakeResponse(AUDIO, request.headers.get('Range'))
+        return httpx.Response(fake.status_code, headers=fake.headers, content=fake._body)
+    
+    monkeypatch.setattr(AsyncStreamer, '_get_client',
+                        lambda self: httpx.AsyncClient(transport=httpx.MockTransport(googlevideo)))
+    monkeypatch.setattr(asgi_module, 'DEFAULT_RATE_LIMIT', '2 per minute')
+    limiter.reset()
+    asgi = create_asgi_app(app)
+    
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=asgi), base_url='http://test',
+                                     headers={'X-API-Key': 'test'}) as client:
+            return [await client.get(f'/api/v1/tracks/stream/{VIDEO_ID}') for _ in range(3)]
+    
+    statuses = [response.status_code for response in asyncio.run(run())]
+    limiter.reset()
+    assert statuses == [200, 200, 429]
+
+
+@pytest.fixture
+def variants(app, upstream, tmp_path, monkeypatch):
+    """Resolve to FORMATS and transcode with a stand-in ffmpeg that prefixes its input."""
+    ffmpeg = tmp_path / 'ffmpeg'
+    ffmpeg.write_text(f"#!{sys.executable}\nimport sys\n"
+                      "sys.stdout.buffer.write(b'ENC:' + sys.stdin.buffer.read())\n")
+    ffmpeg.chmod(0o755)
+    app.config.update(TRANSCODE_FFMPEG=str(ffmpeg), TRANSCODE_MAX_PROCESSES=1, TRANSCODE_QUEUE_TIMEOUT=0)
+    monkeypatch.setattr(transcoder, '_slots', None)
+    
+    extract = resolver._extract
+    monkeypatch.setattr(resolver, '_extract', lambda video_id: dict(extract(video_id), formats=FORMATS))
+    return upstream
+
+
+def test_quality_served_from_closest_native_format(client, variants):
+    """Test that ?quality= picks a native format near the target and caches it under its itag."""
+    stream = f'/api/v1/tracks/stream/{VIDEO_ID}'
+    response = client.get(f'{stream}?quality=low')
+    assert response.status_code == 200
+    assert response.data == AUDIO
+    assert variants.urls == ['https://upstream.test/249']
+    assert audio_cache.lookup(VIDEO_ID, '249')['complete']
+    assert audio_cache.lookup(VIDEO_ID) is None
+    
+    response = client.get(f'{stream}?codec=aac&kbps=128', headers={'Range': 'bytes=0-99'})
+    assert response.status_code == 206
+    assert variants.urls[-1] == 'https://upstream.test/140'
+    
+    response = client.get(f'{stream}?quality=lossless')
+    assert response.status_code == 400
+    assert response.get_json()['error']['code'] == 'INVALID_QUALITY'
+
+
+def test_transcoded_variant_is_cached(client, variants):
+    """Test that a codec with no native format is transcoded once, then served from the cache."""
+    stream = f'/api/v1/tracks/stream/{VIDEO_ID}?codec=mp3&kbps=64'
+    response = client.get(stream)
+    assert response.status_code == 200
+    assert response.data == b'ENC:' + AUDIO
+    assert response.headers['Content-Type'] == 'audio/mpeg'
+    assert response.headers['X-Transcode'] == 'mp3-64k'
+    assert variants.urls == ['https://upstream.test/audio/1']
+    assert transcoder.stats()['running'] == 0
+    
+    response = client.get(stream, headers={'Range': 'bytes=0-3'})
+    assert response.status_code == 206
+    assert response.data == b'ENC:'
+    assert len(variants.urls) == 1
+
+
+def test_unread_transcode_frees_its_slot(client, variants, monkeypatch):
+    """Test that a HEAD or an unread transcoded body gives back the ffmpeg slot and upstream response."""
+    stream = f'/api/v1/tracks/stream/{VIDEO_ID}?codec=mp3&kbps=64'
+    closed = []
+    monkeypatch.setattr(FakeResponse, 'close', lambda self: closed.append(self))
+    
+    # Servers close the body iterable after a HEAD, as they do for any response
+    response = client.head(stream)
+    assert response.status_code == 200
+    response.close()
+    assert len(closed) == 1
+    
+    response = client.get(stream, buffered=False)
+    response.close()
+    assert len({id(resp) for resp in closed}) == 2
+    
+    # The only slot is free again, and nothing was cached
+    with client.application.app_context():
+        assert transcoder.acquire()
+    transcoder.release()
+    assert transcoder.stats()['running'] == 0
+    assert audio_cache.lookup(VIDEO_ID, 'mp3-64k') is None
+
+
+def test_busy_transcoder_falls_back_to_native(client, variants):
+    """Test that with every ffmpeg slot taken the closest native bitrate is served instead."""
+    with client.application.app_context():
+        assert transcoder.acquire()
+    try:
+        response = client.get(f'/api/v1/tracks/stream/{VIDEO_ID}?codec=mp3&kbps=64')
+    finally:
+        transcoder.release()
+    assert response.data == AUDIO
+    assert 'X-Transcode' not in response.headers
+    assert variants.urls == ['https://upstream.test/250']
+
+
+def mp4_box(kind, body):
+    return struct.pack('>I4s', 8 + len(body), kind) + body
+
+
+def fragmented_mp4(fragments, seconds=2):
+    """(init segment, sidx box, media fragments) of a DASH m4a with `seconds` per fragment."""
+    init = mp4_box(b'ftyp', b'dash\0\0\0\0iso6') + mp4_box(b'moov', mp4_box(b'mvhd', bytes(100)))
+    media = [mp4_box(b'moof', bytes(16)) + mp4_box(b'mdat', bytes([i]) * size) for i, size in enumerate(fragments)]
+    refs = b''.join(struct.pack('>III', len(m), seconds * 1000, 0x90000000) for m in media)
+    sidx = mp4_box(b'sidx', struct.pack('>B3xIIIIHH', 0, 1, 1000, 0, 0, 0, len(media)) + refs)
+    return init, sidx, media
+
+
+def ebml(element, body):
+    """An EBML element with an 8-byte size, as YouTube's muxer writes them."""
+    return element.to_bytes((element.bit_length() + 7) // 8, 'big') + b'\x01' + len(body).to_bytes(7, 'big') + body
+
+
+def webm(clusters, cues_last=False):
+    """A WebM file with one cue per cluster, 1.5 s apart, and its Cues before or after the clusters."""
+    info = ebml(seek_index.INFO, ebml(seek_index.TIMECODE_SCALE, (1000000).to_bytes(3, 'big')))
+    
+    def cues(positions):
+        points = [
+            ebml(seek_index.CUE_POINT, ebml(seek_index.CUE_TIME, (i * 1500).to_bytes(4, 'big')) + ebml(
+                seek_index.CUE_TRACK_POSITIONS, ebml(seek_index.CUE_CLUSTER_POSITION, p.to_bytes(4, 'big'))
+            ))
+            for i, p in enumerate(positions)
+        ]
+        return ebml(seek_index.CUES, b''.join(points))
+    
+    def seek_head(position):
+        target = ebml(seek_index.SEEK_ID, seek_index.CUES.to_bytes(4, 'big')) \
+            + ebml(seek_index.SEEK_POSITION, position.to_bytes(4, 'big'))
+        return ebml(seek_index.SEEK_HEAD, ebml(seek_index.SEEK, target))
+    
+    bodies = [ebml(seek_index.CLUSTER, bytes([i]) * size) for i, size in enumerate(clusters)]
+    header = seek_head(0) + info + (b'' if cues_last else cues([0] * len(clusters)))
+    positions = [len(header) + sum(map(len, bodies[:i])) for i in range(len(bodies))]
+    index = cues(positions)
+    if cues_last:
+        segment = seek_head(len(header) + sum(map(len, bodies))) + info + b''.join(bodies) + index
+    else:
+        segment = seek_head(0) + info + index + b''.join(bodies)
+    return ebml(seek_index.EBML, ebml(0x4282, b'webm')) + ebml(seek_index.SEGMENT, segment), positions
+
+
+def test_seek_index_parses_sidx_and_cues():
+    """Test the fragment times and offsets read from a sidx box and from WebM Cues, near or far."""
+    init, sidx, media = fragmented_mp4([300, 500, 700])
+    data = init + sidx + b''.join(media)
+    index = seek_index.parse_index(data, len(data), None)
+    assert index['header'] == init
+    first = len(init) + len(sidx)
+    assert index['points'] == [(0, first), (2, first + len(media[0])), (4, first + len(media[0]) + len(media[1]))]
+    assert seek_index.locate(index, 3.9) == (2, first + len(media[0]))
+    
+    # Only the start of the sidx box is in the head: the rest is fetched
+    fetched = []
+    
+    def fetch(start, end):
+        fetched.append((start, end))
+        return data[start:end + 1]
+    
+    assert seek_index.parse_index(data[:len(init) + 20], len(data), fetch)['points'] == index['points']
+    assert fetched == [(len(init), len(init) + len(sidx) - 1)]
+    
+    for cues_last in (False, True):
+        data, positions = webm([400, 400, 400], cues_last)
+        fetched.clear()
+        head = data[:positions[0] + 100]
+        index = seek_index.parse_index(head, len(data), fetch)
+        segment = data.index(seek_index.SEGMENT.to_bytes(4, 'big')) + 12
+        assert index['points'] == [(i * 1.5, segment + p) for i, p in enumerate(positions)]
+        assert seek_index.locate(index, 2) == (1.5, segment + positions[1])
+        # The cut file's Segment size is unknown
+        assert index['header'][segment - 8:segment] == seek_index.UNKNOWN_SIZE
+        assert len(index['header']) == segment + positions[0]
+        assert bool(fetched) == cues_last
+    
+    assert seek_index.parse_index(AUDIO, len(AUDIO), fetch) is None
+
+
+def test_seek_starts_at_indexed_fragment(client, upstream):
+    """Test that ?t= streams the header plus the file from the fragment holding that time."""
+    init, sidx, media = fragmented_mp4([20000] * 5)
+    upstream.data = init + sidx + b''.join(media)
+    stream = f'/api/v1/tracks/stream/{VIDEO_ID}'
+    starts = [len(init) + len(sidx) + len(media[0]) * i for i in range(5)]
+    
+    response = client.get(f'{stream}?t=5')
+    assert response.status_code == 200
+    assert response.headers['X-Seek-Time'] == '4.000'
+    assert response.data == init + b''.join(media[2:])
+    assert response.headers['Content-Length'] == str(len(response.data))
+    assert [r.get('Range') for r in upstream.requests] == [
+        'bytes=0-65535', f'bytes={starts[2]}-'
+    ]
+    
+    # The index is cached: the next seek goes straight to its fragment
+    upstream.requests.clear()
+    response = client.get(f'{stream}?t=2.5')
+    assert response.data == init + b''.join(media[1:])
+    assert [r.get('Range') for r in upstream.requests] == [
+        f'bytes={starts[1]}-{starts[2] - 1}'
+    ]
+    
+    assert client.get(f'{stream}?t=soon').status_code == 400
+
+
+def test_seek_on_changed_file_restarts_cleanly(client, upstream, monkeypatch, mocker):
+    """Test that a stale index closes the discarded stream, and unindexed files are not remembered long."""
+    other = 'kJQP7kiw5Fk'
+    cache.set(make_key('seek_index', other), {'container': 'mp4', 'size': 999, 'header': '',
+                                              'points': [[0.0, 100]]}, 60)
+    responses, closed = [], []
+    get = upstream.get
+    
+    def recording_get(url, **kwargs):
+        responses.append(get(url, **kwargs))
+        return responses[-1]
+    
+    monkeypatch.setattr(upstream, 'get', recording_get)
+    monkeypatch.setattr(FakeResponse, 'close', lambda self: closed.append(self))
+    response = client.get(f'/api/v1/tracks/stream/{other}?t=1')
+    assert response.data == AUDIO
+    # The restart finds the (empty) cache entry the discarded stream created
+    assert [r.get('Range') for r in upstream.requests] == ['bytes=100-', f'bytes=0-{len(AUDIO) - 1}']
+    assert responses[0] in closed
+    
+    # AUDIO has no index; that is cached for SEEK_INDEX_MISS_TTL, not SEEK_INDEX_TTL
+    spy = mocker.spy(CacheService, 'set')
+    assert client.get(f'/api/v1/tracks/stream/{VIDEO_ID}?t=1').data == AUDIO
+    ttls = [call.args[3] for call in spy.call_args_list if call.args[1] == make_key('seek_index', VIDEO_ID)]
+    assert ttls == [300]
+
+
+@pytest.fixture
+def clock(app, monkeypatch):
+    """Bandwidth scheduling on, with a virtual clock that sleeps advance."""
+    app.config['BANDWIDTH_ENABLED'] = True
+    monkeypatch.setattr(bandwidth, '_configured', False)
+    monkeypatch.setattr(bandwidth, 'enabled', True, raising=False)
+    monkeypatch.setattr(bandwidth, '_global', None)
+    monkeypatch.setattr(bandwidth, '_keys', {})
+    monkeypatch.setattr(bandwidth, '_streams', {'playback': 0, 'bulk': 0})
+    
+    class Clock:
+        now = 1000.0
+        slept = []
+        
+        def monotonic(self):
+            return self.now
+        
+        def sleep(self, seconds):
+            self.slept.append(seconds)
+            self.now += seconds
+    
+    fake = Clock()
+    monkeypatch.setattr(bandwidth_module, 'time', fake)
+    metrics.reset()
+    return fake
+
+
+def test_playback_is_paced_after_its_burst(app, client, upstream, clock):
+    """Test that a play gets its burst at once and the rest at real time plus headroom."""
+    app.config.update(BANDWIDTH_PLAYBACK_KBPS=80, BANDWIDTH_PLAYBACK_BURST_SECONDS=1)
+    response = client.get(f'/api/v1/tracks/stream/{VIDEO_ID}')
+    assert response.data == AUDIO
+    response.close()
+    
+    # 10 KB burst, then 80 kbps * 1.5 = 15 KB/s
+    assert sum(clock.slept) == pytest.approx((len(AUDIO) - 10000) / 15000)
+    # Only the first 8 KB chunk fits in the burst
+    assert len(clock.slept) == len(range(0, len(AUDIO), 8192)) - 1
+    counters = metrics.snapshot()['counters']
+    assert counters['bandwidth.playback.bytes'] == len(AUDIO)
+    assert counters['bandwidth.playback.throttled_ms'] > 6000
+    assert bandwidth.stats()['streams'] == {'playback': 0, 'bulk': 0}
+
+
+def test_bulk_streams_leave_global_reserve_to_playback(app, clock):
+    """Test that downloads wait for bandwidth above the reserve while plays and key limits apply."""
+    app.config.update(BANDWIDTH_GLOBAL_KBPS=800, BANDWIDTH_BULK_RESERVE=0.25, BANDWIDTH_PER_KEY_KBPS=400)
+    with app.app_context():
+        play = bandwidth.open(None)
+        download = bandwidth.open('key-b', bulk=True)
+        assert bandwidth.stats()['streams'] == {'playback': 1, 'bulk': 1}
+        assert bandwidth.stats()['global'] == {'rate_kbps': 800, 'tokens': 100000}
+    
+    # Playback may drain the global bucket below the reserve without waiting
+    play.pace(40000)
+    play.pace(40000)
+    assert clock.slept == []
+    # Downloads wait until 25 KB stays after their bytes: (25000 + 8192 - 20000) / 100 KB/s
+    download.pace(8192)
+    assert sum(clock.slept) == pytest.approx(0.13192)
+    
+    for shaper in (play, download):
+        shaper.close()
+    with app.app_context():
+        assert bandwidth.stats()['streams'] == {'playback': 0, 'bulk': 0}
+
+
+def test_streams_of_one_key_share_its_bucket(app, clock):
+    """Test that the per-key bucket paces the sum of a key's streams and is dropped with them."""
+    app.config['BANDWIDTH_PER_KEY_KBPS'] = 400
+    with app.app_context():
+        first, second, other = bandwidth.open('key-a'), bandwidth.open('key-a'), bandwidth.open('key-b')
+        assert bandwidth.stats()['keys'] == 2
+    
+    # 50 KB burst and 50 KB/s for key-a's two streams together
+    first.pace(30000)
+    other.pace(30000)
+    assert clock.slept == []
+    second.pace(30000)
+    assert clock.slept == [pytest.approx(0.2)]
+    
+    for shaper in (first, second, other):
+        shaper.close()
+    with app.app_context():
+        assert bandwidth.stats()['keys'] == 0
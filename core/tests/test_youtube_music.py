@@ -0,0 +1,115 @@
+"""
+Tests for the YouTube Music service layer.
+"""
+import pytest
+from yt_dlp.utils import DownloadError
+
+from app.services.cache import CacheService, cache, make_key
+from app.services.resolver import resolver
+from app.services.validation import is_valid_video_id, is_valid_artist_id, is_valid_album_id, is_not_found_error
+from app.services.youtube_music import ytmusic, UpstreamError
+
+
+@pytest.fixture
+def fresh_cache(app, monkeypatch):
+    """Isolate each test from entries cached by earlier ones."""
+    monkeypatch.setattr(CacheService, '_memory_cache', None)
+
+
+def test_id_validation():
+    """Test syntactic ID checks."""
+    assert is_valid_video_id('dQw4w9WgXcQ')
+    assert not is_valid_video_id('dQw4w9WgXcQ/../x')
+    assert is_valid_artist_id('UCmMUZbaYdNH0bEd1PAlAqsA')
+    assert not is_valid_artist_id('nonsense')
+    assert is_valid_album_id('MPREb_4pL8gzRtw1p')
+    assert not is_valid_album_id('')
+
+
+def test_invalid_ids_never_reach_upstream(fresh_cache, mocker):
+    """Test that malformed IDs are rejected before any upstream call."""
+    upstream = mocker.patch.object(ytmusic._ytmusic, 'get_album')
+    
+    assert ytmusic.get_album('not-an-album') is None
+    assert ytmusic.stream_track('bad id')[2] == 400
+    upstream.assert_not_called()
+
+
+def test_missing_ids_are_negatively_cached(fresh_cache, mocker):
+    """Test that a "not found" answer is remembered."""
+    upstream = mocker.patch.object(ytmusic._ytmusic, 'get_artist',
+                                   side_effect=Exception('Server returned HTTP 404: Not Found'))
+    
+    assert ytmusic.get_artist('UCaaaaaaaaaaaaaaaaaaaaaa') is None
+    assert ytmusic.get_artist('UCaaaaaaaaaaaaaaaaaaaaaa') is None
+    assert upstream.call_count == 1
+
+
+def test_transient_errors_are_briefly_cached(fresh_cache, mocker):
+    """Test that transient failures raise and are not retried immediately."""
+    upstream = mocker.patch.object(ytmusic._ytmusic, 'get_album',
+                                   side_effect=ConnectionError('connection reset'))
+    
+    with pytest.raises(UpstreamError):
+        ytmusic.get_album('MPREb_4pL8gzRtw1p')
+    with pytest.raises(UpstreamError):
+        ytmusic.get_album('MPREb_4pL8gzRtw1p')
+    assert upstream.call_count == 1
+
+
+def test_only_explicit_answers_count_as_not_found():
+    """Test that parse failures and server errors are transient, not "not found"."""
+    class HTTPError(Exception):
+        def __init__(self, status_code):
+            super().__init__(f'HTTP {status_code}')
+            self.response = type('Response', (), {'status_code': status_code})()
+    
+    assert is_not_found_error(Exception('Server returned HTTP 404: Not Found'))
+    assert is_not_found_error(Exception('ERROR: [youtube] abc: Video unavailable'))
+    assert is_not_found_error(HTTPError(410))
+    assert not is_not_found_error(KeyError('contents'))
+    assert not is_not_found_error(IndexError('list index out of range'))
+    assert not is_not_found_error(HTTPError(503))
+    assert not is_not_found_error(Exception('Connection terminated by peer'))
+    assert not is_not_found_error(Exception('ffprobe and ffmpeg not found'))
+
+
+def test_parse_errors_are_not_remembered_as_missing(fresh_cache, mocker):
+    """Test that an unparseable page raises instead of reporting the album as missing."""
+    upstream = mocker.patch.object(ytmusic._ytmusic, 'get_album', side_effect=KeyError('contents'))
+    
+    with pytest.raises(UpstreamError):
+        ytmusic.get_album('MPREb_4pL8gzRtw1p')
+    assert upstream.call_count == 1
+
+
+def test_track_lookups_share_one_negative_cache_entry(fresh_cache, mocker):
+    """Test that a missing video found by the stream path is not looked up again for track info."""
+    resolve = mocker.patch.object(resolver, 'resolve', side_effect=Exception('Video unavailable'))
+    
+    assert ytmusic._get_audio_url('dQw4w9WgXcQ') is None
+    assert ytmusic.get_streaming_url('dQw4w9WgXcQ') is None
+    assert resolve.call_count == 1
+
+
+def test_unavailable_format_is_not_remembered_as_missing(fresh_cache, mocker):
+    """Test that yt-dlp's format error on a playable video is transient, not a 10-minute 404."""
+    error = DownloadError('ERROR: [youtube] dQw4w9WgXcQ: Requested format is not available')
+    resolve = mocker.patch.object(resolver, 'resolve', side_effect=error)
+    
+    assert not is_not_found_error(error)
+    with pytest.raises(UpstreamError):
+        ytmusic._get_audio_url('dQw4w9WgXcQ')
+    assert cache.get(make_key('missing', 'track', 'dQw4w9WgXcQ')) == 'error'
+    assert resolve.call_count == 1
+
+
+def test_local_timeouts_are_not_negatively_cached(fresh_cache, mocker):
+    """Test that a wait timing out on our side is retried by the next request."""
+    resolve = mocker.patch.object(resolver, 'resolve', side_effect=TimeoutError('Timed out waiting'))
+    
+    for _ in range(2):
+        with pytest.raises(TimeoutError):
+            ytmusic._get_audio_url('dQw4w9WgXcQ')
+    assert resolve.call_count == 2
+    assert cache.get(make_key('missing', 'track', 'dQw4w9WgXcQ')) is None
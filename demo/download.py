@@ -50,7 +50,7 @@ def download_track(track_id: str, filename: str, output_dir: Path):
     print(f"{c.BLUE}⬇ Downloading...{c.END}")
     
     try:
-        resp = requests.get(f"{API_BASE}/api/v1/tracks/stream/{track_id}", stream=True)
+        resp = requests.get(f"{API_BASE}/api/v1/tracks/stream/{track_id}?download=1", stream=True)
         resp.raise_for_status()
         
         total = int(resp.headers.get('content-length', 0))